@@ -1,13 +1,25 @@
+import os
+
 import numpy as np
 
 
 class BackendBase:
 
-    def __init__(self, name, mpi_rank=0, all_type="float64", gpupos=0, silent=False):
+    def __init__(
+        self,
+        name,
+        mpi_rank=0,
+        all_type="float64",
+        gpupos=0,
+        silent=False,
+        conv_type=None,
+    ):
 
         self.BACKEND = name
         self.mpi_rank = mpi_rank
         self.all_type = all_type
+        # reduced precision of the healpix convolutions (None for all_type)
+        self.conv_type = conv_type
         self.gpupos = gpupos
         self.silent = silent
         # ---------------------------------------------−---------
@@ -357,12 +369,29 @@ class BackendBase:
                 0 * self._fft_3_orient[(norient, nharm, imaginary)],
             )
 
+    # ---------------------------------------------−---------
+    # free memory in bytes of the device computing the tensors
+    def available_memory(self):
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return None
+
+    # ---------------------------------------------−---------
+    # func traced once per input shapes into a graph of the backend, the
+    # eager function when the backend has no graph compiler
+    def bk_compile(self, func):
+        return func
+
     # ---------------------------------------------−---------
     # --             BACKEND DEFINITION                    --
     # ---------------------------------------------−---------
     def bk_SparseTensor(self, indice, w, dense_shape=[]):
         raise NotImplementedError("This is an abstract class.")
 
+    def bk_SparseTensorCSR(self, indptr, indices, w, dense_shape=[]):
+        raise NotImplementedError("This is an abstract class.")
+
     def bk_stack(self, list, axis=0):
         raise NotImplementedError("This is an abstract class.")
 
@@ -504,6 +533,15 @@ class BackendBase:
     def bk_gather(self, data, idx):
         raise NotImplementedError("This is an abstract class.")
 
+    def bk_index(self, idx):
+        raise NotImplementedError("This is an abstract class.")
+
+    def bk_einsum(self, subscripts, *operands):
+        raise NotImplementedError("This is an abstract class.")
+
+    def bk_cast_conv(self, x):
+        raise NotImplementedError("This is an abstract class.")
+
     def bk_reverse(self, data, axis=0):
         raise NotImplementedError("This is an abstract class.")
 
@@ -537,6 +575,9 @@ class BackendBase:
     def bk_clip_by_value(self, x, xmin, xmax):
         raise NotImplementedError("This is an abstract class.")
 
+    def bk_nan_to_num(self, x):
+        raise NotImplementedError("This is an abstract class.")
+
     def bk_cast(self, x):
         raise NotImplementedError("This is an abstract class.")
 
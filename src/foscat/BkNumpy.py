@@ -38,6 +38,16 @@ class BkNumpy(BackendBase.BackendBase):
                 )
                 return None
 
+        # numpy has no bfloat16
+        if self.conv_type is None:
+            self.conv_bk_type = None
+        elif self.conv_type == "float16":
+            self.conv_bk_type = self.backend.float16
+        else:
+            raise ValueError(
+                f"ERROR INIT foscat: {self.conv_type} should be float16 with numpy"
+            )
+
         # ===========================================================================
         # INIT
 
@@ -54,11 +64,50 @@ class BkNumpy(BackendBase.BackendBase):
             (w, (indice[:, 0], indice[:, 1])), shape=dense_shape
         )
 
+    def bk_SparseTensorCSR(self, indptr, indices, w, dense_shape=[]):
+        # no copy of the (memory mapped) arrays
+        return self.scipy.sparse.csr_matrix(
+            (w, indices, indptr), shape=dense_shape, copy=False
+        )
+
+    def binned_mean(self, data, cell_ids):
+        """
+        Compute the mean over groups of 4 nested HEALPix cells (nside → nside/2).
+
+        Args:
+            data (np.ndarray): Array of shape [..., N], where N is the number of HEALPix cells.
+            cell_ids (np.ndarray): Array of shape [N], with cell indices (nested ordering).
+
+        Returns:
+            np.ndarray: Array of shape [..., n_bins], with averaged values per group of 4 cells.
+        """
+        groups, inverse = np.unique(np.asarray(cell_ids) // 4, return_inverse=True)
+        n_bins = groups.shape[0]
+        counts = np.bincount(inverse, minlength=n_bins)
+
+        # one bincount for all the leading dimensions
+        ishape = list(data.shape)
+        data_flat = data.reshape(-1, ishape[-1])
+        nrow = data_flat.shape[0]
+        idx = (inverse[None, :] + n_bins * np.arange(nrow)[:, None]).ravel()
+
+        def l_sum(x):
+            return np.bincount(idx, x.ravel(), nrow * n_bins).reshape(nrow, n_bins)
+
+        if np.iscomplexobj(data_flat):
+            out = l_sum(data_flat.real) + 1j * l_sum(data_flat.imag)
+        else:
+            out = l_sum(data_flat)
+
+        out = (out / counts).astype(data.dtype, copy=False)
+        return out.reshape(ishape[0:-1] + [n_bins]), groups
+
     def bk_stack(self, list, axis=0):
         return self.backend.stack(list, axis=axis)
 
     def bk_sparse_dense_matmul(self, smat, mat):
-        return smat.dot(mat)
+        # ndarray.dot does not dispatch to a scipy sparse right operand
+        return smat @ mat
 
     def conv2d(self, x, w, strides=[1, 1, 1, 1], padding="SAME"):
         res = np.zeros([x.shape[0], x.shape[1], x.shape[2], w.shape[3]], dtype=x.dtype)
@@ -277,6 +326,17 @@ class BkNumpy(BackendBase.BackendBase):
     def bk_zeros(self, shape, dtype=None):
         return np.zeros(shape, dtype=dtype)
 
+    def bk_index(self, idx):
+        return np.asarray(idx, dtype="int64")
+
+    def bk_einsum(self, subscripts, *operands):
+        return np.einsum(subscripts, *operands, optimize=True)
+
+    def bk_cast_conv(self, x):
+        if self.conv_bk_type is None:
+            return x
+        return x.astype(self.conv_bk_type, copy=False)
+
     def bk_gather(self, data, idx, axis=0):
         if axis == 0:
             return data[idx]
@@ -322,6 +382,9 @@ class BkNumpy(BackendBase.BackendBase):
     def bk_clip_by_value(self, x, xmin, xmax):
         return self.backend.clip(x, xmin, xmax)
 
+    def bk_nan_to_num(self, x):
+        return self.backend.where(self.backend.isnan(x), 0.0, x)
+
     def bk_cast(self, x):
         if isinstance(x, np.float64):
             if self.all_bk_type == "float32":
@@ -355,7 +418,7 @@ class BkNumpy(BackendBase.BackendBase):
         else:
             out_type = self.all_bk_type
 
-        return x.astype(out_type)
+        return x.astype(out_type, copy=False)
 
     def bk_variable(self, x):
 
@@ -39,6 +39,19 @@ class BkTensorflow(BackendBase.BackendBase):
                 f"ERROR INIT foscat: {self.all_type} should be float32 or float64"
             )
 
+        conv_map = {
+            None: None,
+            "float16": self.backend.float16,
+            "bfloat16": self.backend.bfloat16,
+        }
+
+        if self.conv_type in conv_map:
+            self.conv_bk_type = conv_map[self.conv_type]
+        else:
+            raise ValueError(
+                f"ERROR INIT foscat: {self.conv_type} should be float16 or bfloat16"
+            )
+
         if self.mpi_rank == 0:
             if not self.silent:
                 print(
@@ -86,12 +99,20 @@ class BkTensorflow(BackendBase.BackendBase):
     def tf_loc_function(self, func):
         return func
 
+    def bk_compile(self, func):
+        return tf.function(func)
+
     # ---------------------------------------------−---------
     # --             BACKEND DEFINITION                    --
     # ---------------------------------------------−---------
     def bk_SparseTensor(self, indice, w, dense_shape=[]):
         return self.backend.SparseTensor(indice, w, dense_shape=dense_shape)
 
+    def bk_SparseTensorCSR(self, indptr, indices, w, dense_shape=[]):
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        indice = np.stack([rows, np.asarray(indices, dtype="int64")], 1)
+        return self.backend.SparseTensor(indice, w, dense_shape=dense_shape)
+
     def bk_stack(self, list, axis=0):
         return self.backend.stack(list, axis=axis)
 
@@ -482,6 +503,17 @@ class BkTensorflow(BackendBase.BackendBase):
     def bk_zeros(self, shape, dtype=None):
         return self.backend.zeros(shape, dtype=dtype)
 
+    def bk_index(self, idx):
+        return self.backend.constant(idx, dtype=self.backend.int64)
+
+    def bk_einsum(self, subscripts, *operands):
+        return self.backend.einsum(subscripts, *operands)
+
+    def bk_cast_conv(self, x):
+        if self.conv_bk_type is None:
+            return x
+        return self.backend.cast(x, self.conv_bk_type)
+
     def bk_gather(self, data, idx, axis=0):
         return self.backend.gather(data, idx, axis=axis)
 
@@ -548,6 +580,11 @@ class BkTensorflow(BackendBase.BackendBase):
             x = np.clip(x, xmin, xmax)
         return self.backend.clip_by_value(x, xmin, xmax)
 
+    def bk_nan_to_num(self, x):
+        return self.backend.where(
+            self.backend.math.is_nan(x), self.backend.zeros_like(x), x
+        )
+
     def bk_cast(self, x):
         if isinstance(x, np.float64):
             if self.all_bk_type == "float32":
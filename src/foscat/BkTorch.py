@@ -36,6 +36,19 @@ class BkTorch(BackendBase.BackendBase):
                 f"ERROR INIT foscat: {self.all_type} should be float32 or float64"
             )
 
+        conv_map = {
+            None: None,
+            "float16": self.backend.float16,
+            "bfloat16": self.backend.bfloat16,
+        }
+
+        if self.conv_type in conv_map:
+            self.conv_bk_type = conv_map[self.conv_type]
+        else:
+            raise ValueError(
+                f"ERROR INIT foscat: {self.conv_type} should be float16 or bfloat16"
+            )
+
         # ===========================================================================
         # INIT
         if self.mpi_rank == 0:
@@ -65,6 +78,15 @@ class BkTorch(BackendBase.BackendBase):
 
     import torch
 
+    def available_memory(self):
+        if self.torch_device.type == "cuda":
+            return torch.cuda.mem_get_info(self.torch_device)[0]
+        return super().available_memory()
+
+    def bk_compile(self, func):
+        # one graph per shape, the sparse CSR operators can not be traced
+        return torch.compile(func, dynamic=False)
+
     def binned_mean(self, data, cell_ids):
         """
         Compute the mean over groups of 4 nested HEALPix cells (nside → nside/2).
@@ -155,6 +177,14 @@ class BkTorch(BackendBase.BackendBase):
             .to(self.torch_device)
         )
 
+    def bk_SparseTensorCSR(self, indptr, indices, w, dense_shape=[]):
+        return self.backend.sparse_csr_tensor(
+            self.backend.as_tensor(indptr),
+            self.backend.as_tensor(indices),
+            w,
+            dense_shape,
+        ).to(self.torch_device)
+
     def bk_stack(self, list, axis=0):
         return self.backend.stack(list, axis=axis).to(self.torch_device)
 
@@ -176,7 +206,9 @@ class BkTorch(BackendBase.BackendBase):
         O_c, wx, wy = w.shape
 
         # Flatten leading dims into batch dimension
-        B = int(torch.prod(torch.tensor(leading_dims))) if leading_dims else 1
+        B = 1
+        for k in leading_dims:
+            B = B * k
         x = x.reshape(B, 1, Nx, Ny)  # [B, 1, Nx, Ny]
 
         # Reshape filters to match conv2d format [O_c, 1, wx, wy]
@@ -391,9 +423,8 @@ class BkTorch(BackendBase.BackendBase):
         return self.backend.argmax(data)
 
     def bk_reshape(self, data, shape):
-        if isinstance(data, np.ndarray):
-            return data.reshape(shape)
-        return data.view(shape)
+        # a view if possible, a copy for non contiguous tensors (einsum results)
+        return data.reshape(shape)
 
     def bk_repeat(self, data, nn, axis=0):
         return self.backend.repeat_interleave(data, repeats=nn, dim=axis)
@@ -439,6 +470,19 @@ class BkTorch(BackendBase.BackendBase):
     def bk_zeros(self, shape, dtype=None):
         return self.backend.zeros(shape, dtype=dtype).to(self.torch_device)
 
+    def bk_index(self, idx):
+        return self.backend.as_tensor(
+            np.asarray(idx, dtype="int64"), device=self.torch_device
+        )
+
+    def bk_einsum(self, subscripts, *operands):
+        return self.backend.einsum(subscripts, *operands)
+
+    def bk_cast_conv(self, x):
+        if self.conv_bk_type is None:
+            return x
+        return x.to(self.conv_bk_type)
+
     def bk_gather(self, data, idx, axis=0):
         if axis == 0:
             return data[idx]
@@ -504,6 +548,9 @@ class BkTorch(BackendBase.BackendBase):
         )
         return self.backend.clamp(x, min=xmin, max=xmax)
 
+    def bk_nan_to_num(self, x):
+        return self.backend.where(self.backend.isnan(x), self.backend.zeros_like(x), x)
+
     def bk_cast(self, x):
         if isinstance(x, np.float64):
             if self.all_bk_type == "float32":
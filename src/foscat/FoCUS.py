@@ -1,13 +1,439 @@
+import hashlib
+import multiprocessing
 import os
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import healpy as hp
 import numpy as np
 from scipy.interpolate import griddata
+from scipy.spatial import cKDTree
+
+from foscat.OperatorCache import OperatorCache
 
 TMPFILE_VERSION = "V5_0"
 
 
+# ---------------------------------------------−---------
+# width (pw), smoothing width (pw2) and weight threshold of the healpix wavelet
+def wave_kernel_param(l_kernel):
+    if l_kernel == 5:
+        return 0.5, 0.5, 2e-4
+    elif l_kernel == 3:
+        return 1.0 / np.sqrt(2), 1.0, 1e-3
+    elif l_kernel == 7:
+        return 0.5, 0.25, 4e-5
+    raise ValueError(
+        "Only 3x3, 5x5 and 7x7 kernels are available for Healpix, not %dx%d"
+        % (l_kernel, l_kernel)
+    )
+
+
+# ---------------------------------------------−---------
+# Batched computation of the healpix wavelet (indice,wav) and smoothing
+# (indice2,wwav) operators for the pixels [pix_min,pix_max[ of a full sky map.
+# The values are ordered as the former per pixel loop: pixel, orientation and
+# neighbour in increasing nested index, so that the PIDX files are unchanged.
+# For a partial sky map of nested cell_ids, the pixels and neighbours are
+# the positions in cell_ids, neighbours are searched in the map only.
+def calc_wave_index(
+    nside,
+    l_kernel,
+    norient,
+    pix_min=0,
+    pix_max=None,
+    block_size=4096,
+    silent=True,
+    cell_ids=None,
+):
+    pw, pw2, threshold = wave_kernel_param(l_kernel)
+
+    if cell_ids is None:
+        cell_ids = np.arange(12 * nside * nside)
+    npix = cell_ids.shape[0]
+    if pix_max is None:
+        pix_max = npix
+
+    th, ph = hp.pix2ang(nside, cell_ids, nest=True)
+    x, y, z = hp.pix2vec(nside, cell_ids, nest=True)
+    tree = cKDTree(np.stack([x, y, z], 1))
+
+    # neighbours are searched inside the disc of radius 2*pi/nside used by the
+    # per pixel version, restricted to the chord where the weights pass the threshold
+    if 2 * np.pi / nside < np.pi:
+        radius = 2 * np.sin(np.pi / nside)
+    else:
+        radius = np.inf
+    radius = min(radius, 1.01 * np.sqrt(-np.log(threshold) / (2 * pw2)) / nside + 1e-12)
+    knn = min(npix, int(4.5 * (nside * radius) ** 2) + 16)
+    if pix_max <= pix_min:
+        return (
+            np.zeros([0, 2], dtype="int"),
+            np.zeros([0], dtype="complex"),
+            np.zeros([0, 2], dtype="int"),
+            np.zeros([0]),
+        )
+
+    indice = []
+    wav = []
+    indice2 = []
+    wwav = []
+    for k in range(pix_min, pix_max, block_size):
+        if not silent:
+            print(
+                "Pre-compute nside=%6d %.2f%%"
+                % (nside, 100 * (k - pix_min) / (pix_max - pix_min))
+            )
+        l_indice, l_wav, l_indice2, l_wwav, knn = _calc_wave_index_block(
+            nside,
+            norient,
+            np.arange(k, min(k + block_size, pix_max)),
+            th,
+            ph,
+            x,
+            y,
+            z,
+            tree,
+            radius,
+            knn,
+            pw,
+            pw2,
+            threshold,
+        )
+        indice.append(l_indice)
+        wav.append(l_wav)
+        indice2.append(l_indice2)
+        wwav.append(l_wwav)
+
+    return (
+        np.concatenate(indice, 0),
+        np.concatenate(wav, 0),
+        np.concatenate(indice2, 0),
+        np.concatenate(wwav, 0),
+    )
+
+
+def _calc_wave_index_block(
+    nside, norient, pidx, th, ph, x, y, z, tree, radius, knn, pw, pw2, threshold
+):
+    npix = x.shape[0]
+
+    # neighbourhood [Nblock,knn], sorted by nested index as done by hp.query_disc
+    while True:
+        dist, hidx = tree.query(
+            np.stack([x[pidx], y[pidx], z[pidx]], 1),
+            k=knn,
+            distance_upper_bound=radius,
+        )
+        if knn == npix or not np.isfinite(dist[:, -1]).any():
+            break
+        knn = min(npix, 2 * knn)
+
+    hidx = np.sort(hidx, 1)
+    valid = hidx < npix
+    hidx[~valid] = 0
+
+    # rotation matrices of hp.Rotator(rot=[phi, -theta], eulertype="ZYZ") [Nblock,3,3]
+    phi = ph[pidx] / np.pi * 180
+    thi = th[pidx] / np.pi * 180
+    a1 = phi * (np.pi / 180.0)
+    a2 = -(-thi * (np.pi / 180.0))
+    c1 = np.cos(a1)
+    s1 = np.sin(a1)
+    c2 = np.cos(a2)
+    s2 = np.sin(a2)
+    mat = np.zeros([pidx.shape[0], 3, 3])
+    mat[:, 0, 0] = c2 * c1
+    mat[:, 0, 1] = c2 * s1
+    mat[:, 0, 2] = -s2
+    mat[:, 1, 0] = -s1
+    mat[:, 1, 1] = c1
+    mat[:, 2, 0] = s2 * c1
+    mat[:, 2, 1] = s2 * s1
+    mat[:, 2, 2] = c2
+
+    vec = hp.rotator.dir2vec(th[hidx].flatten(), ph[hidx].flatten())
+    vec = np.matmul(
+        mat, np.transpose(vec.reshape(3, hidx.shape[0], hidx.shape[1]), [1, 0, 2])
+    )
+    vx = vec[:, 0]
+    vy = vec[:, 1]
+    vz = vec[:, 2]
+
+    t2, p2 = hp.rotator.vec2dir(vx.flatten(), vy.flatten(), vz.flatten())
+    vec2 = hp.ang2vec(t2, p2)
+
+    x2 = vec2[:, 0].reshape(hidx.shape)
+    y2 = vec2[:, 1].reshape(hidx.shape)
+    z2 = vec2[:, 2].reshape(hidx.shape)
+
+    # smoothing kernel
+    ww = np.exp(-pw2 * ((nside) ** 2) * ((x2) ** 2 + (y2) ** 2 + (z2 - 1.0) ** 2))
+    ww[~valid] = 0.0
+
+    idx = valid * ((ww**2) > threshold)
+    sww = np.sum(ww * idx, 1)
+    ib, ik = np.nonzero(idx)
+    indice2 = np.zeros([ib.shape[0], 2], dtype="int")
+    indice2[:, 1] = pidx[ib]
+    indice2[:, 0] = hidx[ib, ik]
+    wwav = ww[ib, ik] / sww[ib]
+
+    # oriented wavelet [Nblock,NORIENT,knn]
+    zh = np.expand_dims(z[hidx], 1)
+    rot = np.arange(norient).reshape(1, norient, 1)
+    lphi = phi.reshape(phi.shape[0], 1, 1)
+    angle = (
+        rot / 4.0 * np.pi
+        - lphi / 180.0 * np.pi * (zh > 0)
+        - (180.0 - lphi) / 180.0 * np.pi * (zh < 0)
+    )
+    ww = np.expand_dims(ww, 1)
+    axes = np.expand_dims(y2, 1) * np.cos(angle) - np.expand_dims(x2, 1) * np.sin(angle)
+    wresr = ww * np.cos(pw * axes * (nside) * np.pi)
+    wresi = ww * np.sin(pw * axes * (nside) * np.pi)
+
+    vnorm = wresr * wresr + wresi * wresi
+    idx = np.expand_dims(valid, 1) * (vnorm > threshold)
+    nval = np.maximum(np.sum(idx, 2), 1)
+
+    normr = np.expand_dims(np.sum(wresr * idx, 2) / nval, -1)
+    normi = np.expand_dims(np.sum(wresi * idx, 2) / nval, -1)
+    val = (wresr - normr + 1j * (wresi - normi)) * idx
+    r = np.sum(abs(val), 2)
+    r[r == 0] = 1.0
+    val = val / np.expand_dims(r, -1)
+
+    ib, ir, ik = np.nonzero(idx)
+    indice = np.zeros([ib.shape[0], 2], dtype="int")
+    indice[:, 1] = pidx[ib] + ir * npix
+    indice[:, 0] = hidx[ib, ik]
+
+    return indice, val[ib, ir, ik], indice2, wwav, knn
+
+
+# ---------------------------------------------−---------
+# cache file of the healpix operators, name is PIDX, WAVE, PIDX2 or SMOO
+def wave_index_file(path, kernelsz, norient, nside, name):
+    return "%s/FOSCAT_%s_W%d_%d_%d_%s.npy" % (
+        path,
+        TMPFILE_VERSION,
+        kernelsz**2,
+        norient,
+        nside,
+        name,
+    )
+
+
+# ---------------------------------------------−---------
+# cache directory of all the operators of a kernel size and a number of orientations
+def operator_cache_file(path, kernelsz, norient):
+    return "%s/FOSCAT_%s_W%d_%d.ops" % (path, TMPFILE_VERSION, kernelsz**2, norient)
+
+
+# ---------------------------------------------−---------
+# cache entry of an operator of nside, e.g. WAVE_INDPTR or CNN_I, cells is the
+# cell_ids_hash of a partial sky map
+def cache_key(nside, name, cells=None):
+    if cells is None:
+        return "%d_%s" % (nside, name)
+    return "%d_%s_%s" % (nside, cells, name)
+
+
+# ---------------------------------------------−---------
+# key of a set of nested cell_ids in the operator cache
+def cell_ids_hash(cell_ids):
+    return hashlib.sha1(
+        np.ascontiguousarray(cell_ids, dtype="int64").tobytes()
+    ).hexdigest()[:16]
+
+
+# WAVE is the [ncell,2*NORIENT*ncell] wavelet operator with the real and the
+# imaginary parts side by side
+WAVE_CACHE_NAMES = [
+    "WAVE_INDPTR",
+    "WAVE_INDICES",
+    "WAVE_DATA",
+    "SMOO_INDPTR",
+    "SMOO_INDICES",
+    "SMOO_DATA",
+]
+
+
+# ---------------------------------------------−---------
+# CSR storage (indptr,indices) of the operator whose non zero values are at
+# the [row,column] of indice, order gives the position of the values.
+def csr_index(indice, nrow, ncol):
+    if max(ncol, indice.shape[0]) < 2**31:
+        itype = "int32"
+    else:
+        itype = "int64"
+    order = np.lexsort((indice[:, 1], indice[:, 0]))
+    indptr = np.zeros([nrow + 1], dtype=itype)
+    np.cumsum(np.bincount(indice[:, 0], minlength=nrow), out=indptr[1:])
+    return order, indptr, indice[order, 1].astype(itype)
+
+
+# ---------------------------------------------−---------
+# CSR operator [nrow,ncol+ncol2] holding the columns of the CSR operator
+# (indptr,indices,data) [nrow,ncol] followed by those of (indptr2,indices2,data2)
+def fused_csr(indptr, indices, data, indptr2, indices2, data2, ncol, ncol2):
+    nrow = indptr.shape[0] - 1
+    row = np.concatenate(
+        [
+            np.repeat(np.arange(nrow), np.diff(indptr)),
+            np.repeat(np.arange(nrow), np.diff(indptr2)),
+        ]
+    )
+    order = np.argsort(row, kind="stable")
+    if max(ncol + ncol2, order.shape[0]) < 2**31:
+        itype = "int32"
+    else:
+        itype = "int64"
+    return (
+        (indptr.astype(itype) + indptr2).astype(itype),
+        np.concatenate([indices, indices2.astype(itype) + ncol]).astype(itype)[order],
+        np.concatenate([data, data2])[order],
+    )
+
+
+# ---------------------------------------------−---------
+# Fixed width neighbour table of the CSR operator [ncell,nout*ncell] whose
+# column p+o*ncell is the output o of the pixel p. idx [ncell,K] gives the input
+# pixels of each output pixel and w [ncell,K,nout] their weights, the padding
+# entries point to the pixel itself with a zero weight.
+def stencil_table(indptr, indices, data, ncell, nout):
+    k = np.repeat(np.arange(ncell), np.diff(indptr))
+    p = indices % ncell
+    o = indices // ncell
+
+    # neighbours of each pixel for all the outputs
+    pair, inv = np.unique(p.astype("int64") * ncell + k, return_inverse=True)
+    pix = pair // ncell
+    count = np.bincount(pix, minlength=ncell)
+    start = np.cumsum(count) - count
+    slot = np.arange(pair.shape[0]) - start[pix]
+
+    idx = np.repeat(np.arange(ncell).reshape(ncell, 1), max(count.max(), 1), 1)
+    idx[pix, slot] = pair % ncell
+    w = np.zeros([ncell, idx.shape[1], nout], dtype=data.dtype)
+    w[p, slot[inv], o] = data
+    return idx, w
+
+
+# ---------------------------------------------−---------
+# nested cells of nside covering the pixel ichunk of nside_chunk and halo rings
+# of pixels of nside_halo around it, core is True for the cells of the chunk.
+def chunk_cell_ids(nside, nside_chunk, ichunk, nside_halo, halo):
+    g = (nside_halo // nside_chunk) ** 2
+    pix = np.arange(ichunk * g, (ichunk + 1) * g)
+    for k in range(halo):
+        neighbours = hp.get_all_neighbours(nside_halo, pix, nest=True).ravel()
+        pix = np.union1d(pix, neighbours[neighbours >= 0])
+
+    h = (nside // nside_halo) ** 2
+    cells = (pix.reshape(-1, 1) * h + np.arange(h).reshape(1, -1)).ravel()
+    core = cells // (nside // nside_chunk) ** 2 == ichunk
+    return cells, core
+
+
+# ---------------------------------------------−---------
+# (nside_chunk,Jmax) of a chunked evaluation of a map of nside with halo rings
+# of pixels of the coarsest scale, the missing one is the largest such that
+# the cells of a chunk and its halo are at most max_overhead times its own.
+# Without both, the chunks are the pixels of nside_chunk=2.
+def stream_chunk_param(nside, halo, nside_chunk=None, Jmax=None, max_overhead=4.0):
+    # smallest width of a chunk in pixels of the coarsest scale
+    width = 2 * halo / (np.sqrt(max_overhead) - 1)
+    if Jmax is None:
+        l_nside_chunk = 2 if nside_chunk is None else nside_chunk
+        Jmax = int(np.floor(np.log2(nside / (width * l_nside_chunk)))) + 1
+        Jmax = min(Jmax, int(np.log2(nside)))
+        if Jmax < 1:
+            raise ValueError(
+                "nside=%d is too small for chunks of nside %d with a halo of %d "
+                "pixels, use eval or a larger max_overhead"
+                % (nside, l_nside_chunk, halo)
+            )
+    if nside_chunk is None:
+        nside_chunk = max(nside / (width * 2 ** (Jmax - 1)), 1)
+        nside_chunk = 2 ** int(np.floor(np.log2(nside_chunk)))
+
+    if nside_chunk * 2 ** (Jmax - 1) > nside:
+        raise ValueError(
+            "Jmax=%d needs chunks of nside %d or less"
+            % (Jmax, nside // 2 ** (Jmax - 1))
+        )
+    overhead = (1 + 2 * halo * 2 ** (Jmax - 1) * nside_chunk / nside) ** 2
+    if overhead > max_overhead:
+        raise ValueError(
+            "a chunk and its halo are %.1f times the chunk (max_overhead=%.1f), "
+            "use a smaller nside_chunk or Jmax" % (overhead, max_overhead)
+        )
+    return nside_chunk, Jmax
+
+
+# ---------------------------------------------−---------
+# cache entries of the healpix wavelet (indice,wav) and smoothing (indice2,wwav)
+# operators of nside, for the map of cell_ids if given
+def wave_cache_arrays(nside, norient, indice, wav, indice2, wwav, cell_ids=None):
+    if cell_ids is None:
+        ncell = 12 * nside * nside
+        cells = None
+    else:
+        ncell = cell_ids.shape[0]
+        cells = cell_ids_hash(cell_ids)
+    ncol = norient * ncell
+    order, indptr, indices = csr_index(
+        np.concatenate([indice, indice + np.array([[0, ncol]])], 0), ncell, 2 * ncol
+    )
+    order2, indptr2, indices2 = csr_index(indice2, ncell, ncell)
+    values = [
+        indptr,
+        indices,
+        np.concatenate([wav.real, wav.imag], 0)[order],
+        indptr2,
+        indices2,
+        wwav[order2],
+    ]
+    return {cache_key(nside, k, cells): v for k, v in zip(WAVE_CACHE_NAMES, values)}
+
+
+# ---------------------------------------------−---------
+# task of FoCUS.precompute run by the process pool: compute the pixels
+# [pix_min,pix_max[ of nside and write them in the chunk files of the cache,
+# they are gathered in the operator cache by rank 0.
+def _precompute_wave_index(path, kernelsz, norient, nside, pix_min, pix_max, chunk):
+    res = calc_wave_index(nside, kernelsz, norient, pix_min=pix_min, pix_max=pix_max)
+    for name, val in zip(["PIDX", "WAVE", "PIDX2", "SMOO"], res):
+        name = "%s_C%04d" % (name, chunk)
+        np.save(wave_index_file(path, kernelsz, norient, nside, name), val)
+    return nside, chunk
+
+
+class MaskPyramid:
+    """
+    Masks of all the scales of eval, built once by FoCUS.prepare_mask and
+    given to eval as mask so that the loops calling eval many times on the
+    same mask (e.g. the losses of a synthesis) do no mask work at all.
+    """
+
+    def __init__(self, masks, mask0, shape, Jmax, cell_ids=None, edge=True):
+        self.masks = masks  # [Nmask, Npix_j] or [Nmask, X_j, Y_j] per scale
+        self.mask0 = mask0  # mask of S0, the edges are not trimmed
+        self.shape = shape  # shape of the mask given to prepare_mask
+        self.Jmax = Jmax
+        self.cell_ids = cell_ids
+        self.edge = edge  # edges of 2D images and 1D signals trimmed
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __getitem__(self, j):
+        return self.masks[j]
+
+
 class FoCUS:
     def __init__(
         self,
@@ -33,6 +459,9 @@ class FoCUS:
         silent=True,
         mpi_size=1,
         mpi_rank=0,
+        lazy=False,
+        engine="sparse",
+        conv_type=None,
     ):
 
         self.__version__ = "2025.05.2"
@@ -44,7 +473,26 @@ class FoCUS:
         self.mask_thres = mask_thres
         self.mask_norm = mask_norm
         self.InitWave = InitWave
+        self.lazy = lazy
+        if engine not in ["sparse", "stencil"]:
+            raise ValueError(
+                "engine should be 'sparse' or 'stencil', not '%s'" % (engine)
+            )
+        self.engine = engine
+        # the sparse products have no half precision kernels on CPU
+        if conv_type is not None and engine != "stencil":
+            raise ValueError("conv_type=%s needs engine='stencil'" % (conv_type))
+        self.conv_type = conv_type
         self.mask_mask = None
+        # lazily built state (operators, caches, mask pyramids and graphs)
+        # shared by the threads of Synthesis.run(nthread=...)
+        self.lock = threading.RLock()
+        # last healpix mask pyramids of eval, by content hash, and the last
+        # one with its mask object
+        self.mask_pyramids = {}
+        self.last_mask_pyramid = None
+        # graphs of eval_compiled, by signature
+        self.compiled_evals = {}
         self.mpi_size = mpi_size
         self.mpi_rank = mpi_rank
         self.return_data = return_data
@@ -115,6 +563,7 @@ class FoCUS:
                 mpi_rank=mpi_rank,
                 gpupos=gpupos,
                 silent=self.silent,
+                conv_type=conv_type,
             )
         elif BACKEND == "tensorflow":
             from foscat.BkTensorflow import BkTensorflow
@@ -124,6 +573,7 @@ class FoCUS:
                 mpi_rank=mpi_rank,
                 gpupos=gpupos,
                 silent=self.silent,
+                conv_type=conv_type,
             )
         else:
             from foscat.BkNumpy import BkNumpy
@@ -133,6 +583,7 @@ class FoCUS:
                 mpi_rank=mpi_rank,
                 gpupos=gpupos,
                 silent=self.silent,
+                conv_type=conv_type,
             )
 
         self.all_bk_type = self.backend.all_bk_type
@@ -170,11 +621,21 @@ class FoCUS:
 
         self.ww_Real = {}
         self.ww_Imag = {}
+        self.ww_RealImag = {}
+        self.ww_Stencil = {}
+        self.w_smooth_Stencil = {}
         self.ww_CNN_Transpose = {}
         self.ww_CNN = {}
         self.X_CNN = {}
         self.Y_CNN = {}
         self.Z_CNN = {}
+        self.operator_caches = {}
+        self.wave_cell_ids = {}
+        # write the operators of partial sky maps in their own store of the
+        # operator cache, whose least recently used ones are removed above
+        # cell_cache_size bytes
+        self.cache_cell_operators = True
+        self.cell_cache_size = 2**30
 
         self.filters_set = {}
         self.edge_masks = {}
@@ -285,20 +746,14 @@ class FoCUS:
                 lout = 2**i
                 self.ww_Real[lout] = None
 
-            for i in range(1, 6):
-                lout = 2**i
-                if not self.silent:
-                    print("Init Wave ", lout)
-
-                if self.InitWave is None:
-                    wr, wi, ws, widx = self.init_index(lout)
-                else:
-                    wr, wi, ws, widx = self.InitWave(self, lout)
-
-                self.Idx_Neighbours[lout] = 1  # self.backend.bk_constant(widx)
-                self.ww_Real[lout] = wr
-                self.ww_Imag[lout] = wi
-                self.w_smooth[lout] = ws
+            # in lazy mode the operators are built or loaded by convol/smooth
+            # only for the nside they are called with
+            if not self.lazy:
+                for i in range(1, 6):
+                    lout = 2**i
+                    if not self.silent:
+                        print("Init Wave ", lout)
+                    self.init_wave(lout)
         elif self.use_1D:
             self.w_smooth = slope * (w_smooth / w_smooth.sum()).astype(self.all_type)
             self.ww_RealT = {}
@@ -540,72 +995,42 @@ class FoCUS:
 
     def init_CNN_index(self, nside, transpose=False):
         l_kernel = int(self.KERNELSZ * self.KERNELSZ)
-        try:
-            indices = np.load(
-                "%s/FOSCAT_%s_I%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside)
-            )
-            weights = np.load(
-                "%s/FOSCAT_%s_W%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside)
-            )
-            xc = np.load(
-                "%s/FOSCAT_%s_X%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside)
-            )
-            yc = np.load(
-                "%s/FOSCAT_%s_Y%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside)
-            )
-            zc = np.load(
-                "%s/FOSCAT_%s_Z%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside)
-            )
-        except:
-            indices, weights, xc, yc, zc = self.calc_indices_convol(nside, l_kernel)
-            np.save(
-                "%s/FOSCAT_%s_I%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside),
-                indices,
-            )
-            np.save(
-                "%s/FOSCAT_%s_W%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside),
-                weights,
-            )
-            np.save(
-                "%s/FOSCAT_%s_X%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside),
-                xc,
-            )
-            np.save(
-                "%s/FOSCAT_%s_Y%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside),
-                yc,
-            )
-            np.save(
-                "%s/FOSCAT_%s_Z%d_%d_%d_CNNV3.npy"
-                % (self.TEMPLATE_PATH, TMPFILE_VERSION, l_kernel, self.NORIENT, nside),
-                zc,
-            )
-            if not self.silent:
-                print(
-                    "Write %s/FOSCAT_%s_W%d_%d_%d_CNNV2.npy"
-                    % (
-                        self.TEMPLATE_PATH,
-                        TMPFILE_VERSION,
-                        l_kernel,
-                        self.NORIENT,
-                        nside,
-                    )
+        names = ["CNN_I", "CNN_W", "CNN_X", "CNN_Y", "CNN_Z"]
+        cache = self.get_operator_cache()
+
+        def compute():
+            files = [
+                "%s/FOSCAT_%s_%s%d_%d_%d_CNNV3.npy"
+                % (
+                    self.TEMPLATE_PATH,
+                    TMPFILE_VERSION,
+                    name[-1],
+                    l_kernel,
+                    self.NORIENT,
+                    nside,
                 )
+                for name in names
+            ]
+            # operators of the former one file per array cache
+            if all([os.path.exists(f) for f in files]):
+                res = [np.load(f) for f in files]
+            else:
+                res = self.calc_indices_convol(nside, l_kernel)
+            if not self.silent:
+                print("Write CNN nside=%d in %s" % (nside, cache.path))
+            return {cache_key(nside, k): v for k, v in zip(names, res)}
 
-        self.X_CNN[nside] = xc
-        self.Y_CNN[nside] = yc
-        self.Z_CNN[nside] = zc
-        self.ww_CNN[nside] = self.backend.bk_SparseTensor(
-            indices, weights, [12 * nside * nside * l_kernel, 12 * nside * nside]
-        )
+        with self.lock:
+            indices, weights, xc, yc, zc = self.get_cached_operators(
+                cache, [cache_key(nside, k) for k in names], compute
+            )
+
+            self.X_CNN[nside] = xc
+            self.Y_CNN[nside] = yc
+            self.Z_CNN[nside] = zc
+            self.ww_CNN[nside] = self.backend.bk_SparseTensor(
+                indices, weights, [12 * nside * nside * l_kernel, 12 * nside * nside]
+            )
 
     # ---------------------------------------------−---------
     def healpix_layer_coord(self, im, axis=0):
@@ -822,7 +1247,7 @@ class FoCUS:
                 return sim, new_cell_ids
 
             lout = int(np.sqrt(shape[axis] // 12))
-            if im.__class__ == np.zeros([0]).__class__:
+            if isinstance(im, np.ndarray):
                 oshape = np.zeros([len(shape) + 1], dtype="int")
                 if axis > 0:
                     oshape[0:axis] = shape[0:axis]
@@ -1345,330 +1770,346 @@ class FoCUS:
         return res
 
     # ---------------------------------------------−---------
-    def init_index(self, nside, kernel=-1, cell_ids=None):
-
-        if kernel == -1:
-            l_kernel = self.KERNELSZ
-        else:
-            l_kernel = kernel
-
-        if cell_ids is not None:
-            ncell = cell_ids.shape[0]
-        else:
-            ncell = 12 * nside * nside
+    def calc_wave_index(
+        self, nside, l_kernel, pix_min=0, pix_max=None, block_size=4096, cell_ids=None
+    ):
+        return calc_wave_index(
+            nside,
+            l_kernel,
+            self.NORIENT,
+            pix_min=pix_min,
+            pix_max=pix_max,
+            block_size=block_size,
+            silent=self.silent,
+            cell_ids=cell_ids,
+        )
 
-        try:
-            if self.use_2D:
-                tmp = np.load(
-                    "%s/W%d_%s_%d_IDX.npy"
-                    % (self.TEMPLATE_PATH, l_kernel**2, TMPFILE_VERSION, nside)
-                )
-            else:
-                if cell_ids is not None:
-                    tmp = np.load(
-                        "%s/XXXX_%s_W%d_%d_%d_PIDX.npy"  # can not work
-                        % (
-                            self.TEMPLATE_PATH,
-                            TMPFILE_VERSION,
-                            l_kernel**2,
-                            self.NORIENT,
-                            nside,  # if cell_ids computes the index
-                        )
-                    )
+    # ---------------------------------------------−---------
+    def precompute(self, nside_list, workers=None, nchunk=1):
+        """
+        Compute the healpix wavelet and smoothing operators (ww_Real, ww_Imag and
+        w_smooth) for several nside on a pool of processes. Each process writes its
+        result in TEMPLATE_PATH, the operators are then gathered in the operator
+        cache and loaded as by init_index.
+
+        Parameters
+        ----------
+        nside_list: int or list of int
+            The nside for which the operators are computed.
+        workers: int, optional
+            Number of processes, default is the number of cores of the node.
+        nchunk: int, default 1
+            Number of pixel chunks computed in parallel for each nside, use it to
+            spread a large nside over the pool.
+        """
+        if self.use_2D or self.use_1D:
+            print("precompute is only available for Healpix data")
+            return None
 
-                else:
-                    tmp = np.load(
-                        "%s/FOSCAT_%s_W%d_%d_%d_PIDX.npy"
-                        % (
-                            self.TEMPLATE_PATH,
-                            TMPFILE_VERSION,
-                            l_kernel**2,
-                            self.NORIENT,
-                            nside,  # if cell_ids computes the index
+        if not isinstance(nside_list, (list, tuple, np.ndarray)):
+            nside_list = [nside_list]
+
+        names = ["PIDX", "WAVE", "PIDX2", "SMOO"]
+        cache = self.get_operator_cache()
+
+        # the other processes sharing TEMPLATE_PATH wait for the end of the
+        # computation instead of computing the same operators
+        if self.rank == 0:
+            with cache.lock():
+                tasks = []
+                chunked = []
+                for nside in nside_list:
+                    if all([cache_key(nside, k) in cache for k in WAVE_CACHE_NAMES]):
+                        continue
+
+                    npix = 12 * nside * nside
+                    l_nchunk = min(nchunk, npix)
+                    chunked.append((nside, l_nchunk))
+                    for k in range(l_nchunk):
+                        tasks.append(
+                            (
+                                self.TEMPLATE_PATH,
+                                self.KERNELSZ,
+                                self.NORIENT,
+                                nside,
+                                k * npix // l_nchunk,
+                                (k + 1) * npix // l_nchunk,
+                                k,
+                            )
                         )
-                    )
-        except:
-            if not self.use_2D:
 
-                if l_kernel == 5:
-                    pw = 0.5
-                    pw2 = 0.5
-                    threshold = 2e-4
-
-                elif l_kernel == 3:
-                    pw = 1.0 / np.sqrt(2)
-                    pw2 = 1.0
-                    threshold = 1e-3
+                if len(tasks) > 0:
+                    # spawn does not copy the GPU/threads state of the backend
+                    with ProcessPoolExecutor(
+                        max_workers=workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    ) as pool:
+                        futures = [
+                            pool.submit(_precompute_wave_index, *t) for t in tasks
+                        ]
+                        for f in as_completed(futures):
+                            nside, chunk = f.result()
+                            if not self.silent:
+                                print("Pre-computed nside=%d chunk=%s" % (nside, chunk))
+
+                # gather the pixel chunks of each nside in the operator cache
+                for nside, l_nchunk in chunked:
+                    res = []
+                    for name in names:
+                        files = [
+                            wave_index_file(
+                                self.TEMPLATE_PATH,
+                                self.KERNELSZ,
+                                self.NORIENT,
+                                nside,
+                                "%s_C%04d" % (name, k),
+                            )
+                            for k in range(l_nchunk)
+                        ]
+                        res.append(np.concatenate([np.load(f) for f in files], 0))
+                        for f in files:
+                            os.remove(f)
+                    cache.update(wave_cache_arrays(nside, self.NORIENT, *res))
 
-                elif l_kernel == 7:
-                    pw = 0.5
-                    pw2 = 0.25
-                    threshold = 4e-5
+        self.barrier()
 
-                if cell_ids is not None:
-                    if not isinstance(cell_ids, np.ndarray):
-                        cell_ids = self.backend.to_numpy(cell_ids)
-                    th, ph = hp.pix2ang(nside, cell_ids, nest=True)
-                    x, y, z = hp.pix2vec(nside, cell_ids, nest=True)
+        for nside in nside_list:
+            self.Idx_Neighbours[nside] = None
+            self.init_wave(nside)
 
-                    t, p = hp.pix2ang(nside, cell_ids, nest=True)
-                    phi = [p[k] / np.pi * 180 for k in range(ncell)]
-                    thi = [t[k] / np.pi * 180 for k in range(ncell)]
+    # ---------------------------------------------−---------
+    # True if the healpix operators of nside are built for these cell_ids
+    def has_wave(self, nside, cell_ids=None):
+        if self.Idx_Neighbours.get(nside) is None:
+            return False
+        l_cell_ids = self.wave_cell_ids.get(nside)
+        return l_cell_ids is cell_ids or (
+            l_cell_ids is not None
+            and cell_ids is not None
+            and np.array_equal(l_cell_ids, cell_ids)
+        )
 
-                    indice2 = np.zeros([ncell * 64, 2], dtype="int")
-                    indice = np.zeros([ncell * 64 * self.NORIENT, 2], dtype="int")
-                    wav = np.zeros([ncell * 64 * self.NORIENT], dtype="complex")
-                    wwav = np.zeros([ncell * 64 * self.NORIENT], dtype="float")
+    # ---------------------------------------------−---------
+    # build or load the healpix operators of nside if not yet done for these
+    # cell_ids. The threads sharing the operator build them one at a time,
+    # Idx_Neighbours is set last so that has_wave sees complete operators.
+    def init_wave(self, nside, cell_ids=None):
+        if cell_ids is not None and not isinstance(cell_ids, np.ndarray):
+            cell_ids = self.backend.to_numpy(cell_ids)
 
-                else:
+        if self.has_wave(nside, cell_ids):
+            return
 
-                    th, ph = hp.pix2ang(nside, np.arange(12 * nside**2), nest=True)
-                    x, y, z = hp.pix2vec(nside, np.arange(12 * nside**2), nest=True)
+        with self.lock:
+            if not self.has_wave(nside, cell_ids):
+                self.build_wave(nside, cell_ids)
 
-                    t, p = hp.pix2ang(nside, np.arange(12 * nside * nside), nest=True)
-                    phi = [p[k] / np.pi * 180 for k in range(12 * nside * nside)]
-                    thi = [t[k] / np.pi * 180 for k in range(12 * nside * nside)]
+    # ---------------------------------------------−---------
+    def build_wave(self, nside, cell_ids):
+        wri = None
+        wst = None
+        wst2 = None
+        if self.InitWave is None and self.engine == "stencil":
+            wst, wi, wst2, widx = self.load_wave_operators(
+                nside, self.KERNELSZ, cell_ids=cell_ids, stencil=True
+            )
+            wr = None
+            ws = None
+        elif self.InitWave is None:
+            # ww_Real and ww_Imag are only built if get_ww asks for them
+            wri, wi, ws, widx = self.load_wave_operators(
+                nside, self.KERNELSZ, cell_ids=cell_ids, stacked=True
+            )
+            wr = None
+        elif cell_ids is None:
+            # the full sky InitWave(self, nside) of the previous versions
+            wr, wi, ws, widx = self.InitWave(self, nside)
+        else:
+            wr, wi, ws, widx = self.InitWave(self, nside, cell_ids=cell_ids)
+
+        self.Idx_Neighbours[nside] = None
+        self.wave_cell_ids[nside] = cell_ids
+        self.ww_Stencil[nside] = wst
+        self.w_smooth_Stencil[nside] = wst2
+        self.ww_RealImag[nside] = wri
+        self.ww_Real[nside] = wr
+        self.ww_Imag[nside] = wi
+        self.w_smooth[nside] = ws
+        self.Idx_Neighbours[nside] = 1  # self.backend.bk_constant(widx)
 
-                    indice2 = np.zeros([12 * nside * nside * 64, 2], dtype="int")
-                    indice = np.zeros(
-                        [12 * nside * nside * 64 * self.NORIENT, 2], dtype="int"
-                    )
-                    wav = np.zeros(
-                        [12 * nside * nside * 64 * self.NORIENT], dtype="complex"
-                    )
-                    wwav = np.zeros(
-                        [12 * nside * nside * 64 * self.NORIENT], dtype="float"
+    # ---------------------------------------------−---------
+    # operator cache of TEMPLATE_PATH for the kernel size kernelsz, with cells
+    # the bounded store of the partial sky operators
+    def get_operator_cache(self, kernelsz=None, cells=False):
+        if kernelsz is None:
+            kernelsz = self.KERNELSZ
+        with self.lock:
+            if (kernelsz, cells) not in self.operator_caches:
+                path = operator_cache_file(self.TEMPLATE_PATH, kernelsz, self.NORIENT)
+                if cells:
+                    self.operator_caches[kernelsz, cells] = OperatorCache(
+                        path + "/cells", TMPFILE_VERSION, max_size=self.cell_cache_size
                     )
-                iv = 0
-                iv2 = 0
-
-                for iii in range(ncell):
-                    if cell_ids is None:
-                        if iii % (nside * nside) == nside * nside - 1:
-                            if not self.silent:
-                                print(
-                                    "Pre-compute nside=%6d %.2f%%"
-                                    % (nside, 100 * iii / (12 * nside * nside))
-                                )
-
-                    if cell_ids is not None:
-                        hidx = np.where(
-                            (x - x[iii]) ** 2 + (y - y[iii]) ** 2 + (z - z[iii]) ** 2
-                            < (2 * np.pi / nside) ** 2
-                        )[0]
-                    else:
-                        hidx = hp.query_disc(
-                            nside,
-                            [x[iii], y[iii], z[iii]],
-                            2 * np.pi / nside,
-                            nest=True,
-                        )
-
-                    R = hp.Rotator(rot=[phi[iii], -thi[iii]], eulertype="ZYZ")
-
-                    t2, p2 = R(th[hidx], ph[hidx])
-
-                    vec2 = hp.ang2vec(t2, p2)
-
-                    x2 = vec2[:, 0]
-                    y2 = vec2[:, 1]
-                    z2 = vec2[:, 2]
-
-                    ww = np.exp(
-                        -pw2
-                        * ((nside) ** 2)
-                        * ((x2) ** 2 + (y2) ** 2 + (z2 - 1.0) ** 2)
+                else:
+                    self.operator_caches[kernelsz, cells] = OperatorCache(
+                        path, TMPFILE_VERSION
                     )
-                    idx = np.where((ww**2) > threshold)[0]
-                    nval2 = len(idx)
-                    indice2[iv2 : iv2 + nval2, 1] = iii
-                    indice2[iv2 : iv2 + nval2, 0] = hidx[idx]
-                    wwav[iv2 : iv2 + nval2] = ww[idx] / np.sum(ww[idx])
-                    iv2 += nval2
-
-                    for l_rotation in range(self.NORIENT):
-
-                        angle = (
-                            l_rotation / 4.0 * np.pi
-                            - phi[iii] / 180.0 * np.pi * (z[hidx] > 0)
-                            - (180.0 - phi[iii]) / 180.0 * np.pi * (z[hidx] < 0)
-                        )
-
-                        # posi=2*(0.5-(z[hidx]<0))
-
-                        axes = y2 * np.cos(angle) - x2 * np.sin(angle)
-                        wresr = ww * np.cos(pw * axes * (nside) * np.pi)
-                        wresi = ww * np.sin(pw * axes * (nside) * np.pi)
+        return self.operator_caches[kernelsz, cells]
 
-                        vnorm = wresr * wresr + wresi * wresi
-                        idx = np.where(vnorm > threshold)[0]
-
-                        nval = len(idx)
-                        indice[iv : iv + nval, 1] = iii + l_rotation * ncell
-                        indice[iv : iv + nval, 0] = hidx[idx]
-                        # print([hidx[k] for k in idx])
-                        # print(hp.query_disc(nside, [x[iii],y[iii],z[iii]], np.pi/nside,nest=True))
-                        normr = np.mean(wresr[idx])
-                        normi = np.mean(wresi[idx])
-
-                        val = wresr[idx] - normr + 1j * (wresi[idx] - normi)
-                        r = abs(val).sum()
-
-                        if r > 0:
-                            val = val / r
+    # ---------------------------------------------−---------
+    # arrays keys of the operator cache, written with the dictionary returned by
+    # compute() if some are missing. The first process computes them while the
+    # others wait on the cache lock and then read them.
+    def get_cached_operators(self, cache, keys, compute):
+        if not all([k in cache for k in keys]):
+            with cache.lock():
+                if not all([k in cache for k in keys]):
+                    cache.update(compute())
+        return [cache.get(k) for k in keys]
 
-                        wav[iv : iv + nval] = val
-                        iv += nval
+    # ---------------------------------------------−---------
+    # healpix operators of nside, memory mapped from the operator cache where they
+    # are first written if needed. For a partial sky map the operators are
+    # cached for the hash of its cell_ids in the store of the cell sets. If stacked, wr is the operator
+    # [ncell,2*NORIENT*ncell] giving the real and imaginary parts of the
+    # convolution in one product and wi is None. If stencil, wr and ws are the
+    # (idx,w) neighbour tables of this operator and of the smoothing, that share
+    # the same idx.
+    def load_wave_operators(
+        self, nside, l_kernel, cell_ids=None, stacked=False, stencil=False
+    ):
+        cache = self.get_operator_cache(l_kernel, cells=cell_ids is not None)
+        if cell_ids is not None:
+            ncell = cell_ids.shape[0]
+            cells = cell_ids_hash(cell_ids)
+        else:
+            ncell = 12 * nside * nside
+            cells = None
 
-                indice = indice[:iv, :]
-                wav = wav[:iv]
-                indice2 = indice2[:iv2, :]
-                wwav = wwav[:iv2]
+        def compute():
+            if cell_ids is not None:
+                res = self.calc_wave_index(nside, l_kernel, cell_ids=cell_ids)
+                if not self.silent and self.cache_cell_operators:
+                    print("Write nside=%d cells=%s in %s" % (nside, cells, cache.path))
+                return wave_cache_arrays(nside, self.NORIENT, *res, cell_ids=cell_ids)
+
+            files = [
+                wave_index_file(self.TEMPLATE_PATH, l_kernel, self.NORIENT, nside, name)
+                for name in ["PIDX", "WAVE", "PIDX2", "SMOO"]
+            ]
+            # operators of the former one file per array cache
+            if all([os.path.exists(f) for f in files]):
+                res = [np.load(f) for f in files]
+            else:
+                res = self.calc_wave_index(nside, l_kernel)
                 if not self.silent:
-                    print("Kernel Size ", iv / (self.NORIENT * 12 * nside * nside))
-                """
-                # OLD VERSION OLD VERSION OLD VERSION (3.0)
-                if self.KERNELSZ*self.KERNELSZ>12*nside*nside:
-                    l_kernel=3
-
-                aa=np.cos(np.arange(self.NORIENT)/self.NORIENT*np.pi).reshape(1,self.NORIENT)
-                bb=np.sin(np.arange(self.NORIENT)/self.NORIENT*np.pi).reshape(1,self.NORIENT)
-                x,y,z=hp.pix2vec(nside,np.arange(12*nside*nside),nest=True)
-                to,po=hp.pix2ang(nside,np.arange(12*nside*nside),nest=True)
-
-                wav=np.zeros([12*nside*nside,l_kernel**2,self.NORIENT],dtype='complex')
-                wwav=np.zeros([12*nside*nside,l_kernel**2])
-                iwav=np.zeros([12*nside*nside,l_kernel**2],dtype='int')
-
-                scale=4
-                if nside>scale*2:
-                    th,ph=hp.pix2ang(nside//scale,np.arange(12*(nside//scale)**2),nest=True)
-                else:
-                    lidx=np.arange(12*nside*nside)
+                    print("Kernel Size ", res[0].shape[0] / (self.NORIENT * ncell))
+            if not self.silent:
+                print("Write nside=%d in %s" % (nside, cache.path))
+            return wave_cache_arrays(nside, self.NORIENT, *res)
+
+        keys = [cache_key(nside, k, cells) for k in WAVE_CACHE_NAMES]
+        if cell_ids is not None and not self.cache_cell_operators:
+            # operators used once (see eval_stream), not worth writing
+            res = compute()
+            val = [res[k] for k in keys]
+        else:
+            val = self.get_cached_operators(cache, keys, compute)
+        val = dict(zip(WAVE_CACHE_NAMES, val))
+
+        self.barrier()
+
+        ncol = self.NORIENT * ncell
+        if stencil:
+            # one neighbour table for the wavelet and the smoothing kernels
+            ws = val["SMOO_DATA"]
+            if self.slope != 1.0:
+                ws = self.slope * ws
+            idx, w = stencil_table(
+                *fused_csr(
+                    val["WAVE_INDPTR"],
+                    val["WAVE_INDICES"],
+                    val["WAVE_DATA"],
+                    val["SMOO_INDPTR"],
+                    val["SMOO_INDICES"],
+                    ws,
+                    2 * ncol,
+                    ncell,
+                ),
+                ncell,
+                2 * self.NORIENT + 1,
+            )
+            idx = self.backend.bk_index(idx)
+            w2 = self.backend.bk_cast(np.ascontiguousarray(w[:, :, -1]))
+            w = self.backend.bk_cast(np.ascontiguousarray(w[:, :, :-1]))
+            return (
+                (idx, self.backend.bk_cast_conv(w)),
+                None,
+                (idx, self.backend.bk_cast_conv(w2)),
+                (val["WAVE_INDPTR"], val["WAVE_INDICES"]),
+            )
+        if stacked:
+            wr = self.backend.bk_SparseTensorCSR(
+                val["WAVE_INDPTR"],
+                val["WAVE_INDICES"],
+                self.backend.bk_cast(val["WAVE_DATA"]),
+                dense_shape=[ncell, 2 * ncol],
+            )
+            wi = None
+        else:
+            # each row holds its real values then its imaginary values
+            real = val["WAVE_INDICES"] < ncol
+            wr = self.backend.bk_SparseTensorCSR(
+                val["WAVE_INDPTR"] // 2,
+                val["WAVE_INDICES"][real],
+                self.backend.bk_cast(val["WAVE_DATA"][real]),
+                dense_shape=[ncell, ncol],
+            )
+            wi = self.backend.bk_SparseTensorCSR(
+                val["WAVE_INDPTR"] // 2,
+                val["WAVE_INDICES"][~real] - ncol,
+                self.backend.bk_cast(val["WAVE_DATA"][~real]),
+                dense_shape=[ncell, ncol],
+            )
+        ws = val["SMOO_DATA"]
+        if self.slope != 1.0:
+            ws = self.slope * ws
+        ws = self.backend.bk_SparseTensorCSR(
+            val["SMOO_INDPTR"],
+            val["SMOO_INDICES"],
+            self.backend.bk_cast(ws),
+            dense_shape=[ncell, ncell],
+        )
 
-                pw=np.pi/4.0
-                pw2=1/2
-                amp=1.0
+        return wr, wi, ws, (val["WAVE_INDPTR"], val["WAVE_INDICES"])
 
-                if l_kernel==5:
-                    pw=np.pi/4.0
-                    pw2=1/2.25
-                    amp=1.0/9.2038
+    # ---------------------------------------------−---------
+    def init_index(self, nside, kernel=-1, cell_ids=None):
 
-                elif l_kernel==3:
-                    pw=1.0/np.sqrt(2)
-                    pw2=1.0
-                    amp=1/8.45
+        if kernel == -1:
+            l_kernel = self.KERNELSZ
+        else:
+            l_kernel = kernel
 
-                elif l_kernel==7:
-                    pw=np.pi/4.0
-                    pw2=1.0/3.0
+        if not self.use_2D:
+            wr, wi, ws, tmp = self.load_wave_operators(
+                nside, l_kernel, cell_ids=cell_ids
+            )
+            if kernel == -1:
+                self.Idx_Neighbours[nside] = tmp
+            return wr, wi, ws, tmp
 
-                for k in range(12*nside*nside):
-                    if k%(nside*nside)==0:
-                        if not self.silent:
-                            print('Pre-compute nside=%6d %.2f%%'%(nside,100*k/(12*nside*nside)))
-                    if nside>scale*2:
-                        lidx=hp.get_all_neighbours(nside//scale,th[k//(scale*scale)],ph[k//(scale*scale)],nest=True)
-                        lidx=np.concatenate([lidx,np.array([(k//(scale*scale))])],0)
-                        lidx=np.repeat(lidx*(scale*scale),(scale*scale))+ \
-                              np.tile(np.arange((scale*scale)),lidx.shape[0])
-
-                    delta=(x[lidx]-x[k])**2+(y[lidx]-y[k])**2+(z[lidx]-z[k])**2
-                    pidx=np.where(delta<(10)/(nside**2))[0]
-                    if len(pidx)<l_kernel**2:
-                        pidx=np.arange(delta.shape[0])
-
-                    w=np.exp(-pw2*delta[pidx]*(nside**2))
-                    pidx=pidx[np.argsort(-w)[0:l_kernel**2]]
-                    pidx=pidx[np.argsort(lidx[pidx])]
-
-                    w=np.exp(-pw2*delta[pidx]*(nside**2))
-                    iwav[k]=lidx[pidx]
-                    wwav[k]=w
-                    rot=[po[k]/np.pi*180.0,90+(-to[k])/np.pi*180.0]
-                    r=hp.Rotator(rot=rot)
-                    ty,tx=r(to[iwav[k]],po[iwav[k]])
-                    ty=ty-np.pi/2
-
-                    xx=np.expand_dims(pw*nside*np.pi*tx/np.cos(ty),-1)
-                    yy=np.expand_dims(pw*nside*np.pi*ty,-1)
-
-                    wav[k,:,:]=(np.cos(xx*aa+yy*bb)+complex(0.0,1.0)*np.sin(xx*aa+yy*bb))*np.expand_dims(w,-1)
-
-                wav=wav-np.expand_dims(np.mean(wav,1),1)
-                wav=amp*wav/np.expand_dims(np.std(wav,1),1)
-                wwav=wwav/np.expand_dims(np.sum(wwav,1),1)
-
-                nk=l_kernel*l_kernel
-                indice=np.zeros([12*nside*nside*nk*self.NORIENT,2],dtype='int')
-                lidx=np.arange(self.NORIENT)
-                for i in range(12*nside*nside):
-                    indice[i*nk*self.NORIENT:i*nk*self.NORIENT+nk*self.NORIENT,0]=i*self.NORIENT+np.repeat(lidx,nk)
-                    indice[i*nk*self.NORIENT:i*nk*self.NORIENT+nk*self.NORIENT,1]=np.tile(iwav[i],self.NORIENT)
-
-                indice2=np.zeros([12*nside*nside*nk,2],dtype='int')
-                for i in range(12*nside*nside):
-                    indice2[i*nk:i*nk+nk,0]=i
-                    indice2[i*nk:i*nk+nk,1]=iwav[i]
-
-                w=np.zeros([12*nside*nside,wav.shape[2],wav.shape[1]],dtype='complex')
-                for i in range(wav.shape[1]):
-                    for j in range(wav.shape[2]):
-                        w[:,j,i]=wav[:,i,j]
-                wav=w.flatten()
-                wwav=wwav.flatten()
-                """
-                if cell_ids is None:
-                    if not self.silent:
-                        print(
-                            "Write FOSCAT_%s_W%d_%d_%d_PIDX.npy"
-                            % (TMPFILE_VERSION, self.KERNELSZ**2, self.NORIENT, nside)
-                        )
-                    np.save(
-                        "%s/FOSCAT_%s_W%d_%d_%d_PIDX.npy"
-                        % (
-                            self.TEMPLATE_PATH,
-                            TMPFILE_VERSION,
-                            self.KERNELSZ**2,
-                            self.NORIENT,
-                            nside,
-                        ),
-                        indice,
-                    )
-                    np.save(
-                        "%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy"
-                        % (
-                            self.TEMPLATE_PATH,
-                            TMPFILE_VERSION,
-                            self.KERNELSZ**2,
-                            self.NORIENT,
-                            nside,
-                        ),
-                        wav,
-                    )
-                    np.save(
-                        "%s/FOSCAT_%s_W%d_%d_%d_PIDX2.npy"
-                        % (
-                            self.TEMPLATE_PATH,
-                            TMPFILE_VERSION,
-                            self.KERNELSZ**2,
-                            self.NORIENT,
-                            nside,
-                        ),
-                        indice2,
-                    )
-                    np.save(
-                        "%s/FOSCAT_%s_W%d_%d_%d_SMOO.npy"
-                        % (
-                            self.TEMPLATE_PATH,
-                            TMPFILE_VERSION,
-                            self.KERNELSZ**2,
-                            self.NORIENT,
-                            nside,
-                        ),
-                        wwav,
-                    )
+        if cell_ids is not None:
+            ncell = cell_ids.shape[0]
+        else:
+            ncell = 12 * nside * nside
+
+        try:
+            tmp = np.load(
+                "%s/W%d_%s_%d_IDX.npy"
+                % (self.TEMPLATE_PATH, l_kernel**2, TMPFILE_VERSION, nside)
+            )
+        except:
             if self.use_2D:
                 if l_kernel**2 == 9:
                     if self.rank == 0:
@@ -1685,70 +2126,51 @@ class FoCUS:
                             )
                         return None
 
-        if cell_ids is None:
-            self.barrier()
-            if self.use_2D:
-                tmp = np.load(
-                    "%s/W%d_%s_%d_IDX.npy"
-                    % (self.TEMPLATE_PATH, l_kernel**2, TMPFILE_VERSION, nside)
-                )
-            else:
-                tmp = np.load(
-                    "%s/FOSCAT_%s_W%d_%d_%d_PIDX.npy"
-                    % (
-                        self.TEMPLATE_PATH,
-                        TMPFILE_VERSION,
-                        self.KERNELSZ**2,
-                        self.NORIENT,
-                        nside,
-                    )
-                )
-            tmp2 = np.load(
-                "%s/FOSCAT_%s_W%d_%d_%d_PIDX2.npy"
-                % (
-                    self.TEMPLATE_PATH,
-                    TMPFILE_VERSION,
-                    self.KERNELSZ**2,
-                    self.NORIENT,
-                    nside,
-                )
+        self.barrier()
+        tmp = np.load(
+            "%s/W%d_%s_%d_IDX.npy"
+            % (self.TEMPLATE_PATH, l_kernel**2, TMPFILE_VERSION, nside)
+        )
+        tmp2 = np.load(
+            "%s/FOSCAT_%s_W%d_%d_%d_PIDX2.npy"
+            % (
+                self.TEMPLATE_PATH,
+                TMPFILE_VERSION,
+                self.KERNELSZ**2,
+                self.NORIENT,
+                nside,
             )
-            wr = np.load(
-                "%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy"
-                % (
-                    self.TEMPLATE_PATH,
-                    TMPFILE_VERSION,
-                    self.KERNELSZ**2,
-                    self.NORIENT,
-                    nside,
-                )
-            ).real
-            wi = np.load(
-                "%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy"
-                % (
-                    self.TEMPLATE_PATH,
-                    TMPFILE_VERSION,
-                    self.KERNELSZ**2,
-                    self.NORIENT,
-                    nside,
-                )
-            ).imag
-            ws = self.slope * np.load(
-                "%s/FOSCAT_%s_W%d_%d_%d_SMOO.npy"
-                % (
-                    self.TEMPLATE_PATH,
-                    TMPFILE_VERSION,
-                    self.KERNELSZ**2,
-                    self.NORIENT,
-                    nside,
-                )
+        )
+        wr = np.load(
+            "%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy"
+            % (
+                self.TEMPLATE_PATH,
+                TMPFILE_VERSION,
+                self.KERNELSZ**2,
+                self.NORIENT,
+                nside,
             )
-        else:
-            tmp = indice
-            tmp2 = indice2
-            wr = wav.real
-            wi = wav.imag
-            ws = self.slope * wwav
+        ).real
+        wi = np.load(
+            "%s/FOSCAT_%s_W%d_%d_%d_WAVE.npy"
+            % (
+                self.TEMPLATE_PATH,
+                TMPFILE_VERSION,
+                self.KERNELSZ**2,
+                self.NORIENT,
+                nside,
+            )
+        ).imag
+        ws = self.slope * np.load(
+            "%s/FOSCAT_%s_W%d_%d_%d_SMOO.npy"
+            % (
+                self.TEMPLATE_PATH,
+                TMPFILE_VERSION,
+                self.KERNELSZ**2,
+                self.NORIENT,
+                nside,
+            )
+        )
 
         wr = self.backend.bk_SparseTensor(
             self.backend.bk_constant(tmp),
@@ -1794,6 +2216,160 @@ class FoCUS:
         thelist[laxis2] = laxis1
         return self.backend.bk_transpose(x, thelist)
 
+    # ---------------------------------------------−---------
+    # healpix masks [Nmask,Npix_j] of the Jmax scales of eval, up_graded for
+    # the kernels bigger than 3 and thresholded by mask_thres as eval does.
+    # None is the full sky (no mask or a single mask of ones) for the fast path
+    # of masked_mean. The last pyramids are kept and found by their content,
+    # the last one first by the identity of its mask, not copied to the host
+    # nor hashed: a mask modified in place must be given as a new array.
+    def mask_pyramid(self, mask, nside, Jmax, cell_ids=None):
+        if mask is None:
+            return [None for j in range(Jmax)]
+        if isinstance(mask, MaskPyramid):
+            return mask.masks[0:Jmax]
+        if isinstance(mask, list):
+            # already a pyramid, nothing to hash when eval is traced
+            return mask[0:Jmax]
+
+        with self.lock:
+            last = self.last_mask_pyramid
+            if (
+                last is not None
+                and last[0] is mask
+                and last[1] == nside
+                and last[2] is cell_ids
+                and len(last[3]) >= Jmax
+            ):
+                return last[3][0:Jmax]
+
+            l_mask = np.ascontiguousarray(self.backend.to_numpy(mask))
+            if (
+                l_mask.shape[0] == 1
+                and np.all(l_mask == 1)
+                and (self.mask_thres is None or self.mask_thres < 1)
+            ):
+                self.last_mask_pyramid = (mask, nside, cell_ids, [None] * Jmax)
+                return [None for j in range(Jmax)]
+
+            key = (
+                hashlib.sha1(l_mask.tobytes()).hexdigest(),
+                l_mask.shape,
+                l_mask.dtype.str,
+                nside,
+                None if cell_ids is None else cell_ids_hash(cell_ids),
+            )
+            # the most recent pyramid is the last one
+            pyramid = self.mask_pyramids.pop(key, None)
+            if pyramid is None or len(pyramid) < Jmax:
+                vmask = self.backend.bk_cast(l_mask)
+                l_nside = nside
+                if self.KERNELSZ > 3 and cell_ids is None:
+                    vmask = self.up_grade(vmask, l_nside * 2, axis=1)
+                    l_nside = l_nside * 2
+                    if self.KERNELSZ > 5:
+                        vmask = self.up_grade(vmask, l_nside * 2, axis=1)
+                        l_nside = l_nside * 2
+
+                pyramid = [vmask]
+                l_cell_ids = cell_ids
+                for j in range(1, Jmax):
+                    vmask, l_cell_ids = self.ud_grade_2(
+                        vmask, axis=1, cell_ids=l_cell_ids, nside=l_nside
+                    )
+                    if self.mask_thres is not None:
+                        vmask = self.backend.bk_threshold(vmask, self.mask_thres)
+                    pyramid.append(vmask)
+                    l_nside = l_nside // 2
+
+            self.mask_pyramids[key] = pyramid
+            while len(self.mask_pyramids) > 4:
+                del self.mask_pyramids[next(iter(self.mask_pyramids))]
+            self.last_mask_pyramid = (mask, nside, cell_ids, pyramid)
+            return pyramid[0:Jmax]
+
+    # ---------------------------------------------−---------
+    # mask [Nmask,X[,Y]] of 2D images or 1D signals set to zero on the
+    # KERNELSZ//2 pixels of the borders where the convolutions are not valid
+    def edge_mask(self, vmask):
+        with self.lock:
+            if self.mask_mask is None:
+                self.mask_mask = {}
+            key = tuple(vmask.shape[1:])
+            if key not in self.mask_mask:
+                mask_mask = np.zeros([1] + list(key))
+                if self.use_2D:
+                    mask_mask[
+                        0,
+                        self.KERNELSZ // 2 : -self.KERNELSZ // 2 + 1,
+                        self.KERNELSZ // 2 : -self.KERNELSZ // 2 + 1,
+                    ] = 1.0
+                else:
+                    mask_mask[0, self.KERNELSZ // 2 : -self.KERNELSZ // 2 + 1] = 1.0
+                self.mask_mask[key] = self.backend.bk_cast(mask_mask)
+        return vmask * self.mask_mask[key]
+
+    # ---------------------------------------------−---------
+    def prepare_mask(self, mask, Jmax=None, nside=None, cell_ids=None, edge=True):
+        """
+        Computes once the masks of all the scales of eval on the device: the
+        healpix masks up_graded for the large kernels and thresholded, or the
+        2D and 1D masks with their trimmed edges. eval(image, mask=pyramid)
+        gives the same coefficients as eval(image, mask=mask) without any
+        work on the mask.
+        Parameters
+        ----------
+        mask: array
+            Masks [Nmask, Npix] or [Nmask, Nx, Ny] for 2D images, a single
+            mask of ones for the full sky
+        Jmax: int
+            Number of scales, the largest Jmax of the eval calls
+        nside, cell_ids, edge:
+            As in eval
+        Returns
+        -------
+        MaskPyramid to give to eval as mask
+        """
+        shape = list(mask.shape)
+        if not self.use_2D and not self.use_1D:
+            if nside is None:
+                nside = int(np.sqrt(shape[-1] // 12))
+            if Jmax is None:
+                Jmax = int(np.log(nside) / np.log(2))
+            masks = self.mask_pyramid(mask, nside, Jmax, cell_ids=cell_ids)
+            return MaskPyramid(
+                masks, masks[0], shape, Jmax, cell_ids=cell_ids, edge=edge
+            )
+
+        # same number of scales as eval
+        if self.use_2D:
+            J = int(np.log(min(shape[1], shape[2]) - self.KERNELSZ) / np.log(2))
+        else:
+            J = int(np.log(shape[1]) / np.log(2))
+        if self.KERNELSZ > 3:
+            J -= 1
+        if Jmax is None:
+            Jmax = J
+
+        vmask = self.backend.bk_cast(mask)
+        if self.use_1D and self.KERNELSZ > 3 and cell_ids is None:
+            vmask = self.up_grade(vmask, vmask.shape[1] * 2, axis=1)
+            if self.KERNELSZ > 5:
+                vmask = self.up_grade(vmask, vmask.shape[1] * 2, axis=1)
+        mask0 = vmask
+
+        masks = []
+        l_cell_ids = cell_ids
+        for j in range(Jmax):
+            if edge:
+                vmask = self.edge_mask(vmask)
+            masks.append(vmask)
+            if j != Jmax - 1:
+                vmask, l_cell_ids = self.ud_grade_2(vmask, axis=1, cell_ids=l_cell_ids)
+                if self.mask_thres is not None:
+                    vmask = self.backend.bk_threshold(vmask, self.mask_thres)
+        return MaskPyramid(masks, mask0, shape, Jmax, cell_ids=cell_ids, edge=edge)
+
     # ---------------------------------------------−---------
     # Mean using mask x [....,Npix,....], mask[Nmask,Npix]  to [....,Nmask,....]
     # if use_2D
@@ -1812,6 +2388,21 @@ class FoCUS:
         if not self.use_2D and not self.use_1D:
             nside = int(np.sqrt(x.shape[axis] // 12))
 
+            if mask is None:
+                # full sky: plain reductions over the pixels
+                oshape = [x.shape[0] if axis > 0 else 1, 1]
+                if axis > 1:
+                    oshape = oshape + list(x.shape[1:-1])
+                if not calc_var:
+                    return self.backend.bk_reshape(
+                        self.backend.bk_reduce_mean(x, -1), oshape
+                    )
+                res, c = self.shifted_moments(x)
+                vh = 12 * nside * nside if self.mask_norm else shape[-1]
+                return self.backend.bk_reshape(res, oshape), self.backend.bk_reshape(
+                    self.moments_std(res, c, vh), oshape
+                )
+
         l_mask = mask
         if self.mask_norm:
             sum_mask = self.backend.bk_reduce_sum(
@@ -2008,11 +2599,9 @@ class FoCUS:
                 return res
 
         else:
-            v1 = self.backend.bk_reduce_sum(l_mask * l_x, axis=-1)
-            v2 = self.backend.bk_reduce_sum(l_mask * l_x * l_x, axis=-1)
-            vh = self.backend.bk_reduce_sum(l_mask, axis=-1)
-
-            res = v1 / vh
+            # [ichannel,1,Npix] and [1,1,Nmask,Npix] => [ichannel,Nmask]
+            l_x = l_x[:, 0]
+            l_mask = l_mask[0, 0]
 
             oshape = []
             if axis > 0:
@@ -2024,26 +2613,123 @@ class FoCUS:
                 oshape = oshape + list(x.shape[1:-1])
 
             if calc_var:
-                if self.backend.bk_is_complex(l_x):
-                    res2 = self.backend.bk_sqrt(
-                        (
-                            self.backend.bk_real(v2) / self.backend.bk_real(vh)
-                            - self.backend.bk_real(res) * self.backend.bk_real(res)
-                            + self.backend.bk_imag(v2) / self.backend.bk_real(vh)
-                            - self.backend.bk_imag(res) * self.backend.bk_imag(res)
-                        )
-                        / self.backend.bk_real(vh)
-                    )
-                else:
-                    res2 = self.backend.bk_sqrt((v2 / vh - res * res) / (vh))
-
+                res, c = self.shifted_moments(l_x, l_mask)
+                res2 = self.moments_std(
+                    res,
+                    c,
+                    self.backend.bk_real(self.backend.bk_reduce_sum(l_mask, axis=-1)),
+                )
                 res = self.backend.bk_reshape(res, oshape)
                 res2 = self.backend.bk_reshape(res2, oshape)
                 return res, res2
             else:
+                vh = self.backend.bk_reduce_sum(l_mask, axis=-1)
+                res = self.backend.bk_einsum("cp,mp->cm", l_x, l_mask) / vh
                 res = self.backend.bk_reshape(res, oshape)
                 return res
 
+    # ---------------------------------------------−---------
+    # mean of x [...,Npix] over the pixels weighted by mask [Nmask,Npix] (plain
+    # mean if None) and c = E[x*x] - mean*mean, contracted against the mask
+    # without building the [...,Nmask,Npix] product. The values are shifted by
+    # the first one of each channel so that E[d*d] - E[d]**2 of d = x - shift
+    # does not cancel out when the mean is large compared to the spread.
+    def shifted_moments(self, x, mask=None):
+        shift = x[..., 0:1]
+        d = x - shift
+        if mask is None:
+            m1 = self.backend.bk_reduce_mean(d, -1)
+            m2 = self.backend.bk_reduce_mean(d * d, -1)
+            shift = shift[..., 0]
+        else:
+            vh = self.backend.bk_reduce_sum(mask, -1)
+            m1 = self.backend.bk_einsum("...p,mp->...m", d, mask) / vh
+            m2 = self.backend.bk_einsum("...p,mp->...m", d * d, mask) / vh
+        return m1 + shift, m2 - m1 * m1
+
+    # ---------------------------------------------−---------
+    # standard deviation of masked_mean from the mean res, c = E[x*x] - res*res
+    # and the sum vh of the mask. For complex values it is, as for the real and
+    # imaginary parts, sqrt((Re(E[x*x])-Re(res)**2+Im(E[x*x])-Im(res)**2)/vh)
+    def moments_std(self, res, c, vh):
+        if self.backend.bk_is_complex(res):
+            r = self.backend.bk_real(res)
+            i = self.backend.bk_imag(res)
+            var = (
+                self.backend.bk_real(c)
+                + self.backend.bk_imag(c)
+                - 2 * i * i
+                + 2 * r * i
+            )
+        else:
+            var = c
+        return self.backend.bk_sqrt(var / vh)
+
+    # ---------------------------------------------−---------
+    # masked_mean(expand_dims(x1,-4)*conj(expand_dims(x2,-3)),mask,axis=4) of the
+    # healpix x1 [Nbatch,N1,N3,Npix] and x2 [Nbatch,N2,N3,Npix] computed as a
+    # contraction over the pixels, one mask at a time. The [Nbatch,N2,N1,N3,Npix]
+    # product is never built, the largest temporary is the masked copy of x1.
+    def masked_mean_prod(self, x1, x2, mask, calc_var=False):
+
+        shape = list(x1.shape)
+        nside = int(np.sqrt(shape[-1] // 12))
+
+        if mask is None:
+            # full sky: [Nbatch,N1,N3,Npix] x [Nbatch,N2,N3,Npix] => [Nbatch,N2,N1,N3]
+            x2 = self.backend.bk_conjugate(x2)
+            oshape = [shape[0], 1, x2.shape[1], shape[1], shape[2]]
+            res = self.backend.bk_einsum("bacp,bdcp->bdac", x1, x2) / shape[-1]
+            if not calc_var:
+                return self.backend.bk_reshape(res, oshape)
+            # (x1 x2^*)^2 = x1^2 (x2^*)^2
+            v2 = self.backend.bk_einsum("bacp,bdcp->bdac", x1 * x1, x2 * x2)
+            vh = 12 * nside * nside if self.mask_norm else shape[-1]
+            return self.backend.bk_reshape(res, oshape), self.backend.bk_reshape(
+                self.moments_std(res, v2 / shape[-1] - res * res, vh), oshape
+            )
+
+        l_mask = mask
+        if self.mask_norm:
+            sum_mask = self.backend.bk_reduce_sum(l_mask, 1)
+            l_mask = (
+                12
+                * nside
+                * nside
+                * l_mask
+                / self.backend.bk_reshape(sum_mask, [l_mask.shape[0], 1])
+            )
+        vh = self.backend.bk_reduce_sum(l_mask, axis=-1)
+        c_mask = self.backend.bk_complex(l_mask, self.backend.bk_cast(0.0 * l_mask))
+
+        def l_sum(a, b):
+            # [Nbatch,N1,N3,Npix] x [Nbatch,N2,N3,Npix] => [Nbatch,N2,N1,N3,Nmask]
+            return self.backend.bk_stack(
+                [
+                    self.backend.bk_einsum("bacp,bdcp->bdac", a * c_mask[m], b)
+                    for m in range(mask.shape[0])
+                ],
+                axis=-1,
+            )
+
+        x2 = self.backend.bk_conjugate(x2)
+        v1 = l_sum(x1, x2)
+
+        oshape = [shape[0], mask.shape[0], x2.shape[1], shape[1], shape[2]]
+        vh = self.backend.bk_cast(vh)
+        c_vh = self.backend.bk_complex(vh, 0.0 * vh)
+        res = v1 / c_vh
+
+        if calc_var:
+            # (x1 x2^*)^2 = x1^2 (x2^*)^2
+            v2 = l_sum(x1 * x1, x2 * x2)
+            res2 = self.moments_std(res, v2 / c_vh - res * res, vh)
+            return (
+                self.backend.bk_reshape(res, oshape),
+                self.backend.bk_reshape(res2, oshape),
+            )
+        return self.backend.bk_reshape(res, oshape)
+
     # ---------------------------------------------−---------
     # convert tensor x [....,a,b,....] to [....,a*b,....]
     def reduce_dim(self, x, axis=0):
@@ -2296,19 +2982,12 @@ class FoCUS:
             if nside is None:
                 nside = int(np.sqrt(image.shape[-1] // 12))
 
-            if self.Idx_Neighbours[nside] is None:
-                if self.InitWave is None:
-                    wr, wi, ws, widx = self.init_index(nside, cell_ids=cell_ids)
-                else:
-                    wr, wi, ws, widx = self.InitWave(nside, cell_ids=cell_ids)
-
-                self.Idx_Neighbours[nside] = 1  # self.backend.bk_constant(tmp)
-                self.ww_Real[nside] = wr
-                self.ww_Imag[nside] = wi
-                self.w_smooth[nside] = ws
+            self.init_wave(nside, cell_ids=cell_ids)
 
             l_ww_real = self.ww_Real[nside]
             l_ww_imag = self.ww_Imag[nside]
+            l_ww_realimag = self.ww_RealImag[nside]
+            l_ww_stencil = self.ww_Stencil[nside]
 
             # always convolve the last dimension
 
@@ -2320,7 +2999,37 @@ class FoCUS:
                 self.backend.bk_cast(image), [ndata, ishape[-1]]
             )
 
-            if tim.dtype == self.all_cbk_type:
+            if l_ww_realimag is not None or l_ww_stencil is not None:
+                # one product with [ww_Real,ww_Imag], the real and imaginary
+                # parts of a complex input are stacked along the data axis
+                if tim.dtype == self.all_cbk_type:
+                    nbatch = 2 * ndata
+                    tim = self.backend.bk_concat(
+                        [self.backend.bk_real(tim), self.backend.bk_imag(tim)], 0
+                    )
+                else:
+                    nbatch = ndata
+                if l_ww_stencil is not None:
+                    # gather the neighbours [nbatch,ncell,K] and weight them
+                    rr = self.backend.bk_cast(
+                        self.backend.bk_einsum(
+                            "bpk,pko->bop",
+                            self.backend.bk_gather(
+                                self.backend.bk_cast_conv(tim), l_ww_stencil[0], axis=1
+                            ),
+                            l_ww_stencil[1],
+                        )
+                    )
+                else:
+                    rr = self.backend.bk_sparse_dense_matmul(tim, l_ww_realimag)
+                rr = self.backend.bk_reshape(rr, [nbatch, 2, self.NORIENT, ishape[-1]])
+                if nbatch > ndata:
+                    res = self.backend.bk_complex(
+                        rr[:ndata, 0] - rr[ndata:, 1], rr[:ndata, 1] + rr[ndata:, 0]
+                    )
+                else:
+                    res = self.backend.bk_complex(rr[:, 0], rr[:, 1])
+            elif tim.dtype == self.all_cbk_type:
                 rr1 = self.backend.bk_reshape(
                     self.backend.bk_sparse_dense_matmul(
                         self.backend.bk_real(tim),
@@ -2475,26 +3184,37 @@ class FoCUS:
             if nside is None:
                 nside = int(np.sqrt(image.shape[-1] // 12))
 
-            if self.Idx_Neighbours[nside] is None:
-
-                if self.InitWave is None:
-                    wr, wi, ws, widx = self.init_index(nside, cell_ids=cell_ids)
-                else:
-                    wr, wi, ws, widx = self.InitWave(self, nside, cell_ids=cell_ids)
-
-                self.Idx_Neighbours[nside] = 1
-                self.ww_Real[nside] = wr
-                self.ww_Imag[nside] = wi
-                self.w_smooth[nside] = ws
+            self.init_wave(nside, cell_ids=cell_ids)
 
             l_w_smooth = self.w_smooth[nside]
+            l_w_stencil = self.w_smooth_Stencil[nside]
 
             odata = 1
             for k in range(0, len(ishape) - 1):
                 odata = odata * ishape[k]
 
             tim = self.backend.bk_reshape(image, [odata, ishape[-1]])
-            if tim.dtype == self.all_cbk_type:
+            if l_w_stencil is not None:
+
+                def l_smooth(x):
+                    return self.backend.bk_cast(
+                        self.backend.bk_einsum(
+                            "bpk,pk->bp",
+                            self.backend.bk_gather(
+                                self.backend.bk_cast_conv(x), l_w_stencil[0], axis=1
+                            ),
+                            l_w_stencil[1],
+                        )
+                    )
+
+                if tim.dtype == self.all_cbk_type:
+                    res = self.backend.bk_complex(
+                        l_smooth(self.backend.bk_real(tim)),
+                        l_smooth(self.backend.bk_imag(tim)),
+                    )
+                else:
+                    res = l_smooth(tim)
+            elif tim.dtype == self.all_cbk_type:
                 rr = self.backend.bk_sparse_dense_matmul(
                     self.backend.bk_real(tim), l_w_smooth
                 )
@@ -2511,6 +3231,72 @@ class FoCUS:
 
         return res
 
+    # ---------------------------------------------−---------
+    # convol and smooth of a healpix map. With the stencil engine the
+    # neighbourhood of each pixel is gathered once for both kernels.
+    def convol_smooth(self, in_image, axis=0, cell_ids=None, nside=None):
+
+        if self.use_2D or self.use_1D or self.engine != "stencil":
+            return (
+                self.convol(in_image, axis=axis, cell_ids=cell_ids, nside=nside),
+                self.smooth(in_image, axis=axis, cell_ids=cell_ids, nside=nside),
+            )
+
+        image = self.backend.bk_cast(in_image)
+        ishape = list(image.shape)
+        if nside is None:
+            nside = int(np.sqrt(ishape[-1] // 12))
+
+        self.init_wave(nside, cell_ids=cell_ids)
+
+        l_ww_stencil = self.ww_Stencil[nside]
+        l_w_stencil = self.w_smooth_Stencil[nside]
+        if l_ww_stencil is None:
+            # operators given by InitWave
+            return (
+                self.convol(in_image, axis=axis, cell_ids=cell_ids, nside=nside),
+                self.smooth(in_image, axis=axis, cell_ids=cell_ids, nside=nside),
+            )
+
+        ndata = 1
+        for k in range(len(ishape) - 1):
+            ndata = ndata * ishape[k]
+        tim = self.backend.bk_reshape(image, [ndata, ishape[-1]])
+
+        if tim.dtype == self.all_cbk_type:
+            nbatch = 2 * ndata
+            tim = self.backend.bk_concat(
+                [self.backend.bk_real(tim), self.backend.bk_imag(tim)], 0
+            )
+        else:
+            nbatch = ndata
+
+        tim = self.backend.bk_gather(
+            self.backend.bk_cast_conv(tim), l_ww_stencil[0], axis=1
+        )
+        rw = self.backend.bk_reshape(
+            self.backend.bk_cast(
+                self.backend.bk_einsum("bpk,pko->bop", tim, l_ww_stencil[1])
+            ),
+            [nbatch, 2, self.NORIENT, ishape[-1]],
+        )
+        rs = self.backend.bk_cast(
+            self.backend.bk_einsum("bpk,pk->bp", tim, l_w_stencil[1])
+        )
+        if nbatch > ndata:
+            res = self.backend.bk_complex(
+                rw[:ndata, 0] - rw[ndata:, 1], rw[:ndata, 1] + rw[ndata:, 0]
+            )
+            res_smooth = self.backend.bk_complex(rs[:ndata], rs[ndata:])
+        else:
+            res = self.backend.bk_complex(rw[:, 0], rw[:, 1])
+            res_smooth = rs
+
+        return (
+            self.backend.bk_reshape(res, ishape[0:-1] + [self.NORIENT, ishape[-1]]),
+            self.backend.bk_reshape(res_smooth, ishape),
+        )
+
     # ---------------------------------------------−---------
     def get_kernel_size(self):
         return self.KERNELSZ
@@ -2528,6 +3314,14 @@ class FoCUS:
                 self.ww_ImagT[1].reshape(self.KERNELSZ * self.KERNELSZ, self.NORIENT),
             )
         else:
+            with self.lock:
+                self.init_wave(nside)
+                if self.ww_Real[nside] is None:
+                    wr, wi, ws, widx = self.load_wave_operators(
+                        nside, self.KERNELSZ, cell_ids=self.wave_cell_ids[nside]
+                    )
+                    self.ww_Real[nside] = wr
+                    self.ww_Imag[nside] = wi
             return (self.ww_Real[nside], self.ww_Imag[nside])
 
     # ---------------------------------------------−---------
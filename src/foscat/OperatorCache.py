@@ -0,0 +1,244 @@
+import contextlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # no file locking on windows
+    fcntl = None
+
+MAGIC = b"FOSCATOC"
+ALIGN = 64
+SUFFIX = ".op"
+
+
+class OperatorCache:
+    """
+    Directory of precomputed operators, one file per array.
+
+    Each file starts with a magic string and the length of a JSON header giving
+    the version, dtype, shape, file size and crc32 of its array. The array
+    follows, aligned on 64 bytes, so that it is opened with np.memmap: the
+    processes of one node reading the same file share its page-cache copy
+    instead of holding a private copy of the operators. The maps are copy on
+    write, a process modifying an array gets a private copy of the modified
+    pages.
+
+    A file is never modified in place. update() writes each array in a
+    temporary file renamed over the old one, so that a reader never sees a
+    half-written file and the memory maps already opened stay valid. Adding an
+    array does not read or write the other ones. A file whose size or checksum
+    does not match its header is seen as missing.
+
+    Processes sharing the cache compute missing operators inside lock(), the
+    first one computes and writes them while the others wait and read them:
+
+    >>> with cache.lock():
+    ...     if key not in cache:
+    ...         cache.update({key: compute()})
+
+    Parameters
+    ----------
+    path: str
+        Name of the cache directory.
+    version: str
+        Version stamp of the cached operators, a file with another version is
+        seen as missing.
+    verify: bool, default True
+        Check the crc32 of an array the first time it is accessed.
+    max_size: int, optional
+        Size in bytes above which update() removes the least recently used
+        arrays. Without it the cache is never pruned.
+    """
+
+    def __init__(self, path, version, verify=True, max_size=None):
+        self.path = path
+        self.version = version
+        self.verify = verify
+        self.max_size = max_size
+        self.arrays = {}
+        self.checked = {}
+        self.nlock = 0
+        self.lock_file = None
+        # the threads of a process take the file lock one after the other
+        self.thread_lock = threading.RLock()
+
+    # ---------------------------------------------−---------
+    def filename(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    # ---------------------------------------------−---------
+    # header of the array key, read again if its file has been replaced by
+    # another process, None if it is missing or corrupted
+    def refresh(self, key):
+        try:
+            st = os.stat(self.filename(key))
+        except OSError:
+            return self.forget(key)
+
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if key in self.arrays and self.arrays[key][0] == stat:
+            return self.arrays[key][1]
+
+        self.checked.pop(key, None)
+        try:
+            with open(self.filename(key), "rb") as f:
+                magic = f.read(len(MAGIC))
+                (length,) = struct.unpack("<Q", f.read(8))
+                header = json.loads(f.read(length).decode("utf-8"))
+        except (struct.error, ValueError):
+            header = None
+        except OSError:
+            # removed by another process since the stat
+            return self.forget(key)
+
+        if header is None or magic != MAGIC or header.get("size") != st.st_size:
+            print("Ignore the corrupted operator %s" % (self.filename(key)))
+            header = None
+        elif header["version"] != self.version:
+            header = None
+
+        self.arrays[key] = (stat, header)
+        return header
+
+    def forget(self, key):
+        self.arrays.pop(key, None)
+        self.checked.pop(key, None)
+        return None
+
+    def __contains__(self, key):
+        info = self.refresh(key)
+        if info is None:
+            return False
+        if self.verify and key not in self.checked:
+            try:
+                data = self.read(key)
+            except OSError:
+                self.forget(key)
+                return False
+            self.checked[key] = zlib.crc32(data) == info["crc"]
+            if not self.checked[key]:
+                print("Ignore %s, wrong checksum" % (self.filename(key)))
+        return not self.verify or self.checked[key]
+
+    def keys(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        keys = [n[: -len(SUFFIX)] for n in names if n.endswith(SUFFIX)]
+        return [k for k in sorted(keys) if k in self]
+
+    def read(self, key):
+        info = self.arrays[key][1]
+        shape = tuple(info["shape"])
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=info["dtype"])
+        return np.memmap(
+            self.filename(key),
+            dtype=info["dtype"],
+            mode="c",
+            offset=info["offset"],
+            shape=shape,
+        )
+
+    def get(self, key):
+        if key not in self:
+            raise KeyError("%s is not in the operator cache %s" % (key, self.path))
+        if self.max_size is not None:
+            # last use of the array for the pruning of update
+            with contextlib.suppress(OSError):
+                os.utime(self.filename(key))
+        return self.read(key)
+
+    # ---------------------------------------------−---------
+    # exclusive access to the cache between processes and threads, can be nested
+    @contextlib.contextmanager
+    def lock(self):
+        with self.thread_lock:
+            if self.nlock == 0:
+                os.makedirs(self.path, exist_ok=True)
+                self.lock_file = open(os.path.join(self.path, ".lock"), "a")
+                if fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.nlock += 1
+            try:
+                yield self
+            finally:
+                self.nlock -= 1
+                if self.nlock == 0:
+                    if fcntl is not None:
+                        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    # ---------------------------------------------−---------
+    # add (or replace) the arrays of the dictionary values
+    def update(self, values):
+        with self.lock():
+            for key, val in values.items():
+                self.write(key, np.ascontiguousarray(val))
+            if self.max_size is not None:
+                self.prune(list(values))
+
+    # ---------------------------------------------−---------
+    def write(self, key, val):
+        start = ALIGN
+        while True:
+            header = json.dumps(
+                {
+                    "version": self.version,
+                    "dtype": val.dtype.str,
+                    "shape": list(val.shape),
+                    "offset": start,
+                    "size": start + val.nbytes,
+                    "crc": zlib.crc32(val),
+                }
+            ).encode()
+            if len(MAGIC) + 8 + len(header) <= start:
+                break
+            start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+        fd, tmpname = tempfile.mkstemp(dir=self.path, prefix=key + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(MAGIC)
+                f.write(struct.pack("<Q", len(header)))
+                f.write(header)
+                f.seek(start)
+                f.write(val.data)
+                f.truncate(start + val.nbytes)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmpname, 0o644)
+            os.replace(tmpname, self.filename(key))
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    # ---------------------------------------------−---------
+    # remove the least recently used arrays, but the ones of keep, until the
+    # cache fits in max_size. The open memory maps of the removed files stay valid.
+    def prune(self, keep):
+        files = []
+        size = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(SUFFIX):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                st = os.stat(os.path.join(self.path, name))
+                size += st.st_size
+                if name[: -len(SUFFIX)] not in keep:
+                    files.append((st.st_mtime_ns, st.st_size, name))
+        for t, s, name in sorted(files):
+            if size <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.path, name))
+            size -= s
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Event, Thread
 
 import numpy as np
@@ -89,6 +90,8 @@ class Synthesis:
         self.mpi_size = self.operation.mpi_size
         self.mpi_rank = self.operation.mpi_rank
         self.KEEP_TRACK = None
+        self.executor = None
+        self.warm = False
         self.MAXNUMLOSS = len(loss_list)
 
         if self.operation.BACKEND == "tensorflow":
@@ -182,94 +185,132 @@ class Synthesis:
         self.itt = self.itt + 1
 
     # ---------------------------------------------−---------
-    def calc_grad(self, in_x):
+    # loss and gradient of the loss k for the batch step istep, run by the
+    # threads of run(nthread=...) for the different losses and steps
+    def eval_loss(self, x, istep, k):
+        if self.loss_class[k].batch is None:
+            l_batch = None
+        else:
+            l_batch = self.loss_class[k].batch(self.loss_class[k].batch_data, istep)
 
-        g_tot = None
-        l_tot = 0.0
+        return self.bk.loss(x, l_batch, self.loss_class[k], self.KEEP_TRACK)
 
+    # ---------------------------------------------−---------
+    # number of batch steps summed by loss_grad
+    def number_of_step(self):
         if self.do_all_noise and self.totalsz > self.batchsz:
-            nstep = self.totalsz // self.batchsz
-        else:
-            nstep = 1
+            return self.totalsz // self.batchsz
+        return 1
 
-        x = self.operation.backend.bk_reshape(
-            self.operation.backend.bk_cast(in_x), self.oshape
-        )
+    # ---------------------------------------------−---------
+    # loss and gradient [oshape] at x [oshape] summed over the losses and the
+    # MPI processes, the gradient stays a backend tensor with a single process.
+    # With steps, only these batch steps are computed and the gradient is
+    # scaled to estimate the sum over all of them.
+    def loss_grad(self, x, steps=None):
+
+        nstep = self.number_of_step()
+        if steps is None:
+            steps = range(nstep)
+        nsteps = len(steps)
 
         self.l_log[
             self.mpi_rank * self.MAXNUMLOSS : (self.mpi_rank + 1) * self.MAXNUMLOSS
         ] = -1.0
 
-        for istep in range(nstep):
-
-            for k in range(self.number_of_loss):
-                if self.loss_class[k].batch is None:
-                    l_batch = None
-                else:
-                    l_batch = self.loss_class[k].batch(
-                        self.loss_class[k].batch_data, istep
-                    )
-
+        # With MPI, the batch steps are cut in mpi_nreduce groups. The packed
+        # sum of a group is reduced as soon as its losses and the ones of the
+        # previous groups are computed, while the next groups are computed,
+        # the last one with the loss values.
+        tasks = [(istep, k) for istep in steps for k in range(self.number_of_loss)]
+        ngroup = 1 if self.mpi_size == 1 else max(min(self.mpi_nreduce, nsteps), 1)
+        group = [
+            (i // self.number_of_loss) * ngroup // nsteps for i in range(len(tasks))
+        ]
+        remaining = np.bincount(group, minlength=ngroup)
+        results = [None for t in tasks]
+        g_group = [None for k in range(ngroup)]
+        l_group = [None for k in range(ngroup)]
+        reqs = []
+        next_group = [0]
+
+        def done(i, res):
+            results[i] = res
+            remaining[group[i]] -= 1
+            if remaining[group[i]] > 0:
+                return
+            # summed on the device in the order of the tasks
+            g_sum = None
+            l_sum = {}
+            for j in range(len(tasks)):
+                if group[j] != group[i]:
+                    continue
+                l_loss, g = results[j][0], results[j][1]
                 if self.KEEP_TRACK is not None:
-                    l_loss, g, linfo = self.bk.loss(
-                        x, l_batch, self.loss_class[k], self.KEEP_TRACK
+                    self.last_info = self.KEEP_TRACK(
+                        results[j][2], self.mpi_rank, add=True
                     )
-                    self.last_info = self.KEEP_TRACK(linfo, self.mpi_rank, add=True)
+                g_sum = g if g_sum is None else g_sum + g
+                k = tasks[j][1]
+                l_sum[k] = l_loss if k not in l_sum else l_sum[k] + l_loss
+                results[j] = None
+            g_group[group[i]] = self.local_grad(g_sum)
+            l_group[group[i]] = l_sum
+
+            if self.mpi_size == 1:
+                return
+            # the reductions are started in the order of the groups on all
+            # the processes whatever the order the threads finish them
+            while next_group[0] < ngroup and g_group[next_group[0]] is not None:
+                k = next_group[0]
+                if k == ngroup - 1:
+                    log_losses()
+                    reqs.append(self.start_reduce(g_group[k], self.l_log))
                 else:
-                    l_loss, g = self.bk.loss(
-                        x, l_batch, self.loss_class[k], self.KEEP_TRACK
-                    )
-
-                if g_tot is None:
-                    g_tot = g
-                else:
-                    g_tot = g_tot + g
-
-                l_tot = l_tot + self.to_numpy(l_loss)
-
-                if self.l_log[self.mpi_rank * self.MAXNUMLOSS + k] == -1:
-                    self.l_log[self.mpi_rank * self.MAXNUMLOSS + k] = (
-                        self.to_numpy(l_loss) / nstep
-                    )
-                else:
-                    self.l_log[self.mpi_rank * self.MAXNUMLOSS + k] = (
-                        self.l_log[self.mpi_rank * self.MAXNUMLOSS + k]
-                        + self.to_numpy(l_loss) / nstep
-                    )
-
-        grd_mask = self.grd_mask
+                    reqs.append(self.start_reduce(g_group[k]))
+                g_group[k] = None
+                next_group[0] = k + 1
+
+        def log_losses():
+            # one transfer per loss
+            for k in l_group[0]:
+                l_loss = l_group[0][k]
+                for l_sum in l_group[1:]:
+                    l_loss = l_loss + l_sum[k]
+                self.l_log[self.mpi_rank * self.MAXNUMLOSS + k] = (
+                    self.to_numpy(l_loss) / nsteps
+                )
 
-        if grd_mask is not None:
-            g_tot = self.operation.backend.to_numpy(g_tot * grd_mask)
+        # the losses of all the batch steps are independent. The first call
+        # computes one batch step of each loss in this thread, the lazy
+        # operators are built before the threads share them.
+        if self.executor is not None and len(tasks) > 1:
+            nwarm = 0 if self.warm else self.number_of_loss
+            for i in range(nwarm):
+                done(i, self.eval_loss(x, *tasks[i]))
+            futures = {
+                self.executor.submit(self.eval_loss, x, *tasks[i]): i
+                for i in range(nwarm, len(tasks))
+            }
+            for f in as_completed(futures):
+                done(futures[f], f.result())
         else:
-            g_tot = self.operation.backend.to_numpy(g_tot)
-
-        g_tot[np.isnan(g_tot)] = 0.0
+            for i in range(len(tasks)):
+                done(i, self.eval_loss(x, *tasks[i]))
+        self.warm = True
 
         self.imin = self.imin + self.batchsz
 
         if self.mpi_size == 1:
+            log_losses()
+            grad = g_group[0]
+            if nsteps != nstep:
+                grad = grad * (nstep / nsteps)
             self.ltot = self.l_log
         else:
-            local_log = (self.l_log).astype("float64")
-            self.ltot = np.zeros(self.l_log.shape, dtype="float64")
-            self.comm.Allreduce(
-                (local_log, self.MPI.DOUBLE), (self.ltot, self.MPI.DOUBLE)
-            )
-
-        if self.mpi_size == 1:
-            grad = g_tot
-        else:
-            if self.operation.backend.bk_is_complex(g_tot):
-                grad = np.zeros(self.oshape, dtype=g_tot.dtype)
-
-                self.comm.Allreduce((g_tot), (grad))
-            else:
-                grad = np.zeros(self.oshape, dtype="float64")
-
-                self.comm.Allreduce(
-                    (g_tot.astype("float64"), self.MPI.DOUBLE), (grad, self.MPI.DOUBLE)
-                )
+            grad, self.ltot = self.finish_reduce(reqs)
+            if nsteps != nstep:
+                grad = grad * (nstep / nsteps)
 
         if self.nlog == self.history.shape[0]:
             new_log = np.zeros([self.history.shape[0] * 2])
@@ -280,13 +321,381 @@ class Synthesis:
 
         self.history[self.nlog] = l_tot
 
-        g_tot = grad.flatten()
+        return l_tot, grad
+
+    # ---------------------------------------------−---------
+    # gradient of this process masked by grd_mask, NaN set to zero
+    def local_grad(self, g):
+        if self.grd_mask is not None:
+            g = g * self.grd_mask
+
+        return self.operation.backend.bk_nan_to_num(g)
+
+    # ---------------------------------------------−---------
+    # start the non blocking sum over the MPI processes of the gradient g,
+    # packed in one buffer with the loss values l_log if not None. The
+    # complex gradients are sent as their real and imaginary parts.
+    def start_reduce(self, g, l_log=None):
+        g = self.operation.backend.to_numpy(g).ravel()
+        self.grad_complex = np.iscomplexobj(g)
+        if self.grad_complex:
+            g = np.concatenate([g.real, g.imag])
+        if l_log is not None:
+            g = np.concatenate([g, l_log])
+        send = g.astype(self.mpi_type)
+        recv = np.zeros_like(send)
+        return self.comm.Iallreduce(send, recv, op=self.MPI.SUM), send, recv
+
+    # ---------------------------------------------−---------
+    # wait for the reductions reqs of start_reduce, the last one holding the
+    # loss values. Returns the summed gradient [oshape] and the l_log of all
+    # the processes, in float64.
+    def finish_reduce(self, reqs):
+        self.MPI.Request.Waitall([req for req, send, recv in reqs])
+
+        ngrad = int(np.prod(self.oshape))
+        grad = reqs[0][2][0:ngrad].astype("float64")
+        for req, send, recv in reqs[1:]:
+            grad = grad + recv[0:ngrad]
+        if self.grad_complex:
+            grad = grad + 1j * reqs[0][2][ngrad : 2 * ngrad]
+            for req, send, recv in reqs[1:]:
+                grad = grad + 1j * recv[ngrad : 2 * ngrad]
+        ltot = reqs[-1][2][-self.l_log.shape[0] :].astype("float64")
+        return grad.reshape(self.oshape), ltot
+
+    # ---------------------------------------------−---------
+    # loss and flat gradient of the flat map in_x as numpy float64 arrays
+    # for scipy.optimize
+    def calc_grad(self, in_x):
+
+        x = self.operation.backend.bk_reshape(
+            self.operation.backend.bk_cast(in_x), self.oshape
+        )
+
+        l_tot, grad = self.loss_grad(x)
+
+        g_tot = self.operation.backend.to_numpy(grad).flatten()
 
         if self.operation.backend.bk_is_complex(g_tot):
             return l_tot.astype("float64"), g_tot
 
         return l_tot.astype("float64"), g_tot.astype("float64")
 
+    # ---------------------------------------------−---------
+    # loss and flat gradient of the flat map x, both kept on the device
+    def device_grad(self, x, steps=None):
+        bk = self.operation.backend
+
+        l_tot, grad = self.loss_grad(bk.bk_reshape(x, self.oshape), steps=steps)
+        if isinstance(grad, np.ndarray):
+            # reduced by MPI
+            grad = bk.bk_cast(grad)
+
+        return float(l_tot), bk.bk_reshape(grad, [-1])
+
+    # ---------------------------------------------−---------
+    # gradient of nsample batch steps drawn at random, of all of them if None.
+    # With svrg, the full gradient at a snapshot x_snap is computed every svrg
+    # iterations and the sampled gradient g_S(x) becomes
+    # g_S(x) - g_S(x_snap) + g(x_snap), of much lower variance (SVRG).
+    def sample_grad(self, x, itt, nsample=None, svrg=None):
+        nstep = self.number_of_step()
+        if nsample is None or nsample >= nstep:
+            return self.device_grad(x)
+
+        if svrg is not None and (itt % svrg == 0 or self.x_snap is None):
+            self.x_snap = x
+            l_tot, self.g_snap = self.device_grad(x)
+            return l_tot, self.g_snap
+
+        steps = np.random.choice(nstep, nsample, replace=False)
+        if svrg is None:
+            return self.device_grad(x, steps)
+
+        # the batch steps of x_snap do not move the noise batches
+        imin = self.imin
+        _, g_snap = self.device_grad(self.x_snap, steps)
+        self.imin = imin
+        l_tot, g = self.device_grad(x, steps)
+        return l_tot, g - g_snap + self.g_snap
+
+    # ---------------------------------------------−---------
+    def dot(self, a, b):
+        return self.operation.backend.bk_reduce_sum(a * b)
+
+    # ---------------------------------------------−---------
+    # L-BFGS on backend tensors: two-loop recursion over the last nhist pairs
+    # (s,y) and backtracking line search. Only the scalars of the line search
+    # and of the curvature test go back to the host. Stops as fmin_l_bfgs_b
+    # when the relative decrease of the loss is below factr*eps.
+    def lbfgs(self, x, maxiter, factr=10.0, nhist=10):
+        bk = self.operation.backend
+        eps = np.finfo("float64").eps
+
+        if self.resume_grad is not None:
+            l_tot, g = self.resume_grad
+            self.resume_grad = None
+        else:
+            l_tot, g = self.device_grad(x)
+            self.info_back(x)
+        s_list, y_list, rho_list = self.lbfgs_mem
+
+        for itt in range(self.nit, maxiter):
+            q = g
+            alpha = []
+            for s, y, rho in zip(s_list[::-1], y_list[::-1], rho_list[::-1]):
+                a = rho * self.dot(s, q)
+                q = q - a * y
+                alpha.append(a)
+            if len(s_list) > 0:
+                # initial Hessian s.y/y.y of the last pair
+                yy = float(bk.to_numpy(self.dot(y_list[-1], y_list[-1])))
+                q = q / (rho_list[-1] * yy)
+            else:
+                # first step of unit length
+                q = q / np.sqrt(float(bk.to_numpy(self.dot(g, g))) + 1e-300)
+            for s, y, rho, a in zip(s_list, y_list, rho_list, alpha[::-1]):
+                q = q + (a - rho * self.dot(y, q)) * s
+            d = -q
+
+            gd = float(bk.to_numpy(self.dot(g, d)))
+            if not gd < 0:
+                # not a descent direction, restart from the gradient
+                s_list, y_list, rho_list = [], [], []
+                d = -g / np.sqrt(float(bk.to_numpy(self.dot(g, g))) + 1e-300)
+                gd = float(bk.to_numpy(self.dot(g, d)))
+                if not gd < 0:
+                    break
+
+            step = 1.0
+            for k in range(20):
+                x_new = x + step * d
+                l_new, g_new = self.device_grad(x_new)
+                if l_new <= l_tot + 1e-4 * step * gd:
+                    break
+                step = step / 2
+            else:
+                # line search failed, x is the last accepted point
+                break
+
+            s = x_new - x
+            y = g_new - g
+            sy = float(bk.to_numpy(self.dot(s, y)))
+            if sy > 1e-10 * float(bk.to_numpy(self.dot(y, y))):
+                s_list.append(s)
+                y_list.append(y)
+                rho_list.append(1.0 / sy)
+                if len(s_list) > nhist:
+                    del s_list[0], y_list[0], rho_list[0]
+
+            stop = l_tot - l_new <= factr * eps * max(abs(l_tot), abs(l_new), 1.0)
+            x, g, l_tot = x_new, g_new, l_new
+            self.nit = itt + 1
+            self.lbfgs_mem = [s_list, y_list, rho_list]
+            self.info_back(x)
+            self.save_checkpoint(x, l_tot, g)
+            if stop:
+                break
+
+        return x, l_tot
+
+    # ---------------------------------------------−---------
+    # moments and bias corrections of adam for a new optimization
+    def reset_adam(self):
+        self.m_dw, self.v_dw = 0.0, 0.0
+        self.pbeta1 = self.beta1
+        self.pbeta2 = self.beta2
+
+    # ---------------------------------------------−---------
+    # Adam on backend tensors with the moments m_dw, v_dw, the learning rate
+    # decreased by decay_rate every EVAL_FREQUENCY iterations. The gradients
+    # may be the stochastic ones of sample_grad.
+    def adam(self, x, maxiter, nsample=None, svrg=None):
+        bk = self.operation.backend
+
+        if self.resume_grad is not None:
+            l_tot, g = self.resume_grad
+            self.resume_grad = None
+        else:
+            l_tot, g = self.sample_grad(x, 0, nsample=nsample, svrg=svrg)
+            self.info_back(x)
+
+        for itt in range(self.nit, maxiter):
+            self.m_dw = self.beta1 * self.m_dw + (1 - self.beta1) * g
+            self.v_dw = self.beta2 * self.v_dw + (1 - self.beta2) * g * g
+            # bias corrections, pbeta is beta**t
+            m_hat = self.m_dw / (1 - self.pbeta1)
+            v_hat = self.v_dw / (1 - self.pbeta2)
+            self.pbeta1 = self.pbeta1 * self.beta1
+            self.pbeta2 = self.pbeta2 * self.beta2
+
+            x = x - self.eta * m_hat / (bk.bk_sqrt(v_hat) + self.epsilon)
+            l_tot, g = self.sample_grad(x, itt + 1, nsample=nsample, svrg=svrg)
+            self.nit = itt + 1
+            self.info_back(x)
+            self.save_checkpoint(x, l_tot, g)
+
+            if (itt + 1) % self.EVAL_FREQUENCY == 0:
+                self.eta = self.eta * self.decay_rate
+
+        return x, l_tot
+
+    # ---------------------------------------------−---------
+    # callback of fmin_l_bfgs_b, its Hessian memory is not checkpointed
+    def scipy_callback(self, x):
+        self.nit = self.nit + 1
+        self.info_back(x)
+        self.save_checkpoint(x)
+
+    # ---------------------------------------------−---------
+    # file of the checkpoint, with MPI one per process and generation itt
+    def checkpoint_file(self, itt=None):
+        if self.mpi_size == 1:
+            return self.checkpoint
+        return "%s.%d.%d" % (self.checkpoint, self.mpi_rank, itt)
+
+    # ---------------------------------------------−---------
+    # generations of the complete checkpoint files of this process
+    def checkpoint_generations(self):
+        path = os.path.dirname(os.path.abspath(self.checkpoint))
+        prefix = "%s.%d." % (os.path.basename(self.checkpoint), self.mpi_rank)
+        return sorted(
+            int(f[len(prefix) :])
+            for f in os.listdir(path)
+            if f.startswith(prefix) and f[len(prefix) :].isdigit()
+        )
+
+    # ---------------------------------------------−---------
+    # checkpoint to resume from, None if there is none. With MPI, the last
+    # generation written by all the processes so that they restart at the
+    # same iteration.
+    def resume_file(self):
+        if self.mpi_size == 1:
+            if os.path.exists(self.checkpoint):
+                return self.checkpoint
+            return None
+
+        gens = self.comm.allgather(self.checkpoint_generations())
+        common = set(gens[0]).intersection(*gens[1:])
+        if len(common) == 0:
+            return None
+        return self.checkpoint_file(max(common))
+
+    # ---------------------------------------------−---------
+    # every checkpoint_freq iterations, the state of the run is copied to the
+    # host and written by a background thread while the next iterations are
+    # computed. The previous write is finished first.
+    def save_checkpoint(self, x, l_tot=None, g=None):
+        if self.checkpoint is None or self.nit % self.checkpoint_freq != 0:
+            return
+
+        def host(v):
+            if isinstance(v, float):
+                return np.array(v)
+            return np.array(self.operation.backend.to_numpy(v))
+
+        rng = np.random.get_state()
+        s_list, y_list, rho_list = self.lbfgs_mem
+        state = {
+            "optimizer": self.optimizer,
+            "x": host(x),
+            "nit": self.nit,
+            "bias_iteration": self.bias_iteration,
+            "itt": self.itt,
+            "history": self.history[0 : self.nlog].copy(),
+            "l_log": self.l_log.copy(),
+            "ltot": np.array(self.ltot),
+            "eta": self.eta,
+            "pbeta": np.array([self.pbeta1, self.pbeta2]),
+            "m_dw": host(self.m_dw),
+            "v_dw": host(self.v_dw),
+            "rng_keys": rng[1],
+            "rng_pos": rng[2],
+            "rng_gauss": np.array([rng[3], rng[4]]),
+            "lbfgs_s": np.array([host(v) for v in s_list]),
+            "lbfgs_y": np.array([host(v) for v in y_list]),
+            "lbfgs_rho": np.array(rho_list),
+        }
+        if g is not None:
+            state["l_tot"] = l_tot
+            state["g"] = host(g)
+        if self.x_snap is not None:
+            state["x_snap"] = host(self.x_snap)
+            state["g_snap"] = host(self.g_snap)
+
+        if self.checkpoint_future is not None:
+            self.checkpoint_future.result()
+        if self.mpi_size > 1:
+            # all the processes have written the previous generation, the
+            # older ones are not needed to resume
+            self.comm.Barrier()
+            for itt in self.checkpoint_generations():
+                if itt < self.checkpoint_itt:
+                    os.remove(self.checkpoint_file(itt))
+        self.checkpoint_itt = self.itt
+        self.checkpoint_future = self.checkpoint_writer.submit(
+            self.write_checkpoint, state, self.checkpoint_file(self.itt)
+        )
+
+    # ---------------------------------------------−---------
+    # the file is written at once, a pre-empted write leaves the last one
+    def write_checkpoint(self, state, path):
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **state)
+        os.replace(path + ".tmp", path)
+
+    # ---------------------------------------------−---------
+    # restore the state written by save_checkpoint in path, returns the flat map
+    def load_checkpoint(self, path):
+        bk = self.operation.backend
+
+        def device(v):
+            if v.ndim == 0:
+                return float(v)
+            return bk.bk_cast(v)
+
+        with np.load(path) as state:
+            if str(state["optimizer"]) != self.optimizer:
+                raise ValueError(
+                    "%s was written by the optimizer '%s'" % (path, state["optimizer"])
+                )
+            self.nit = int(state["nit"])
+            self.bias_iteration = int(state["bias_iteration"])
+            self.itt = int(state["itt"])
+            self.nlog = state["history"].shape[0]
+            self.history = np.zeros([max(10, 2 * self.nlog)])
+            self.history[0 : self.nlog] = state["history"]
+            self.l_log[:] = state["l_log"]
+            self.ltot = state["ltot"]
+            self.eta = float(state["eta"])
+            self.pbeta1, self.pbeta2 = [float(v) for v in state["pbeta"]]
+            self.m_dw = device(state["m_dw"])
+            self.v_dw = device(state["v_dw"])
+            np.random.set_state(
+                (
+                    "MT19937",
+                    state["rng_keys"],
+                    int(state["rng_pos"]),
+                    int(state["rng_gauss"][0]),
+                    float(state["rng_gauss"][1]),
+                )
+            )
+            self.lbfgs_mem = [
+                [bk.bk_cast(v) for v in state["lbfgs_s"]],
+                [bk.bk_cast(v) for v in state["lbfgs_y"]],
+                [float(v) for v in state["lbfgs_rho"]],
+            ]
+            if "g" in state:
+                self.resume_grad = (float(state["l_tot"]), bk.bk_cast(state["g"]))
+            if "x_snap" in state:
+                self.x_snap = bk.bk_cast(state["x_snap"])
+                self.g_snap = bk.bk_cast(state["g_snap"])
+
+            if self.optimizer == "scipy":
+                return state["x"].astype("float64")
+            return bk.bk_cast(state["x"])
+
     # ---------------------------------------------−---------
     def xtractmap(self, x, axis):
         x = self.operation.backend.bk_reshape(x, self.oshape)
@@ -313,8 +722,32 @@ class Synthesis:
         totalsz=1,
         do_lbfgs=True,
         axis=0,
+        optimizer=None,
+        nsample=None,
+        svrg=None,
+        nthread=1,
+        mpi_float32=False,
+        mpi_nreduce=1,
+        checkpoint=None,
+        checkpoint_freq=100,
+        resume=False,
     ):
 
+        # 'scipy' (default): fmin_l_bfgs_b on numpy float64 copies of the map,
+        # 'lbfgs' or 'adam': the map, gradient and history stay on the device
+        if optimizer is None:
+            optimizer = "scipy"
+        if optimizer not in ["scipy", "lbfgs", "adam"]:
+            raise ValueError(
+                "optimizer should be 'scipy', 'lbfgs' or 'adam', not '%s'" % (optimizer)
+            )
+        # stochastic synthesis: each step computes nsample of the
+        # totalsz//batchsz batch steps, the line searches need exact losses
+        if nsample is not None and optimizer != "adam":
+            raise ValueError("nsample works with optimizer='adam'")
+        if svrg is not None and nsample is None:
+            raise ValueError("svrg needs nsample")
+
         self.KEEP_TRACK = KEEP_TRACK
         self.track = {}
         self.ntrack = 0
@@ -331,7 +764,15 @@ class Synthesis:
         self.SHOWGPU = SHOWGPU
         self.axis = axis
         self.in_x_nshape = in_x.shape[0]
+        # the losses and batch steps are computed by nthread threads, the
+        # backends release the GIL in their kernels. The scattering operators
+        # build their lazy state under their lock.
+        self.executor = None
+        self.warm = False
+        if nthread > 1:
+            self.executor = ThreadPoolExecutor(max_workers=nthread)
         self.seed = 1234
+        self.reset_adam()
 
         np.random.seed(self.mpi_rank * 7 + 1234)
 
@@ -345,6 +786,11 @@ class Synthesis:
             comm = MPI.COMM_WORLD
             self.comm = comm
             self.MPI = MPI
+            # gradients and losses summed over the processes in this type, in
+            # mpi_nreduce packed buffers per gradient
+            self.mpi_type = "float32" if mpi_float32 else "float64"
+            self.mpi_nreduce = mpi_nreduce
+            self.grad_complex = False
             if self.mpi_rank == 0:
                 print("Work with MPI")
                 sys.stdout.flush()
@@ -391,10 +837,15 @@ class Synthesis:
 
         self.oshape = list(x.shape)
 
-        if not isinstance(x, np.ndarray):
-            x = self.to_numpy(x)
+        if optimizer == "scipy":
+            if not isinstance(x, np.ndarray):
+                x = self.to_numpy(x)
 
-        x = x.flatten()
+            x = x.flatten()
+        else:
+            x = self.operation.backend.bk_reshape(
+                self.operation.backend.bk_cast(x), [-1]
+            )
 
         self.do_all_noise = False
 
@@ -402,30 +853,74 @@ class Synthesis:
 
         self.noise_idx = None
 
+        # state written in checkpoint every checkpoint_freq iterations, with
+        # resume the run restarts from it if it exists. With MPI, the files of
+        # the previous generation are kept until all the processes have
+        # written the next one.
+        self.optimizer = optimizer
+        self.checkpoint = checkpoint
+        self.checkpoint_freq = checkpoint_freq
+        self.checkpoint_writer = None
+        self.checkpoint_future = None
+        self.checkpoint_itt = 0
+        self.nit = 0
+        self.bias_iteration = 0
+        self.lbfgs_mem = [[], [], []]
+        self.resume_grad = None
+        self.x_snap = None
+        resumed = False
+        if checkpoint is not None:
+            self.checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+            path = self.resume_file() if resume else None
+            if path is not None:
+                x = self.load_checkpoint(path)
+                resumed = True
+
         # for k in range(self.number_of_loss):
         #    if self.loss_class[k].batch is not None:
         #        l_batch = self.loss_class[k].batch(
         #            self.loss_class[k].batch_data, 0, init=True
         #        )
 
-        l_tot, g_tot = self.calc_grad(x)
+        if optimizer == "scipy" and not resumed:
+            l_tot, g_tot = self.calc_grad(x)
 
-        self.info_back(x)
+            self.info_back(x)
 
         maxitt = NUM_EPOCHS
 
         #        start_x = x.copy()
 
-        for iteration in range(NUM_STEP_BIAS):
-
-            x, loss, i = opt.fmin_l_bfgs_b(
-                self.calc_grad,
-                x.astype("float64"),
-                callback=self.info_back,
-                pgtol=1e-32,
-                factr=factr,
-                maxiter=maxitt,
-            )
+        if resumed and self.bias_iteration > 0:
+            # the bias data of the previous steps, from the resumed map
+            omap = self.xtractmap(x, axis)
+            for k in range(self.number_of_loss):
+                if self.loss_class[k].batch_update is not None:
+                    self.loss_class[k].batch_update(self.loss_class[k].batch_data, omap)
+
+        for iteration in range(self.bias_iteration, NUM_STEP_BIAS):
+
+            if iteration != self.bias_iteration:
+                # new bias step, the optimizer restarts
+                self.bias_iteration = iteration
+                self.nit = 0
+                self.lbfgs_mem = [[], [], []]
+                self.reset_adam()
+                self.x_snap = None
+
+            if optimizer == "scipy":
+                x, loss, i = opt.fmin_l_bfgs_b(
+                    self.calc_grad,
+                    x.astype("float64"),
+                    callback=self.scipy_callback,
+                    pgtol=1e-32,
+                    factr=factr,
+                    maxiter=max(maxitt - self.nit, 1),
+                )
+            elif optimizer == "lbfgs":
+                x, loss = self.lbfgs(x, maxitt, factr=factr)
+            else:
+                x, loss = self.adam(x, maxitt, nsample=nsample, svrg=svrg)
             print("Final Loss ", loss)
             # update bias input data
             if iteration < NUM_STEP_BIAS - 1:
@@ -445,6 +940,16 @@ class Synthesis:
                     #    )
                 # x=start_x.copy()
 
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+        if self.checkpoint_writer is not None:
+            if self.checkpoint_future is not None:
+                self.checkpoint_future.result()
+            self.checkpoint_writer.shutdown()
+            self.checkpoint_writer = None
+
         if self.mpi_rank == 0 and SHOWGPU:
             self.stop_synthesis()
 
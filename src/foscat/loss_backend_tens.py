@@ -1,4 +1,5 @@
 import sys
+import threading
 
 import tensorflow as tf
 
@@ -10,6 +11,8 @@ class loss_backend:
         self.bk = backend
         self.curr_gpu = curr_gpu
         self.mpi_rank = mpi_rank
+        # the losses may be computed by several threads
+        self.gpu_lock = threading.Lock()
 
     def check_dense(self, data, datasz):
         if isinstance(data, tf.Tensor):
@@ -28,17 +31,19 @@ class loss_backend:
         if len(x.shape) > 1:
             nx = x.shape[0]
 
+        with self.gpu_lock:
+            curr_gpu = self.curr_gpu
+            self.curr_gpu = self.curr_gpu + 1
+
         with tf.device(
-            operation.gpulist[(operation.gpupos + self.curr_gpu) % operation.ngpu]
+            operation.gpulist[(operation.gpupos + curr_gpu) % operation.ngpu]
         ):
             print(
                 "%s Run [PROC=%04d] on GPU %s"
                 % (
                     loss_function.name,
                     self.mpi_rank,
-                    operation.gpulist[
-                        (operation.gpupos + self.curr_gpu) % operation.ngpu
-                    ],
+                    operation.gpulist[(operation.gpupos + curr_gpu) % operation.ngpu],
                 )
             )
             sys.stdout.flush()
@@ -62,7 +67,6 @@ class loss_backend:
 
             g = tf.gradients(l_loss, x)[0]
             g = self.check_dense(g, ndata)
-            self.curr_gpu = self.curr_gpu + 1
 
         if KEEP_TRACK is not None:
             return l_loss, g, linfo
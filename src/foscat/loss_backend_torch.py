@@ -1,3 +1,5 @@
+import threading
+
 import torch
 
 
@@ -8,6 +10,8 @@ class loss_backend:
         self.bk = backend
         self.curr_gpu = curr_gpu
         self.mpi_rank = mpi_rank
+        # the losses may be computed by several threads
+        self.gpu_lock = threading.Lock()
 
     def check_dense(self, data, datasz):
         if isinstance(data, torch.Tensor):
@@ -26,7 +30,10 @@ class loss_backend:
         operation = loss_function.scat_operator
 
         if torch.cuda.is_available():
-            with torch.cuda.device((operation.gpupos + self.curr_gpu) % operation.ngpu):
+            with self.gpu_lock:
+                curr_gpu = self.curr_gpu
+                self.curr_gpu = self.curr_gpu + 1
+            with torch.cuda.device((operation.gpupos + curr_gpu) % operation.ngpu):
 
                 l_x = x.clone().detach().requires_grad_(True)
 
@@ -38,8 +45,6 @@ class loss_backend:
                 l_loss.backward()
 
                 g = l_x.grad
-
-                self.curr_gpu = self.curr_gpu + 1
         else:
             l_x = x.clone().detach().requires_grad_(True)
 
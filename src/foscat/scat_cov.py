@@ -1,3 +1,5 @@
+import hashlib
+import inspect
 import pickle
 import sys
 
@@ -2208,6 +2210,24 @@ class scat_cov:
         )
 
 
+class scat_cov_ref:
+    """
+    Second map of the cross coefficients with its convolutions at all the
+    scales, computed once by funct.prepare_ref and given to funct.eval as
+    image2 so that eval only computes the image1 side.
+    """
+
+    def __init__(self, im, shape, Jmax, cell_ids=None):
+        self.I = im  # map up_graded as in eval [Nbatch, Npix]
+        self.shape = shape  # shape of the map given to prepare_ref
+        self.Jmax = Jmax
+        self.cell_ids = cell_ids
+        self.conv = {}  # I * Psi_j3 [Nbatch, Norient3, Npix_j3]
+        self.MconvPsi = (
+            {}
+        )  # |I * Psi_j2| * Psi_j3 [Nbatch, Norient3, Norient2, Npix_j3]
+
+
 class funct(FOC.FoCUS):
 
     def fill(self, im, nullval=hp.UNSEEN):
@@ -2534,6 +2554,10 @@ class funct(FOC.FoCUS):
         edge=True,
         nside=None,
         cell_ids=None,
+        coefficients=None,
+        S4_criteria=None,
+        nharm=None,
+        imaginary=False,
     ):
         """
         Calculates the scattering correlations for a batch of images. Mean are done over pixels.
@@ -2556,9 +2580,27 @@ class funct(FOC.FoCUS):
         image2: tensor
             Second image. If not None, we compute cross-scattering covariance coefficients.
         mask:
+            None, masks [Nmask, Npix], the MaskPyramid of prepare_mask or, for
+            healpix maps, the list of the masks of all the scales returned by
+            mask_pyramid
         norm: None or str
             If None no normalization is applied, if 'auto' normalize by the reference S2,
             if 'self' normalize by the current S2.
+        coefficients: None or list of str
+            Coefficients to compute among 'S1', 'S2', 'S3' (with S3P) and 'S4',
+            all if None. S0 is always computed, the others are None.
+        S4_criteria: None, str or function
+            Only the S4 coefficients of j1 <= j2 <= j3 satisfying this criteria
+            are computed, e.g. lambda j1, j2: j2 - j1 <= 1. A function is
+            called as S4_criteria(j1, j2) or S4_criteria(j1, j2, j3). A str,
+            kept for the previous versions, is an expression of j1, j2 and j3
+            evaluated without the builtins.
+        nharm: None or int
+            If not None, the orientations are replaced by their nharm first
+            angular harmonics as fft_ang does, the orientation of the second
+            modulus of S4 is contracted before the mean over the pixels.
+        imaginary: bool
+            As in fft_ang, the sine harmonics are also computed if True
         Returns
         -------
         S1, S2, S3, S4 normalized
@@ -2566,6 +2608,34 @@ class funct(FOC.FoCUS):
 
         return_data = self.return_data
 
+        if coefficients is None:
+            coefficients = ["S1", "S2", "S3", "S4"]
+        for name in coefficients:
+            if name not in ["S1", "S2", "S3", "S4"]:
+                raise ValueError("Unknown coefficient %s" % (name))
+        do_S1 = "S1" in coefficients
+        do_S2 = "S2" in coefficients
+        do_S3 = "S3" in coefficients
+        do_S4 = "S4" in coefficients
+        select_S4 = self._S4_selector(S4_criteria)
+        # the modulus of all the scales are kept for S3 and S4
+        keep_M = do_S3 or do_S4
+
+        if nharm is not None:
+            if calc_var or return_data or self.use_1D:
+                raise ValueError(
+                    "nharm works on the means of healpix maps and 2D images"
+                )
+            self.backend.calc_fft_orient(self.NORIENT, nharm, imaginary)
+            fft_orient = (self.NORIENT, nharm, imaginary)
+        else:
+            fft_orient = None
+
+        # image2 side precomputed by prepare_ref
+        ref = image2 if isinstance(image2, scat_cov_ref) else None
+        # masks of all the scales precomputed by prepare_mask
+        prepared_mask = isinstance(mask, FOC.MaskPyramid)
+
         # Check input consistency
         if image2 is not None:
             if list(image1.shape) != list(image2.shape):
@@ -2573,7 +2643,7 @@ class funct(FOC.FoCUS):
                     "The two input image should have the same size to eval Scattering Covariance"
                 )
                 return None
-        if mask is not None:
+        if mask is not None and not isinstance(mask, list):
             if self.use_2D:
                 if (
                     image1.shape[-2] != mask.shape[1]
@@ -2614,12 +2684,12 @@ class funct(FOC.FoCUS):
         im_shape = image1.shape
         if self.use_2D:
             if len(image1.shape) == 2:
-                nside = np.min([im_shape[0], im_shape[1]])
+                nside = min(im_shape[0], im_shape[1])
                 npix = im_shape[0] * im_shape[1]  # Number of pixels
                 x1 = im_shape[0]
                 x2 = im_shape[1]
             else:
-                nside = np.min([im_shape[1], im_shape[2]])
+                nside = min(im_shape[1], im_shape[2])
                 npix = im_shape[1] * im_shape[2]  # Number of pixels
                 x1 = im_shape[1]
                 x2 = im_shape[2]
@@ -2651,6 +2721,19 @@ class funct(FOC.FoCUS):
             J -= 1
         if Jmax is None:
             Jmax = J  # Number of steps for the loop on scales
+        if ref is not None and (
+            Jmax > ref.Jmax or (cell_ids is None) != (ref.cell_ids is None)
+        ):
+            raise ValueError("eval needs a reference prepared for Jmax=%d" % (Jmax))
+        if prepared_mask and (
+            Jmax > mask.Jmax
+            or (cell_ids is None) != (mask.cell_ids is None)
+            or ((self.use_2D or self.use_1D) and edge != mask.edge)
+        ):
+            raise ValueError(
+                "eval needs a mask pyramid prepared for Jmax=%d and edge=%s"
+                % (Jmax, edge)
+            )
         if Jmax > J:
             print("==========\n\n")
             print(
@@ -2663,16 +2746,24 @@ class funct(FOC.FoCUS):
             I1 = self.backend.bk_cast(
                 self.backend.bk_expand_dims(image1, 0)
             )  # Local image1 [Nbatch, Npix]
-            if cross:
+            if cross and ref is None:
                 I2 = self.backend.bk_cast(
                     self.backend.bk_expand_dims(image2, 0)
                 )  # Local image2 [Nbatch, Npix]
         else:
             I1 = self.backend.bk_cast(image1)  # Local image1 [Nbatch, Npix]
-            if cross:
+            if cross and ref is None:
                 I2 = self.backend.bk_cast(image2)  # Local image2 [Nbatch, Npix]
 
-        if mask is None:
+        if not self.use_2D and not self.use_1D:
+            # masks of all the scales, None for the full sky
+            mask_pyramid = self.mask_pyramid(mask, nside, Jmax, cell_ids=cell_ids)
+            vmask = mask_pyramid[0]  # [Nmask, Npix]
+        elif prepared_mask:
+            # up_graded and trimmed at all the scales by prepare_mask
+            mask_pyramid = mask.masks
+            vmask = mask.mask0
+        elif mask is None:
             if self.use_2D:
                 vmask = self.backend.bk_ones([1, x1, x2], dtype=self.all_type)
             else:
@@ -2694,15 +2785,15 @@ class funct(FOC.FoCUS):
                         I2, I2.shape[axis] * 2, axis=axis, nouty=I2.shape[axis + 1] * 2
                     )
             elif self.use_1D:
-                vmask = self.up_grade(vmask, I1.shape[axis] * 2, axis=1)
+                if not prepared_mask:
+                    vmask = self.up_grade(vmask, I1.shape[axis] * 2, axis=1)
                 I1 = self.up_grade(I1, I1.shape[axis] * 2, axis=axis)
                 if cross:
                     I2 = self.up_grade(I2, I2.shape[axis] * 2, axis=axis)
                 nside = nside * 2
             else:
                 I1 = self.up_grade(I1, nside * 2, axis=axis)
-                vmask = self.up_grade(vmask, nside * 2, axis=1)
-                if cross:
+                if cross and ref is None:
                     I2 = self.up_grade(I2, nside * 2, axis=axis)
 
                 nside = nside * 2
@@ -2724,21 +2815,32 @@ class funct(FOC.FoCUS):
                             nouty=I2.shape[axis + 1] * 2,
                         )
                 elif self.use_1D:
-                    vmask = self.up_grade(vmask, I1.shape[axis] * 2, axis=1)
+                    if not prepared_mask:
+                        vmask = self.up_grade(vmask, I1.shape[axis] * 2, axis=1)
                     I1 = self.up_grade(I1, I1.shape[axis] * 2, axis=axis)
                     if cross:
                         I2 = self.up_grade(I2, I2.shape[axis] * 2, axis=axis)
                     nside = nside * 2
                 else:
                     I1 = self.up_grade(I1, nside * 2, axis=axis)
-                    vmask = self.up_grade(vmask, nside * 2, axis=1)
-                    if cross:
+                    if cross and ref is None:
                         I2 = self.up_grade(I2, nside * 2, axis=axis)
                     nside = nside * 2
 
+        if ref is not None:
+            # already up_graded by prepare_ref
+            I2 = ref.I
+
         # Normalize the masks because they have different pixel numbers
         # vmask /= self.backend.bk_reduce_sum(vmask, axis=1)[:, None]  # [Nmask, Npix]
 
+        # the means over several masks are reshaped from [..., Nmask] and mix
+        # up the orientations of S4, the harmonics of M2 are then computed
+        # after the mean
+        fft_M2 = None
+        if fft_orient is not None and (vmask is None or vmask.shape[0] == 1):
+            fft_M2 = fft_orient
+
         ### INITIALIZATION
         # Coefficients
         if return_data:
@@ -2809,33 +2911,25 @@ class funct(FOC.FoCUS):
 
         cell_ids_j3 = cell_ids
 
+        # healpix maps are convolved and smoothed for the next scale in one pass
+        fuse_smooth = not self.use_2D and not self.use_1D and keep_M
+
         for j3 in range(Jmax):
 
-            if edge:
-                if self.mask_mask is None:
-                    self.mask_mask = {}
-                if self.use_2D:
-                    if (vmask.shape[1], vmask.shape[2]) not in self.mask_mask:
-                        mask_mask = np.zeros([1, vmask.shape[1], vmask.shape[2]])
-                        mask_mask[
-                            0,
-                            self.KERNELSZ // 2 : -self.KERNELSZ // 2 + 1,
-                            self.KERNELSZ // 2 : -self.KERNELSZ // 2 + 1,
-                        ] = 1.0
-                        self.mask_mask[(vmask.shape[1], vmask.shape[2])] = (
-                            self.backend.bk_cast(mask_mask)
-                        )
-                    vmask = vmask * self.mask_mask[(vmask.shape[1], vmask.shape[2])]
-                    # print(self.KERNELSZ//2,vmask,mask_mask)
-
-                if self.use_1D:
-                    if (vmask.shape[1]) not in self.mask_mask:
-                        mask_mask = np.zeros([1, vmask.shape[1]])
-                        mask_mask[0, self.KERNELSZ // 2 : -self.KERNELSZ // 2 + 1] = 1.0
-                        self.mask_mask[(vmask.shape[1])] = self.backend.bk_cast(
-                            mask_mask
-                        )
-                    vmask = vmask * self.mask_mask[(vmask.shape[1])]
+            # smoothed maps of the next scale computed with the convolutions
+            I1_smooth = None
+            I2_smooth = None
+            if fuse_smooth and j3 != Jmax - 1:
+                M1_smooth_dic = {}
+                M2_smooth_dic = {} if ref is None else None
+            else:
+                M1_smooth_dic = None
+                M2_smooth_dic = None
+
+            if prepared_mask:
+                vmask = mask_pyramid[j3]
+            elif edge and (self.use_2D or self.use_1D):
+                vmask = self.edge_mask(vmask)
 
             if return_data:
                 S3[j3] = None
@@ -2847,9 +2941,14 @@ class funct(FOC.FoCUS):
 
             ####### S1 and S2
             ### Make the convolution I1 * Psi_j3
-            conv1 = self.convol(
-                I1, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
-            )  # [Nbatch, Norient3 , Npix_j3]
+            if M1_smooth_dic is not None:
+                conv1, I1_smooth = self.convol_smooth(
+                    I1, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                )  # [Nbatch, Norient3 , Npix_j3]
+            else:
+                conv1 = self.convol(
+                    I1, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                )  # [Nbatch, Norient3 , Npix_j3]
 
             if cmat is not None:
 
@@ -2870,7 +2969,8 @@ class funct(FOC.FoCUS):
 
             M1 = self.backend.bk_L1(M1_square)  # [Nbatch, Npix_j3, Norient3]
             # Store M1_j3 in a dictionary
-            M1_dic[j3] = M1
+            if keep_M:
+                M1_dic[j3] = M1
 
             if not cross:  # Auto
                 M1_square = self.backend.bk_real(M1_square)
@@ -2879,7 +2979,7 @@ class funct(FOC.FoCUS):
                 # Apply the mask [Nmask, Npix_j3] and average over pixels
                 if return_data:
                     s2 = M1_square
-                else:
+                elif do_S2 or cond_init_P1_dic:
                     if calc_var:
                         s2, vs2 = self.masked_mean(
                             M1_square, vmask, axis=2, rank=j3, calc_var=True
@@ -2892,84 +2992,93 @@ class funct(FOC.FoCUS):
                     P1_dic[j3] = self.backend.bk_real(s2)  # [Nbatch, Nmask, Norient3]
 
                 # We store S2_auto to return it [Nbatch, Nmask, NS2, Norient3]
-                if return_data:
-                    if S2 is None:
-                        S2 = {}
-                    if out_nside is not None and out_nside < nside_j3:
-                        s2 = self.backend.bk_reduce_mean(
-                            self.backend.bk_reshape(
-                                s2,
-                                [
-                                    s2.shape[0],
-                                    s2.shape[2],
-                                    12 * out_nside**2,
-                                    (nside_j3 // out_nside) ** 2,
-                                ],
-                            ),
-                            2,
-                        )
-                    S2[j3] = s2
-                else:
-                    if norm == "auto":  # Normalize S2
-                        s2 /= P1_dic[j3]
+                if do_S2:
+                    if return_data:
+                        if S2 is None:
+                            S2 = {}
+                        if out_nside is not None and out_nside < nside_j3:
+                            s2 = self.backend.bk_reduce_mean(
+                                self.backend.bk_reshape(
+                                    s2,
+                                    [
+                                        s2.shape[0],
+                                        s2.shape[2],
+                                        12 * out_nside**2,
+                                        (nside_j3 // out_nside) ** 2,
+                                    ],
+                                ),
+                                2,
+                            )
+                        S2[j3] = s2
+                    else:
+                        if norm == "auto":  # Normalize S2
+                            s2 /= P1_dic[j3]
 
-                    S2.append(
-                        self.backend.bk_expand_dims(s2, off_S2)
-                    )  # Add a dimension for NS2
-                    if calc_var:
-                        VS2.append(
-                            self.backend.bk_expand_dims(vs2, off_S2)
+                        S2.append(
+                            self.backend.bk_expand_dims(s2, off_S2)
                         )  # Add a dimension for NS2
+                        if calc_var:
+                            VS2.append(
+                                self.backend.bk_expand_dims(vs2, off_S2)
+                            )  # Add a dimension for NS2
 
-                #### S1_auto computation
-                ### Image 1 : S1 = < M1 >_pix
-                # Apply the mask [Nmask, Npix_j3] and average over pixels
-                if return_data:
-                    s1 = M1
-                else:
-                    if calc_var:
-                        s1, vs1 = self.masked_mean(
-                            M1, vmask, axis=2, rank=j3, calc_var=True
-                        )  # [Nbatch, Nmask, Norient3]
+                if do_S1:
+                    #### S1_auto computation
+                    ### Image 1 : S1 = < M1 >_pix
+                    # Apply the mask [Nmask, Npix_j3] and average over pixels
+                    if return_data:
+                        s1 = M1
                     else:
-                        s1 = self.masked_mean(
-                            M1, vmask, axis=2, rank=j3
-                        )  # [Nbatch, Nmask, Norient3]
+                        if calc_var:
+                            s1, vs1 = self.masked_mean(
+                                M1, vmask, axis=2, rank=j3, calc_var=True
+                            )  # [Nbatch, Nmask, Norient3]
+                        else:
+                            s1 = self.masked_mean(
+                                M1, vmask, axis=2, rank=j3
+                            )  # [Nbatch, Nmask, Norient3]
 
-                if return_data:
-                    if out_nside is not None and out_nside < nside_j3:
-                        s1 = self.backend.bk_reduce_mean(
-                            self.backend.bk_reshape(
-                                s1,
-                                [
-                                    s1.shape[0],
-                                    s1.shape[2],
-                                    12 * out_nside**2,
-                                    (nside_j3 // out_nside) ** 2,
-                                ],
-                            ),
-                            2,
-                        )
-                    S1[j3] = s1
-                else:
-                    ### Normalize S1
-                    if norm is not None:
-                        self.div_norm(s1, (P1_dic[j3]) ** 0.5)
-                    ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
-                    S1.append(
-                        self.backend.bk_expand_dims(s1, off_S2)
-                    )  # Add a dimension for NS1
-                    if calc_var:
-                        VS1.append(
-                            self.backend.bk_expand_dims(vs1, off_S2)
+                    if return_data:
+                        if out_nside is not None and out_nside < nside_j3:
+                            s1 = self.backend.bk_reduce_mean(
+                                self.backend.bk_reshape(
+                                    s1,
+                                    [
+                                        s1.shape[0],
+                                        s1.shape[2],
+                                        12 * out_nside**2,
+                                        (nside_j3 // out_nside) ** 2,
+                                    ],
+                                ),
+                                2,
+                            )
+                        S1[j3] = s1
+                    else:
+                        ### Normalize S1
+                        if norm is not None:
+                            self.div_norm(s1, (P1_dic[j3]) ** 0.5)
+                        ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
+                        S1.append(
+                            self.backend.bk_expand_dims(s1, off_S2)
                         )  # Add a dimension for NS1
+                        if calc_var:
+                            VS1.append(
+                                self.backend.bk_expand_dims(vs1, off_S2)
+                            )  # Add a dimension for NS1
 
             else:  # Cross
                 ### Make the convolution I2 * Psi_j3
-                conv2 = self.convol(
-                    I2, axis=2, cell_ids=cell_ids_j3, nside=nside_j3
-                )  # [Nbatch, Npix_j3, Norient3]
-                if cmat is not None:
+                if ref is not None:
+                    conv2 = ref.conv[j3]  # cmat already applied
+                elif M2_smooth_dic is not None:
+                    conv2, I2_smooth = self.convol_smooth(
+                        I2, axis=2, cell_ids=cell_ids_j3, nside=nside_j3
+                    )  # [Nbatch, Npix_j3, Norient3]
+                else:
+                    conv2 = self.convol(
+                        I2, axis=2, cell_ids=cell_ids_j3, nside=nside_j3
+                    )  # [Nbatch, Npix_j3, Norient3]
+                if cmat is not None and ref is None:
                     tmp2 = self.backend.bk_repeat(conv2, self.NORIENT, axis=-2)
                     conv2 = self.backend.bk_reduce_sum(
                         self.backend.bk_reshape(
@@ -2989,7 +3098,8 @@ class funct(FOC.FoCUS):
                 )  # [Nbatch, Npix_j3, Norient3]
                 M2 = self.backend.bk_L1(M2_square)  # [Nbatch, Npix_j3, Norient3]
                 # Store M2_j3 in a dictionary
-                M2_dic[j3] = M2
+                if keep_M and ref is None:
+                    M2_dic[j3] = M2
 
                 ### S2_auto = < M2^2 >_pix
                 # Not returned, only for normalization
@@ -3017,110 +3127,121 @@ class funct(FOC.FoCUS):
                     P1_dic[j3] = self.backend.bk_real(p1)  # [Nbatch, Nmask, Norient3]
                     P2_dic[j3] = self.backend.bk_real(p2)  # [Nbatch, Nmask, Norient3]
 
-                ### S2_cross = < (I1 * Psi_j3) (I2 * Psi_j3)^* >_pix
-                # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
-                s2 = conv1 * self.backend.bk_conjugate(conv2)
-                MX = self.backend.bk_L1(s2)
-                # Apply the mask [Nmask, Npix_j3] and average over pixels
-                if return_data:
-                    s2 = s2
-                else:
-                    if calc_var:
-                        s2, vs2 = self.masked_mean(
-                            s2, vmask, axis=2, rank=j3, calc_var=True
-                        )
-                    else:
-                        s2 = self.masked_mean(s2, vmask, axis=2, rank=j3)
-
-                if return_data:
-                    if out_nside is not None and out_nside < nside_j3:
-                        s2 = self.backend.bk_reduce_mean(
-                            self.backend.bk_reshape(
-                                s2,
-                                [
-                                    s2.shape[0],
-                                    s2.shape[2],
-                                    12 * out_nside**2,
-                                    (nside_j3 // out_nside) ** 2,
-                                ],
-                            ),
-                            2,
-                        )
-                    S2[j3] = s2
-                else:
+                if do_S1 or do_S2:
+                    ### S2_cross = < (I1 * Psi_j3) (I2 * Psi_j3)^* >_pix
+                    # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
+                    s2 = conv1 * self.backend.bk_conjugate(conv2)
+                    MX = self.backend.bk_L1(s2)
+                    if do_S2:
+                        # Apply the mask [Nmask, Npix_j3] and average over pixels
+                        if return_data:
+                            s2 = s2
+                        else:
+                            if calc_var:
+                                s2, vs2 = self.masked_mean(
+                                    s2, vmask, axis=2, rank=j3, calc_var=True
+                                )
+                            else:
+                                s2 = self.masked_mean(s2, vmask, axis=2, rank=j3)
 
-                    ### Store S2_cross as complex [Nbatch, Nmask, NS2, Norient3]
-                    s2 = self.backend.bk_real(s2)
+                        if return_data:
+                            if out_nside is not None and out_nside < nside_j3:
+                                s2 = self.backend.bk_reduce_mean(
+                                    self.backend.bk_reshape(
+                                        s2,
+                                        [
+                                            s2.shape[0],
+                                            s2.shape[2],
+                                            12 * out_nside**2,
+                                            (nside_j3 // out_nside) ** 2,
+                                        ],
+                                    ),
+                                    2,
+                                )
+                            S2[j3] = s2
+                        else:
 
-                    ### Normalize S2_cross
-                    if norm == "auto":
-                        s2 /= (P1_dic[j3] * P2_dic[j3]) ** 0.5
+                            ### Store S2_cross as complex [Nbatch, Nmask, NS2, Norient3]
+                            s2 = self.backend.bk_real(s2)
 
-                    S2.append(
-                        self.backend.bk_expand_dims(s2, off_S2)
-                    )  # Add a dimension for NS2
-                    if calc_var:
-                        VS2.append(
-                            self.backend.bk_expand_dims(vs2, off_S2)
-                        )  # Add a dimension for NS2
+                            ### Normalize S2_cross
+                            if norm == "auto":
+                                s2 /= (P1_dic[j3] * P2_dic[j3]) ** 0.5
 
-                #### S1_auto computation
-                ### Image 1 : S1 = < M1 >_pix
-                # Apply the mask [Nmask, Npix_j3] and average over pixels
-                if return_data:
-                    s1 = MX
-                else:
-                    if calc_var:
-                        s1, vs1 = self.masked_mean(
-                            MX, vmask, axis=2, rank=j3, calc_var=True
-                        )  # [Nbatch, Nmask, Norient3]
-                    else:
-                        s1 = self.masked_mean(
-                            MX, vmask, axis=2, rank=j3
-                        )  # [Nbatch, Nmask, Norient3]
-                if return_data:
-                    if out_nside is not None and out_nside < nside_j3:
-                        s1 = self.backend.bk_reduce_mean(
-                            self.backend.bk_reshape(
-                                s1,
-                                [
-                                    s1.shape[0],
-                                    s1.shape[2],
-                                    12 * out_nside**2,
-                                    (nside_j3 // out_nside) ** 2,
-                                ],
-                            ),
-                            2,
-                        )
-                    S1[j3] = s1
-                else:
-                    ### Normalize S1
-                    if norm is not None:
-                        self.div_norm(s1, (P1_dic[j3]) ** 0.5)
-                    ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
-                    S1.append(
-                        self.backend.bk_expand_dims(s1, off_S2)
-                    )  # Add a dimension for NS1
-                    if calc_var:
-                        VS1.append(
-                            self.backend.bk_expand_dims(vs1, off_S2)
-                        )  # Add a dimension for NS1
+                            S2.append(
+                                self.backend.bk_expand_dims(s2, off_S2)
+                            )  # Add a dimension for NS2
+                            if calc_var:
+                                VS2.append(
+                                    self.backend.bk_expand_dims(vs2, off_S2)
+                                )  # Add a dimension for NS2
+
+                    if do_S1:
+                        #### S1_auto computation
+                        ### Image 1 : S1 = < M1 >_pix
+                        # Apply the mask [Nmask, Npix_j3] and average over pixels
+                        if return_data:
+                            s1 = MX
+                        else:
+                            if calc_var:
+                                s1, vs1 = self.masked_mean(
+                                    MX, vmask, axis=2, rank=j3, calc_var=True
+                                )  # [Nbatch, Nmask, Norient3]
+                            else:
+                                s1 = self.masked_mean(
+                                    MX, vmask, axis=2, rank=j3
+                                )  # [Nbatch, Nmask, Norient3]
+                        if return_data:
+                            if out_nside is not None and out_nside < nside_j3:
+                                s1 = self.backend.bk_reduce_mean(
+                                    self.backend.bk_reshape(
+                                        s1,
+                                        [
+                                            s1.shape[0],
+                                            s1.shape[2],
+                                            12 * out_nside**2,
+                                            (nside_j3 // out_nside) ** 2,
+                                        ],
+                                    ),
+                                    2,
+                                )
+                            S1[j3] = s1
+                        else:
+                            ### Normalize S1
+                            if norm is not None:
+                                self.div_norm(s1, (P1_dic[j3]) ** 0.5)
+                            ### We store S1 for image1  [Nbatch, Nmask, NS1, Norient3]
+                            S1.append(
+                                self.backend.bk_expand_dims(s1, off_S2)
+                            )  # Add a dimension for NS1
+                            if calc_var:
+                                VS1.append(
+                                    self.backend.bk_expand_dims(vs1, off_S2)
+                                )  # Add a dimension for NS1
 
             # Initialize dictionaries for |I1*Psi_j| * Psi_j3
             M1convPsi_dic = {}
+            # harmonics of the M2 of S4, computed once for all the j1
+            fft_M2_dic = {}
             if cross:
                 # Initialize dictionaries for |I2*Psi_j| * Psi_j3
                 M2convPsi_dic = {}
+                if ref is not None and keep_M:
+                    M2convPsi_dic.update(ref.MconvPsi[j3])
 
             ###### S3
-            for j2 in range(0, j3 + 1):  # j2 <= j3
+            # no loop on j2 without S3 and S4
+            for j2 in range(0, j3 + 1 if keep_M else 0):  # j2 <= j3
                 if return_data:
                     if S4[j3] is None:
                         S4[j3] = {}
                     S4[j3][j2] = None
 
                 ### S3_auto = < (I1 * Psi)_j3 x (|I1 * Psi_j2| * Psi_j3)^* >_pix
-                if not cross:
+                if not do_S3:
+                    # the M_j2 * Psi_j3 are computed by S4 when needed
+                    pass
+                elif not cross:
                     if calc_var:
                         s3, vs3 = self._compute_S3(
                             j2,
@@ -3129,6 +3250,7 @@ class funct(FOC.FoCUS):
                             vmask,
                             M1_dic,
                             M1convPsi_dic,
+                            M_smooth_dic=M1_smooth_dic,
                             calc_var=True,
                             cmat2=cmat2,
                             cell_ids=cell_ids_j3,
@@ -3142,6 +3264,7 @@ class funct(FOC.FoCUS):
                             vmask,
                             M1_dic,
                             M1convPsi_dic,
+                            M_smooth_dic=M1_smooth_dic,
                             return_data=return_data,
                             cmat2=cmat2,
                             cell_ids=cell_ids_j3,
@@ -3203,6 +3326,7 @@ class funct(FOC.FoCUS):
                             vmask,
                             M2_dic,
                             M2convPsi_dic,
+                            M_smooth_dic=M2_smooth_dic,
                             calc_var=True,
                             cmat2=cmat2,
                             cell_ids=cell_ids_j3,
@@ -3215,6 +3339,7 @@ class funct(FOC.FoCUS):
                             vmask,
                             M1_dic,
                             M1convPsi_dic,
+                            M_smooth_dic=M1_smooth_dic,
                             calc_var=True,
                             cmat2=cmat2,
                             cell_ids=cell_ids_j3,
@@ -3228,6 +3353,7 @@ class funct(FOC.FoCUS):
                             vmask,
                             M1_dic,
                             M1convPsi_dic,
+                            M_smooth_dic=M1_smooth_dic,
                             return_data=return_data,
                             cmat2=cmat2,
                             cell_ids=cell_ids_j3,
@@ -3240,6 +3366,7 @@ class funct(FOC.FoCUS):
                             vmask,
                             M2_dic,
                             M2convPsi_dic,
+                            M_smooth_dic=M2_smooth_dic,
                             return_data=return_data,
                             cmat2=cmat2,
                             cell_ids=cell_ids_j3,
@@ -3328,6 +3455,32 @@ class funct(FOC.FoCUS):
 
                 ##### S4
                 for j1 in range(0, j2 + 1):  # j1 <= j2
+                    if not do_S4 or not select_S4(j1, j2, j3):
+                        continue
+                    if not do_S3:
+                        # M1_j1 * Psi_j3 and M2_j2 * Psi_j3 not computed by S3
+                        if cross:
+                            l_dic = [
+                                (j1, M1_dic, M1convPsi_dic, M1_smooth_dic),
+                                (j2, M2_dic, M2convPsi_dic, M2_smooth_dic),
+                            ]
+                        else:
+                            l_dic = [
+                                (j1, M1_dic, M1convPsi_dic, M1_smooth_dic),
+                                (j2, M1_dic, M1convPsi_dic, M1_smooth_dic),
+                            ]
+                        for j, M_dic, MconvPsi_dic, M_smooth_dic in l_dic:
+                            if j not in MconvPsi_dic:
+                                self._compute_MconvPsi(
+                                    j,
+                                    j3,
+                                    M_dic,
+                                    MconvPsi_dic,
+                                    cmat2=cmat2,
+                                    cell_ids=cell_ids_j3,
+                                    nside_j2=nside_j3,
+                                    M_smooth_dic=M_smooth_dic,
+                                )
                     ### S4_auto = <(|I1 * psi1| * psi3)(|I1 * psi2| * psi3)^*>
                     if not cross:
                         if calc_var:
@@ -3347,6 +3500,8 @@ class funct(FOC.FoCUS):
                                 M1convPsi_dic,
                                 M2convPsi_dic=None,
                                 return_data=return_data,
+                                fft_orient=fft_M2,
+                                fft_M2_dic=fft_M2_dic,
                             )  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
 
                         if return_data:
@@ -3422,6 +3577,8 @@ class funct(FOC.FoCUS):
                                 M1convPsi_dic,
                                 M2convPsi_dic=M2convPsi_dic,
                                 return_data=return_data,
+                                fft_orient=fft_M2,
+                                fft_M2_dic=fft_M2_dic,
                             )  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
 
                         if return_data:
@@ -3482,43 +3639,58 @@ class funct(FOC.FoCUS):
             ### Image I1,
             # downscale the I1 [Nbatch, Npix_j3]
             if j3 != Jmax - 1:
-                I1 = self.smooth(I1, axis=1, cell_ids=cell_ids_j3, nside=nside_j3)
+                if I1_smooth is None:
+                    I1_smooth = self.smooth(
+                        I1, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                    )
                 I1, new_cell_ids_j3 = self.ud_grade_2(
-                    I1, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                    I1_smooth, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
                 )
 
                 ### Image I2
-                if cross:
-                    I2 = self.smooth(I2, axis=1, cell_ids=cell_ids_j3, nside=nside_j3)
+                if cross and ref is None:
+                    if I2_smooth is None:
+                        I2_smooth = self.smooth(
+                            I2, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                        )
                     I2, new_cell_ids_j3 = self.ud_grade_2(
-                        I2, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                        I2_smooth, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
                     )
 
                 ### Modules
-                for j2 in range(0, j3 + 1):  # j2 =< j3
+                for j2 in range(0, j3 + 1 if keep_M else 0):  # j2 =< j3
                     ### Dictionary M1_dic[j2]
-                    M1_smooth = self.smooth(
-                        M1_dic[j2], axis=2, cell_ids=cell_ids_j3, nside=nside_j3
-                    )  # [Nbatch, Npix_j3, Norient3]
+                    if M1_smooth_dic is not None and j2 in M1_smooth_dic:
+                        M1_smooth = M1_smooth_dic[j2]
+                    else:
+                        M1_smooth = self.smooth(
+                            M1_dic[j2], axis=2, cell_ids=cell_ids_j3, nside=nside_j3
+                        )  # [Nbatch, Npix_j3, Norient3]
                     M1_dic[j2], new_cell_ids_j2 = self.ud_grade_2(
                         M1_smooth, axis=2, cell_ids=cell_ids_j3, nside=nside_j3
                     )  # [Nbatch, Npix_j3, Norient3]
 
                     ### Dictionary M2_dic[j2]
-                    if cross:
-                        M2_smooth = self.smooth(
-                            M2_dic[j2], axis=2, cell_ids=cell_ids_j3, nside=nside_j3
-                        )  # [Nbatch, Npix_j3, Norient3]
+                    if cross and ref is None:
+                        if M2_smooth_dic is not None and j2 in M2_smooth_dic:
+                            M2_smooth = M2_smooth_dic[j2]
+                        else:
+                            M2_smooth = self.smooth(
+                                M2_dic[j2], axis=2, cell_ids=cell_ids_j3, nside=nside_j3
+                            )  # [Nbatch, Npix_j3, Norient3]
                         M2_dic[j2], new_cell_ids_j2 = self.ud_grade_2(
                             M2_smooth, axis=2, cell_ids=cell_ids_j3, nside=nside_j3
                         )  # [Nbatch, Npix_j3, Norient3]
                 ### Mask
-                vmask, new_cell_ids_j3 = self.ud_grade_2(
-                    vmask, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
-                )
+                if not self.use_2D and not self.use_1D:
+                    vmask = mask_pyramid[j3 + 1]
+                elif not prepared_mask:
+                    vmask, new_cell_ids_j3 = self.ud_grade_2(
+                        vmask, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                    )
 
-                if self.mask_thres is not None:
-                    vmask = self.backend.bk_threshold(vmask, self.mask_thres)
+                    if self.mask_thres is not None:
+                        vmask = self.backend.bk_threshold(vmask, self.mask_thres)
 
                 ### NSIDE_j3
                 nside_j3 = nside_j3 // 2
@@ -3543,19 +3715,42 @@ class funct(FOC.FoCUS):
         return self.backend.bk_concat(Sout, 2)
         """
         if not return_data:
-            S1 = self.backend.bk_concat(S1, 2)
-            S2 = self.backend.bk_concat(S2, 2)
-            S3 = self.backend.bk_concat(S3, 2)
-            S4 = self.backend.bk_concat(S4, 2)
+
+            def l_concat(x):
+                # None for the coefficients not computed
+                if len(x) == 0:
+                    return None
+                return self.backend.bk_concat(x, 2)
+
+            S1 = l_concat(S1)
+            S2 = l_concat(S2)
+            S3 = l_concat(S3)
+            S4 = l_concat(S4)
             if cross:
-                S3P = self.backend.bk_concat(S3P, 2)
+                S3P = l_concat(S3P)
             if calc_var:
-                VS1 = self.backend.bk_concat(VS1, 2)
-                VS2 = self.backend.bk_concat(VS2, 2)
-                VS3 = self.backend.bk_concat(VS3, 2)
-                VS4 = self.backend.bk_concat(VS4, 2)
+                VS1 = l_concat(VS1)
+                VS2 = l_concat(VS2)
+                VS3 = l_concat(VS3)
+                VS4 = l_concat(VS4)
                 if cross:
-                    VS3P = self.backend.bk_concat(VS3P, 2)
+                    VS3P = l_concat(VS3P)
+            if fft_orient is not None:
+                # the other orientations, after the normalizations
+                S1 = self._fft_orient(S1, fft_orient, -1)
+                S2 = self._fft_orient(S2, fft_orient, -1)
+                for k in [-2, -1]:
+                    S3 = self._fft_orient(S3, fft_orient, k)
+                    if cross:
+                        S3P = self._fft_orient(S3P, fft_orient, k)
+                if fft_M2 is None:
+                    l_axes = [-3, -2, -1]
+                elif self.use_2D:
+                    l_axes = [-3, -1]
+                else:
+                    l_axes = [-2, -1]
+                for k in l_axes:
+                    S4 = self._fft_orient(S4, fft_orient, k)
         if calc_var:
             if not cross:
                 return scat_cov(
@@ -3606,6 +3801,565 @@ class funct(FOC.FoCUS):
                     use_1D=self.use_1D,
                 )
 
+    def prepare_ref(
+        self, image2, Jmax=None, cmat=None, cmat2=None, nside=None, cell_ids=None
+    ):
+        """
+        Computes once the convolutions of a fixed second map of the cross
+        coefficients (e.g. the data of a synthesis or denoising loss).
+        eval(image1, image2=ref) then gives the same coefficients as
+        eval(image1, image2=image2) for any mask and norm, computing only the
+        image1 side.
+        Parameters
+        ----------
+        image2: array
+            Healpix map [Npix] or maps [Nbatch, Npix]
+        Jmax: int
+            Number of scales, the largest Jmax of the eval calls
+        cmat, cmat2:
+            Rotations of the image2 side, eval applies its own to image1
+        nside, cell_ids:
+            As in eval
+        Returns
+        -------
+        scat_cov_ref to give to eval as image2
+        """
+        if self.use_2D or self.use_1D:
+            raise ValueError("prepare_ref works on healpix maps")
+
+        if len(image2.shape) == 1:
+            I2 = self.backend.bk_cast(self.backend.bk_expand_dims(image2, 0))
+        else:
+            I2 = self.backend.bk_cast(image2)
+        if nside is None:
+            nside = int(np.sqrt(image2.shape[-1] // 12))
+        if Jmax is None:
+            Jmax = int(np.log(nside) / np.log(2))
+
+        if self.KERNELSZ > 3 and cell_ids is None:
+            # same binning as eval
+            I2 = self.up_grade(I2, nside * 2, axis=1)
+            nside = nside * 2
+            if self.KERNELSZ > 5:
+                I2 = self.up_grade(I2, nside * 2, axis=1)
+                nside = nside * 2
+
+        ref = scat_cov_ref(I2, list(image2.shape), Jmax, cell_ids=cell_ids)
+
+        M_dic = {}
+        nside_j3 = nside
+        cell_ids_j3 = cell_ids
+        for j3 in range(Jmax):
+            if j3 != Jmax - 1:
+                # smoothed maps of the next scale computed with the convolutions
+                M_smooth_dic = {}
+                conv, I2_smooth = self.convol_smooth(
+                    I2, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                )
+            else:
+                M_smooth_dic = None
+                conv = self.convol(I2, axis=1, cell_ids=cell_ids_j3, nside=nside_j3)
+
+            if cmat is not None:
+                tmp2 = self.backend.bk_repeat(conv, self.NORIENT, axis=-2)
+                conv = self.backend.bk_reduce_sum(
+                    self.backend.bk_reshape(
+                        cmat[j3] * tmp2,
+                        [tmp2.shape[0], self.NORIENT, self.NORIENT, cmat[j3].shape[2]],
+                    ),
+                    1,
+                )
+            ref.conv[j3] = conv  # [Nbatch, Norient3, Npix_j3]
+
+            M_dic[j3] = self.backend.bk_L1(conv * self.backend.bk_conjugate(conv))
+            ref.MconvPsi[j3] = {}
+            for j2 in range(0, j3 + 1):
+                self._compute_MconvPsi(
+                    j2,
+                    j3,
+                    M_dic,
+                    ref.MconvPsi[j3],
+                    cmat2=cmat2,
+                    cell_ids=cell_ids_j3,
+                    nside_j2=nside_j3,
+                    M_smooth_dic=M_smooth_dic,
+                )
+
+            if j3 != Jmax - 1:
+                I2, new_cell_ids_j3 = self.ud_grade_2(
+                    I2_smooth, axis=1, cell_ids=cell_ids_j3, nside=nside_j3
+                )
+                for j2 in range(0, j3 + 1):
+                    M_dic[j2], _ = self.ud_grade_2(
+                        M_smooth_dic[j2], axis=2, cell_ids=cell_ids_j3, nside=nside_j3
+                    )
+                nside_j3 = nside_j3 // 2
+                cell_ids_j3 = new_cell_ids_j3
+
+        return ref
+
+    def eval_memory(self, nside, Jmax=None, cross=False, nmask=1, coefficients=None):
+        """
+        Estimates the peak memory used by eval for each map of the batch.
+        The largest intermediates are kept for all the scales j2<=j3 (the
+        modulus M_j2 and their convolutions M_j2*Psi_j3 used by S3 and S4),
+        the peak is taken over j3 and scaled by a margin for the temporaries
+        of the backend.
+        Parameters
+        ----------
+        nside: int
+            nside of the healpix maps
+        Jmax: int
+            Number of scales, log2(nside) if None
+        cross: bool
+            True if eval gets a second map
+        nmask: int
+            Number of masks
+        coefficients: None or list of str
+            Coefficients computed by eval, all if None
+        Returns
+        -------
+        Number of bytes per map
+        """
+        N = self.NORIENT
+        if Jmax is None:
+            Jmax = int(np.log(nside) / np.log(2))
+        npix = 12 * nside * nside
+        if self.KERNELSZ > 3:
+            # eval up_grades the map
+            npix *= 4
+
+        rbytes = np.dtype(self.all_type).itemsize
+        cbytes = 2 * rbytes
+        ncross = 2 if cross else 1
+        # the modulus are only kept and convolved for S3 and S4
+        keep_M = coefficients is None or "S3" in coefficients or "S4" in coefficients
+        nchan = N if keep_M else 1
+        if self.engine == "stencil":
+            # gather of the neighbours of the real and imaginary parts
+            nconv = 2 * nchan * (self.KERNELSZ**2 + 2 * N)
+        else:
+            nconv = 2 * nchan * 2 * N
+
+        peak = 0
+        for j3 in range(Jmax):
+            # I*Psi_j3 and its modulus
+            nval = ncross * 2 * N + N
+            if keep_M:
+                # M_j2 and M_j2*Psi_j3 for j2<=j3
+                nval += ncross * (j3 + 1) * (N + N * N)
+                # products reduced by the masked means of S3 and S4
+                nval += 2 * N * N * nmask
+            peak = max(peak, (npix // 4**j3) * (nval * cbytes + nconv * rbytes))
+
+        # input maps, masks and backend temporaries
+        return int(1.5 * (peak + 4 * ncross * npix * rbytes))
+
+    def eval_many(
+        self,
+        image1,
+        image2=None,
+        mask=None,
+        norm=None,
+        calc_var=False,
+        Jmax=None,
+        memory_budget=None,
+        batch_size=None,
+        coefficients=None,
+        S4_criteria=None,
+    ):
+        """
+        Calculates the scattering correlations of a large number of healpix
+        maps. The maps are evaluated by micro-batches sized so that the
+        memory used by eval stays in memory_budget, the results are
+        concatenated along the batch axis.
+        Parameters
+        ----------
+        image1: array
+            Healpix maps [Nmaps, Npix], can be memory mapped
+        image2: array
+            Second maps. If not None, we compute cross-scattering covariance coefficients.
+        mask: array
+            None or masks [Nmask, Npix]
+        norm: None or str
+            As in eval, 'auto' needs the reference S2 already stored by eval
+        calc_var: bool
+            As in eval
+        Jmax: int
+            Number of scales
+        memory_budget: int
+            Bytes eval can use, 80% of the free memory of the device if None
+        batch_size: int
+            Size of the micro-batches, computed from memory_budget if None
+        coefficients, S4_criteria:
+            Selection of the coefficients, as in eval
+        Returns
+        -------
+        S1, S2, S3, S4 of the Nmaps maps, as eval
+        """
+        if self.use_2D or self.use_1D:
+            raise ValueError("eval_many works on healpix maps")
+        if self.return_data:
+            raise ValueError("eval_many does not work with return_data")
+        if norm == "auto" and self.P1_dic is None:
+            # the reference would be the S2 of the first micro-batch
+            raise ValueError("eval_many needs the reference S2 of norm='auto'")
+
+        nmaps = image1.shape[0]
+        if batch_size is None:
+            nside = int(np.sqrt(image1.shape[-1] // 12))
+            nmask = 1 if mask is None else mask.shape[0]
+            per_map = self.eval_memory(
+                nside,
+                Jmax=Jmax,
+                cross=image2 is not None,
+                nmask=nmask,
+                coefficients=coefficients,
+            )
+            if memory_budget is None:
+                memory_budget = self.backend.available_memory()
+                if memory_budget is None:
+                    raise ValueError("eval_many needs a memory_budget")
+                memory_budget = int(0.8 * memory_budget)
+            batch_size = max(1, memory_budget // per_map)
+
+        # micro-batches of the same size, no small last one
+        nbatch = -(-nmaps // batch_size)
+        batch_size = -(-nmaps // nbatch)
+
+        res = []
+        for k in range(0, nmaps, batch_size):
+            r = self.eval(
+                image1[k : k + batch_size],
+                image2=None if image2 is None else image2[k : k + batch_size],
+                mask=mask,
+                norm=norm,
+                calc_var=calc_var,
+                Jmax=Jmax,
+                coefficients=coefficients,
+                S4_criteria=S4_criteria,
+            )
+            res.append(r if calc_var else (r,))
+
+        out = []
+        for i in range(len(res[0])):
+
+            def l_concat(name):
+                v = [getattr(r[i], name) for r in res]
+                if v[0] is None:
+                    return None
+                return self.backend.bk_concat(v, 0)
+
+            out.append(
+                scat_cov(
+                    l_concat("S0"),
+                    l_concat("S2"),
+                    l_concat("S3"),
+                    l_concat("S4"),
+                    s1=l_concat("S1"),
+                    s3p=l_concat("S3P"),
+                    backend=self.backend,
+                    use_1D=self.use_1D,
+                )
+            )
+
+        if calc_var:
+            return out[0], out[1]
+        return out[0]
+
+    def eval_stream(
+        self,
+        image1,
+        image2=None,
+        mask=None,
+        nside_chunk=None,
+        halo=None,
+        Jmax=None,
+        max_overhead=4.0,
+    ):
+        """
+        Calculates the scattering correlations of a healpix map chunk by chunk.
+        The map is cut in the pixels of nside_chunk, each one is evaluated with
+        eval(cell_ids=...) on its cells and halo rings of pixels of the coarsest
+        scale around them, and the masked means of the chunks are combined.
+        Only the cells of one chunk and its halo are read at a time, image1 and
+        image2 can be memory mapped arrays. The halo grows with the coarsest
+        scale, the configurations where it is more than max_overhead times
+        the chunk are rejected.
+        Parameters
+        ----------
+        image1: array
+            Nested healpix map [Npix] or maps [Nbatch, Npix]
+        image2: array
+            Second map. If not None, we compute cross-scattering covariance coefficients.
+        mask: array
+            None or a single mask [1, Npix]
+        nside_chunk: int
+            nside of the chunks, 12*nside_chunk**2 chunks are evaluated. If
+            None, the largest one allowed by max_overhead.
+        halo: int
+            Number of rings of pixels of the coarsest scale added around each
+            chunk, 2*KERNELSZ if None which gives the full sky result. A
+            thinner halo costs less but biases S3 and S4 first. Each chunk
+            evaluates about (1+2*halo*2**(Jmax-1)*nside_chunk/nside)**2 times
+            its own cells.
+        Jmax: int
+            Number of scales, at most log2(nside/nside_chunk)+1 so that the
+            coarsest scale is not coarser than the chunks. If None, the
+            largest one allowed by max_overhead with chunks of nside_chunk, 2
+            if nside_chunk is None.
+        max_overhead: float, default 4
+            Largest ratio between the cells of a chunk with its halo and the
+            cells of the chunk
+        Returns
+        -------
+        S1, S2, S3, S4 not normalized, as eval(norm=None) with the cell_ids of
+        the full sky (no up_grade of the map if KERNELSZ>3)
+        """
+        if self.use_2D or self.use_1D:
+            raise ValueError("eval_stream works on healpix maps")
+        if isinstance(mask, FOC.MaskPyramid):
+            raise ValueError("eval_stream takes the mask array, not a MaskPyramid")
+        if mask is not None and mask.shape[0] != 1:
+            raise ValueError("eval_stream takes a single mask [1, Npix]")
+
+        nside = int(np.sqrt(image1.shape[-1] // 12))
+        if halo is None:
+            halo = 2 * self.KERNELSZ
+        nside_chunk, Jmax = FOC.stream_chunk_param(
+            nside, halo, nside_chunk=nside_chunk, Jmax=Jmax, max_overhead=max_overhead
+        )
+        nside_halo = nside // 2 ** (Jmax - 1)
+
+        res = {}
+        wsum = 0.0
+        cache_cell_operators = self.cache_cell_operators
+        self.cache_cell_operators = False
+        try:
+            for ichunk in range(12 * nside_chunk**2):
+                cells, core = FOC.chunk_cell_ids(
+                    nside, nside_chunk, ichunk, nside_halo, halo
+                )
+                l_mask = core.astype(self.all_type)
+                if mask is not None:
+                    l_mask = l_mask * np.asarray(mask)[0, cells]
+                w = float(l_mask.sum())
+                if w == 0:
+                    continue
+
+                r = self.eval(
+                    image1[..., cells],
+                    image2=None if image2 is None else image2[..., cells],
+                    mask=l_mask.reshape(1, -1),
+                    Jmax=Jmax,
+                    nside=nside,
+                    cell_ids=cells,
+                )
+
+                # S0 holds the mean and its standard deviation
+                s0 = r.S0[:, 0:1]
+                s0_std = r.S0[:, 1:2]
+                l_res = {
+                    "S0": s0,
+                    "Q0": s0_std * s0_std * w + s0 * s0,
+                    "S1": r.S1,
+                    "S2": r.S2,
+                    "S3": r.S3,
+                    "S4": r.S4,
+                    "S3P": r.S3P,
+                }
+                for k, v in l_res.items():
+                    if v is not None:
+                        res[k] = w * v if k not in res else res[k] + w * v
+                wsum += w
+        finally:
+            self.cache_cell_operators = cache_cell_operators
+
+        if wsum == 0:
+            raise ValueError("eval_stream has an empty mask")
+
+        res = {k: v / wsum for k, v in res.items()}
+        s0_std = self.backend.bk_sqrt((res["Q0"] - res["S0"] * res["S0"]) / wsum)
+
+        return scat_cov(
+            self.backend.bk_concat([res["S0"], s0_std], 1),
+            res["S2"],
+            res["S3"],
+            res["S4"],
+            s1=res["S1"],
+            s3p=res.get("S3P"),
+            backend=self.backend,
+            use_1D=self.use_1D,
+        )
+
+    def eval_compiled(
+        self,
+        image1,
+        image2=None,
+        mask=None,
+        norm=None,
+        calc_var=False,
+        Jmax=None,
+        coefficients=None,
+        S4_criteria=None,
+    ):
+        """
+        Same as eval, computed by a graph compiled by the backend
+        (torch.compile or tf.function, eager with numpy) once per signature:
+        shapes and type of the images, mask and options. The first call of a
+        signature runs eval eagerly to initialise the operators, the next ones
+        reuse the graph without the python dispatch of every operation.
+        Parameters
+        ----------
+        image1: tensor
+            Healpix maps [Nbatch, Npix] or 2D images [Nbatch, Nx, Ny]
+        image2: tensor or scat_cov_ref
+            Second images. If not None, we compute cross-scattering covariance coefficients.
+        mask: array or MaskPyramid
+            None or masks [Nmask, Npix], part of the signature, a MaskPyramid
+            is compared by identity
+        norm, calc_var, Jmax, coefficients, S4_criteria:
+            As in eval, a S4_criteria function is compared by identity
+        Returns
+        -------
+        S1, S2, S3, S4 as eval
+        """
+        if self.use_1D:
+            raise ValueError("eval_compiled works on healpix maps and 2D images")
+        if self.return_data:
+            raise ValueError("eval_compiled does not work with return_data")
+        if norm == "auto":
+            # the reference S2 would be stored in self while tracing
+            raise ValueError("eval_compiled does not work with norm='auto'")
+        if self.BACKEND == "torch" and not self.use_2D and self.engine != "stencil":
+            raise ValueError("eval_compiled of healpix maps needs engine='stencil'")
+
+        ref = image2 if isinstance(image2, scat_cov_ref) else None
+        I1 = self.backend.bk_cast(image1)
+        I2 = None
+        if image2 is not None and ref is None:
+            I2 = self.backend.bk_cast(image2)
+
+        if isinstance(mask, FOC.MaskPyramid):
+            mask_key = mask
+        elif mask is not None:
+            l_mask = np.ascontiguousarray(self.backend.to_numpy(mask))
+            mask_key = (hashlib.sha1(l_mask.tobytes()).hexdigest(), l_mask.shape)
+        else:
+            mask_key = None
+        key = (
+            tuple(I1.shape),
+            str(I1.dtype),
+            ref if I2 is None else tuple(I2.shape),
+            mask_key,
+            norm,
+            calc_var,
+            Jmax,
+            None if coefficients is None else tuple(coefficients),
+            S4_criteria,
+        )
+
+        # the most recent graph is the last one
+        with self.lock:
+            compiled = self.compiled_evals.pop(key, None)
+        if compiled is None:
+            if isinstance(mask, FOC.MaskPyramid):
+                l_mask = mask
+            elif mask is not None:
+                if self.use_2D:
+                    l_mask = self.backend.bk_cast(l_mask)
+                else:
+                    nside = int(np.sqrt(image1.shape[-1] // 12))
+                    l_Jmax = int(np.log(nside) / np.log(2)) if Jmax is None else Jmax
+                    l_mask = self.mask_pyramid(l_mask, nside, l_Jmax)
+            else:
+                l_mask = None
+
+            def l_eval(I1, I2):
+                res = self.eval(
+                    I1,
+                    image2=I2 if ref is None else ref,
+                    mask=l_mask,
+                    norm=norm,
+                    calc_var=calc_var,
+                    Jmax=Jmax,
+                    coefficients=coefficients,
+                    S4_criteria=S4_criteria,
+                )
+                if not calc_var:
+                    res = [res]
+                return tuple([(r.S0, r.S2, r.S3, r.S4, r.S1, r.S3P) for r in res])
+
+            out = l_eval(I1, I2)
+            compiled = self.backend.bk_compile(l_eval)
+        else:
+            out = compiled(I1, I2)
+
+        with self.lock:
+            self.compiled_evals[key] = compiled
+            while len(self.compiled_evals) > 4:
+                del self.compiled_evals[next(iter(self.compiled_evals))]
+
+        res = [
+            scat_cov(
+                s0,
+                s2,
+                s3,
+                s4,
+                s1=s1,
+                s3p=s3p,
+                backend=self.backend,
+                use_1D=self.use_1D,
+            )
+            for s0, s2, s3, s4, s1, s3p in out
+        ]
+        if calc_var:
+            return res[0], res[1]
+        return res[0]
+
+    def _fft_orient(self, x, fft_orient, axis):
+        # contraction of an orientation axis of x with the angular harmonics
+        # (norient, nharm, imaginary) of calc_fft_orient, as fft_ang
+        if x is None:
+            return None
+        if self.backend.bk_is_complex(x):
+            lmat = self.backend._fft_1_orient_C[fft_orient]
+        else:
+            lmat = self.backend._fft_1_orient[fft_orient]
+        idx = "abcdefgh"[0 : len(x.shape)]
+        axis = axis % len(x.shape)
+        return self.backend.bk_einsum(
+            "%s,%sz->%sz%s" % (idx, idx[axis], idx[0:axis], idx[axis + 1 :]),
+            x,
+            lmat,
+        )
+
+    # ---------------------------------------------−---------
+    # S4_criteria of eval as a function of (j1, j2, j3)
+    def _S4_selector(self, S4_criteria):
+        if S4_criteria is None:
+            return lambda j1, j2, j3: True
+        if callable(S4_criteria):
+            try:
+                nparam = len(
+                    [
+                        p
+                        for p in inspect.signature(S4_criteria).parameters.values()
+                        if p.default is p.empty
+                        and p.kind in [p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD]
+                    ]
+                )
+            except (TypeError, ValueError):
+                nparam = 3
+            if nparam == 2:
+                return lambda j1, j2, j3: S4_criteria(j1, j2)
+            return S4_criteria
+        # compiled once, without access to the builtins
+        code = compile(S4_criteria, "<S4_criteria>", "eval")
+        return lambda j1, j2, j3: eval(
+            code, {"__builtins__": {}}, {"j1": j1, "j2": j2, "j3": j3}
+        )
+
     def clean_norm(self):
         self.P1_dic = None
         self.P2_dic = None
@@ -3624,6 +4378,7 @@ class funct(FOC.FoCUS):
         cmat2=None,
         cell_ids=None,
         nside_j2=None,
+        M_smooth_dic=None,
     ):
         """
         Compute the S3 coefficients (auto or cross)
@@ -3634,30 +4389,20 @@ class funct(FOC.FoCUS):
         -------
         cs3, ss3: real and imag parts of S3 coeff
         """
-        ### Compute |I1 * Psi_j2| * Psi_j3 = M1_j2 * Psi_j3
-        # Warning: M1_dic[j2] is already at j3 resolution [Nbatch, Norient3, Npix_j3]
-        MconvPsi = self.convol(
-            M_dic[j2], axis=2, cell_ids=cell_ids, nside=nside_j2
-        )  # [Nbatch,   Norient3, Norient2, Npix_j3]
-
-        if cmat2 is not None:
-            tmp2 = self.backend.bk_repeat(MconvPsi, self.NORIENT, axis=-3)
-            MconvPsi = self.backend.bk_reduce_sum(
-                self.backend.bk_reshape(
-                    cmat2[j3][j2] * tmp2,
-                    [
-                        tmp2.shape[0],
-                        self.NORIENT,
-                        self.NORIENT,
-                        self.NORIENT,
-                        cmat2[j3][j2].shape[3],
-                    ],
-                ),
-                1,
-            )
-
-        # Store it so we can use it in S4 computation
-        MconvPsi_dic[j2] = MconvPsi  # [Nbatch, Norient3, Norient2, Npix_j3]
+        if j2 in MconvPsi_dic:
+            # precomputed by prepare_ref
+            MconvPsi = MconvPsi_dic[j2]
+        else:
+            MconvPsi = self._compute_MconvPsi(
+                j2,
+                j3,
+                M_dic,
+                MconvPsi_dic,
+                cmat2=cmat2,
+                cell_ids=cell_ids,
+                nside_j2=nside_j2,
+                M_smooth_dic=M_smooth_dic,
+            )  # [Nbatch, Norient3, Norient2, Npix_j3]
 
         ### Compute the product (I2 * Psi)_j3 x (M1_j2 * Psi_j3)^*
         # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
@@ -3683,6 +4428,53 @@ class funct(FOC.FoCUS):
                 )  # [Nbatch, Nmask, Norient3, Norient2]
             return s3
 
+    def _compute_MconvPsi(
+        self,
+        j2,
+        j3,
+        M_dic,
+        MconvPsi_dic,
+        cmat2=None,
+        cell_ids=None,
+        nside_j2=None,
+        M_smooth_dic=None,
+    ):
+        """
+        Compute |Ib * Psi_j2| * Psi_j3 = M_j2 * Psi_j3 and store it in MconvPsi_dic
+        for the S4 computation
+        """
+        ### Compute |I1 * Psi_j2| * Psi_j3 = M1_j2 * Psi_j3
+        # Warning: M1_dic[j2] is already at j3 resolution [Nbatch, Norient3, Npix_j3]
+        if M_smooth_dic is not None:
+            # keep the smoothed M_dic[j2] computed in the same pass
+            MconvPsi, M_smooth_dic[j2] = self.convol_smooth(
+                M_dic[j2], axis=2, cell_ids=cell_ids, nside=nside_j2
+            )  # [Nbatch,   Norient3, Norient2, Npix_j3]
+        else:
+            MconvPsi = self.convol(
+                M_dic[j2], axis=2, cell_ids=cell_ids, nside=nside_j2
+            )  # [Nbatch,   Norient3, Norient2, Npix_j3]
+
+        if cmat2 is not None:
+            tmp2 = self.backend.bk_repeat(MconvPsi, self.NORIENT, axis=-3)
+            MconvPsi = self.backend.bk_reduce_sum(
+                self.backend.bk_reshape(
+                    cmat2[j3][j2] * tmp2,
+                    [
+                        tmp2.shape[0],
+                        self.NORIENT,
+                        self.NORIENT,
+                        self.NORIENT,
+                        cmat2[j3][j2].shape[3],
+                    ],
+                ),
+                1,
+            )
+
+        # Store it so we can use it in S4 computation
+        MconvPsi_dic[j2] = MconvPsi  # [Nbatch, Norient3, Norient2, Npix_j3]
+        return MconvPsi
+
     def _compute_S4(
         self,
         j1,
@@ -3692,6 +4484,8 @@ class funct(FOC.FoCUS):
         M2convPsi_dic=None,
         calc_var=False,
         return_data=False,
+        fft_orient=None,
+        fft_M2_dic=None,
     ):
         #### Simplify notations
         M1 = M1convPsi_dic[j1]  # [Nbatch, Norient3, Norient1, Npix_j3]
@@ -3702,8 +4496,22 @@ class funct(FOC.FoCUS):
         else:  # Cross
             M2 = M2convPsi_dic[j2]
 
+        if fft_orient is not None:
+            # angular harmonics of the orientation of M2 that is not shared
+            # with M1, the normalization of S4 does not depend on it
+            if j2 not in fft_M2_dic:
+                fft_M2_dic[j2] = self._fft_orient(
+                    M2, fft_orient, 2 if self.use_2D else 1
+                )
+            M2 = fft_M2_dic[j2]
+
         ### Compute the product (|I1 * Psi_j1| * Psi_j3)(|I2 * Psi_j2| * Psi_j3)
         # z_1 x z_2^* = (a1a2 + b1b2) + i(b1a2 - a1b2)
+        if not return_data and not self.use_1D and not self.use_2D:
+            # mean over the pixels without building the product
+            return self.masked_mean_prod(
+                M1, M2, vmask, calc_var=calc_var
+            )  # [Nbatch, Nmask, Norient3, Norient2, Norient1]
         if self.use_1D:
             s4 = M1 * self.backend.bk_conjugate(M2)
         else:
@@ -5835,26 +6643,14 @@ class funct(FOC.FoCUS):
     def reduce_mean(self, x):
 
         if isinstance(x, scat_cov):
-            result = (
-                self.backend.bk_reduce_sum(self.backend.bk_abs(x.S0))
-                + self.backend.bk_reduce_sum(self.backend.bk_abs(x.S2))
-                + self.backend.bk_reduce_sum(self.backend.bk_abs(x.S3))
-                + self.backend.bk_reduce_sum(self.backend.bk_abs(x.S4))
-            )
-
-            N = (
-                self.backend.bk_size(x.S0)
-                + self.backend.bk_size(x.S2)
-                + self.backend.bk_size(x.S3)
-                + self.backend.bk_size(x.S4)
-            )
-
-            if x.S1 is not None:
-                result = result + self.backend.bk_reduce_sum(self.backend.bk_abs(x.S1))
-                N = N + self.backend.bk_size(x.S1)
-            if x.S3P is not None:
-                result = result + self.backend.bk_reduce_sum(self.backend.bk_abs(x.S3P))
-                N = N + self.backend.bk_size(x.S3P)
+            result = self.backend.bk_reduce_sum(self.backend.bk_abs(x.S0))
+            N = self.backend.bk_size(x.S0)
+
+            # coefficients not computed by eval are None
+            for v in [x.S1, x.S2, x.S3, x.S3P, x.S4]:
+                if v is not None:
+                    result = result + self.backend.bk_reduce_sum(self.backend.bk_abs(v))
+                    N = N + self.backend.bk_size(v)
             return result / self.backend.bk_cast(N)
         else:
             return self.backend.bk_reduce_mean(x, axis=0)
@@ -5922,32 +6718,21 @@ class funct(FOC.FoCUS):
         if isinstance(x, scat_cov):
             if sigma is None:
                 result = self.diff_data(y.S0, x.S0, is_complex=False)
-                if x.S1 is not None:
-                    result += self.diff_data(y.S1, x.S1)
-                if x.S3P is not None:
-                    result += self.diff_data(y.S3P, x.S3P)
-                result += self.diff_data(y.S2, x.S2)
-                result += self.diff_data(y.S3, x.S3)
-                result += self.diff_data(y.S4, x.S4)
             else:
                 result = self.diff_data(y.S0, x.S0, is_complex=False, sigma=sigma.S0)
-                if x.S1 is not None:
-                    result += self.diff_data(y.S1, x.S1, sigma=sigma.S1)
-                if x.S3P is not None:
-                    result += self.diff_data(y.S3P, x.S3P, sigma=sigma.S3P)
-                result += self.diff_data(y.S2, x.S2, sigma=sigma.S2)
-                result += self.diff_data(y.S3, x.S3, sigma=sigma.S3)
-                result += self.diff_data(y.S4, x.S4, sigma=sigma.S4)
-            nval = (
-                self.backend.bk_size(x.S0)
-                + self.backend.bk_size(x.S2)
-                + self.backend.bk_size(x.S3)
-                + self.backend.bk_size(x.S4)
-            )
-            if x.S1 is not None:
-                nval += self.backend.bk_size(x.S1)
-            if x.S3P is not None:
-                nval += self.backend.bk_size(x.S3P)
+            nval = self.backend.bk_size(x.S0)
+
+            # coefficients not computed by eval are None
+            for name in ["S1", "S3P", "S2", "S3", "S4"]:
+                if getattr(x, name) is None:
+                    continue
+                if sigma is None:
+                    result += self.diff_data(getattr(y, name), getattr(x, name))
+                else:
+                    result += self.diff_data(
+                        getattr(y, name), getattr(x, name), sigma=getattr(sigma, name)
+                    )
+                nval += self.backend.bk_size(getattr(x, name))
             result /= self.backend.bk_cast(nval)
             return result
         else:
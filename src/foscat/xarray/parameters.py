@@ -47,4 +47,5 @@ class Parameters:
             JmaxDelta=self.jmax_delta,
             all_type=self.dtype,
             BACKEND=self.backend,
+            lazy=True,
         )
@@ -0,0 +1,21 @@
+import pytest
+
+import foscat.scat_cov as sc
+
+
+@pytest.fixture
+def funct(tmp_path):
+    # scattering operator of the tests, its operators are cached in tmp_path
+    def make(BACKEND="torch", KERNELSZ=3, TEMPLATE_PATH=None, **kw):
+        param = dict(NORIENT=4, all_type="float64", lazy=True)
+        param.update(kw)
+        if TEMPLATE_PATH is None:
+            TEMPLATE_PATH = tmp_path
+        return sc.funct(
+            KERNELSZ=KERNELSZ,
+            BACKEND=BACKEND,
+            TEMPLATE_PATH=str(TEMPLATE_PATH),
+            **param,
+        )
+
+    return make
@@ -0,0 +1,309 @@
+import healpy as hp
+import numpy as np
+import pytest
+
+import foscat.FoCUS as FOC
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_convol_stacked(funct, backend):
+    op = funct(BACKEND=backend)
+    nside = 8
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 3, 12 * nside**2])
+    cim = im + 1j * rng.normal(size=im.shape)
+
+    wr, wi = op.get_ww(nside)
+    wr = op.backend.to_numpy(wr.to_dense()) if backend == "torch" else wr.toarray()
+    wi = op.backend.to_numpy(wi.to_dense()) if backend == "torch" else wi.toarray()
+    assert wr.shape == (12 * nside**2, 4 * 12 * nside**2)
+
+    for x in [im, cim]:
+        res = op.backend.to_numpy(op.convol(op.backend.bk_cast(x)))
+        ref = (x @ wr + 1j * (x @ wi)).reshape(2, 3, 4, 12 * nside**2)
+        np.testing.assert_allclose(res, ref, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_stencil_engine(funct, backend):
+    op = funct(BACKEND=backend, KERNELSZ=5)
+    op_st = funct(BACKEND=backend, KERNELSZ=5, engine="stencil")
+    nside = 8
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 3, 12 * nside**2])
+    cim = im + 1j * rng.normal(size=im.shape)
+
+    for x in [im, cim]:
+        x = op.backend.bk_cast(x)
+        for name in ["convol", "smooth"]:
+            ref = op.backend.to_numpy(getattr(op, name)(x))
+            res = op.backend.to_numpy(getattr(op_st, name)(x))
+            np.testing.assert_allclose(res, ref, rtol=0, atol=1e-12)
+        for l_op in [op, op_st]:
+            res = l_op.convol_smooth(x)
+            np.testing.assert_allclose(
+                op.backend.to_numpy(res[0]),
+                op.backend.to_numpy(op.convol(x)),
+                rtol=0,
+                atol=1e-12,
+            )
+            np.testing.assert_allclose(
+                op.backend.to_numpy(res[1]),
+                op.backend.to_numpy(op.smooth(x)),
+                rtol=0,
+                atol=1e-12,
+            )
+
+    ref = op.eval(im[0], image2=im[1])
+    res = op_st.eval(im[0], image2=im[1])
+    for name in ["S0", "S1", "S2", "S3", "S3P", "S4"]:
+        np.testing.assert_allclose(
+            op.backend.to_numpy(getattr(res, name)),
+            op.backend.to_numpy(getattr(ref, name)),
+            rtol=1e-10,
+        )
+
+    with pytest.raises(ValueError):
+        funct(BACKEND=backend, KERNELSZ=5, engine="dense")
+
+
+@pytest.mark.parametrize(
+    ["backend", "conv_type"], [("numpy", "float16"), ("torch", "bfloat16")]
+)
+def test_conv_type(funct, backend, conv_type):
+    kw = dict(BACKEND=backend, engine="stencil")
+    op = funct(**kw)
+    op_h = funct(all_type="float32", conv_type=conv_type, **kw)
+    nside = 8
+    im = hp.synfast(np.arange(1, 3 * nside) ** -1.5, nside, lmax=3 * nside - 1)
+    im = np.stack([im, im[::-1]])
+
+    assert op_h.convol(op_h.backend.bk_cast(im)).dtype == op_h.all_cbk_type
+    ref = op.eval(im)
+    res = op_h.eval(im)
+    for name in ["S1", "S2", "S3", "S4"]:
+        x = op.backend.to_numpy(getattr(ref, name))
+        y = op_h.backend.to_numpy(getattr(res, name))
+        assert np.abs(y - x).max() < 5e-2 * np.abs(x).max()
+
+    with pytest.raises(ValueError):
+        funct(BACKEND=backend, all_type="float32", conv_type=conv_type, engine="sparse")
+    with pytest.raises(ValueError):
+        funct(all_type="float32", conv_type="int8", **kw)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_eval_compiled(funct, backend):
+    op = funct(BACKEND=backend, engine="stencil")
+    nside = 4
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 12 * nside**2])
+    mask = (rng.uniform(size=[2, 12 * nside**2]) > 0.3).astype("float64")
+
+    # the first call is eager, the next ones reuse the graph
+    for k in range(3):
+        x = rng.normal(size=im.shape)
+        res = op.eval_compiled(x, mask=mask, coefficients=["S1", "S2"])
+        ref = op.eval(x, mask=mask, coefficients=["S1", "S2"])
+        assert res.S3 is None and res.S4 is None
+        for name in ["S0", "S1", "S2"]:
+            np.testing.assert_allclose(
+                op.backend.to_numpy(getattr(res, name)),
+                op.backend.to_numpy(getattr(ref, name)),
+                rtol=1e-10,
+            )
+    assert len(op.compiled_evals) == 1
+
+    with pytest.raises(ValueError):
+        op.eval_compiled(im, norm="auto")
+    if backend == "torch":
+        op.engine = "sparse"
+        with pytest.raises(ValueError):
+            op.eval_compiled(im)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_eval_nharm(funct, backend):
+    op = funct(BACKEND=backend)
+    nside = 8
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 12 * nside**2])
+    mask = (rng.uniform(size=[1, 12 * nside**2]) > 0.2).astype("float64")
+
+    for image2, l_mask in [(None, None), (im[::-1].copy(), mask)]:
+        ref = op.eval(im, image2=image2, mask=l_mask).fft_ang(nharm=1, imaginary=True)
+        res = op.eval(im, image2=image2, mask=l_mask, nharm=1, imaginary=True)
+        for name in ["S0", "S1", "S2", "S3", "S4", "S3P"]:
+            if getattr(ref, name) is None:
+                assert getattr(res, name) is None
+                continue
+            np.testing.assert_allclose(
+                op.backend.to_numpy(getattr(res, name)),
+                op.backend.to_numpy(getattr(ref, name)),
+                rtol=1e-8,
+                atol=1e-12,
+            )
+
+    with pytest.raises(ValueError):
+        op.eval(im, nharm=1, calc_var=True)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_eval_stream(funct, tmp_path, backend):
+    op = funct(BACKEND=backend)
+    nside = 16
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 12 * nside**2])
+    np.save(tmp_path / "im.npy", im)
+    im = np.load(tmp_path / "im.npy", mmap_mode="r")
+    mask = (rng.uniform(size=[1, 12 * nside**2]) > 0.2).astype("float64")
+
+    for image2, l_mask in [(None, None), (np.ascontiguousarray(im[::-1]), mask)]:
+        ref = op.eval(np.array(im), image2=image2, mask=l_mask, Jmax=3)
+        # degenerate chunks of 7/8 of the sky, to compare with eval on a small map
+        res = op.eval_stream(
+            im, image2=image2, mask=l_mask, nside_chunk=1, Jmax=3, max_overhead=16
+        )
+        for name in ["S0", "S1", "S2", "S3", "S4", "S3P"]:
+            if getattr(ref, name) is None:
+                assert getattr(res, name) is None
+                continue
+            np.testing.assert_allclose(
+                op.backend.to_numpy(getattr(res, name)),
+                op.backend.to_numpy(getattr(ref, name)),
+                rtol=1e-10,
+                atol=1e-12,
+            )
+
+    # only the full sky operators of eval are written in the cache
+    assert all(
+        [k.split("_")[1] in ["WAVE", "SMOO"] for k in op.get_operator_cache().keys()]
+    )
+    assert op.cache_cell_operators
+    with pytest.raises(ValueError):
+        op.eval_stream(im, nside_chunk=4, Jmax=4, max_overhead=100)
+    with pytest.raises(ValueError):
+        op.eval_stream(im, nside_chunk=1, Jmax=3)
+
+
+def test_stream_chunk_param():
+    # the default chunks and their halo are a small fraction of the sky
+    for nside in [1024, 4096]:
+        nside_chunk, Jmax = FOC.stream_chunk_param(nside, 6)
+        assert nside_chunk == 2 and Jmax >= 6
+        cells, core = FOC.chunk_cell_ids(
+            nside, nside_chunk, 0, nside // 2 ** (Jmax - 1), 6
+        )
+        assert cells.shape[0] < 0.07 * 12 * nside**2
+        assert cells.shape[0] <= 4 * core.sum()
+
+    # the largest chunks for a given Jmax
+    assert FOC.stream_chunk_param(1024, 6, Jmax=3) == (16, 3)
+    with pytest.raises(ValueError):
+        FOC.stream_chunk_param(1024, 6, nside_chunk=8, Jmax=6)
+    with pytest.raises(ValueError):
+        FOC.stream_chunk_param(16, 6)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_eval_many(funct, backend):
+    op = funct(BACKEND=backend)
+    nside = 8
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[5, 12 * nside**2])
+    im2 = rng.normal(size=[5, 12 * nside**2])
+    per_map = op.eval_memory(nside)
+    assert op.eval_memory(nside, cross=True) > per_map
+
+    ref = op.eval(im, image2=im2, calc_var=True)
+    # micro-batches of 2, 2 and 1 maps
+    res = op.eval_many(im, image2=im2, calc_var=True, memory_budget=2 * per_map)
+    for r1, r2 in zip(res, ref):
+        for name in ["S0", "S1", "S2", "S3", "S4", "S3P"]:
+            np.testing.assert_allclose(
+                op.backend.to_numpy(getattr(r1, name)),
+                op.backend.to_numpy(getattr(r2, name)),
+                rtol=1e-10,
+                atol=1e-12,
+            )
+
+    res = op.eval_many(im, batch_size=1)
+    assert res.S3P is None
+    np.testing.assert_allclose(
+        op.backend.to_numpy(res.S4), op.backend.to_numpy(op.eval(im).S4), rtol=1e-10
+    )
+    with pytest.raises(ValueError):
+        op.eval_many(im, norm="auto", batch_size=1)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_eval_coefficients(funct, backend):
+    op = funct(BACKEND=backend)
+    nside = 8
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 12 * nside**2])
+    im2 = rng.normal(size=[2, 12 * nside**2])
+    # (j1, j2, j3) of the S4 coefficients
+    jj = [
+        (j1, j2, j3) for j3 in range(3) for j2 in range(j3 + 1) for j1 in range(j2 + 1)
+    ]
+    sel = [k for k, (j1, j2, j3) in enumerate(jj) if j2 - j1 <= 1]
+
+    for image2 in [None, im2]:
+        ref = op.eval(im, image2=image2, norm="self")
+        for coefficients, criteria in [
+            (["S1", "S2"], None),
+            (["S3"], None),
+            (["S2", "S4"], "j2-j1<=1"),
+            (["S4"], lambda j1, j2, j3: j2 - j1 <= 1),
+            (["S4"], lambda j1, j2: j2 - j1 <= 1),
+        ]:
+            res = op.eval(
+                im,
+                image2=image2,
+                norm="self",
+                coefficients=coefficients,
+                S4_criteria=criteria,
+            )
+            for name in ["S1", "S2", "S3", "S3P", "S4"]:
+                if name[0:2] not in coefficients or getattr(ref, name) is None:
+                    assert getattr(res, name) is None
+                    continue
+                val = op.backend.to_numpy(getattr(ref, name))
+                if name == "S4":
+                    val = val[:, :, sel]
+                np.testing.assert_allclose(
+                    op.backend.to_numpy(getattr(res, name)), val, rtol=1e-10
+                )
+
+    assert op.eval_memory(nside, coefficients=["S1", "S2"]) < op.eval_memory(nside)
+    with pytest.raises(ValueError):
+        op.eval(im, coefficients=["S5"])
+    # a str criteria has no builtins
+    with pytest.raises(NameError):
+        op.eval(im, coefficients=["S4"], S4_criteria="__import__('os')")
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_prepare_ref(funct, backend):
+    op = funct(BACKEND=backend)
+    nside = 8
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 12 * nside**2])
+    im2 = rng.normal(size=[2, 12 * nside**2])
+    mask = (rng.uniform(size=[2, 12 * nside**2]) > 0.3).astype("float64")
+
+    ref = op.prepare_ref(im2)
+    for kwargs in [{}, {"mask": mask, "norm": "self"}, {"Jmax": 2}]:
+        r1 = op.eval(im, image2=im2, **kwargs)
+        r2 = op.eval(im, image2=ref, **kwargs)
+        for name in ["S0", "S1", "S2", "S3", "S3P", "S4"]:
+            np.testing.assert_allclose(
+                op.backend.to_numpy(getattr(r2, name)),
+                op.backend.to_numpy(getattr(r1, name)),
+                rtol=1e-10,
+                atol=1e-14,
+            )
+
+    with pytest.raises(ValueError):
+        op.eval(im, image2=op.prepare_ref(im2, Jmax=2))
@@ -0,0 +1,249 @@
+import os
+
+import healpy as hp
+import numpy as np
+import pytest
+
+import foscat.FoCUS as FOC
+
+
+def per_pixel_index(op, nside, l_kernel):
+    # reference: the historical one pixel at a time computation of init_index
+    pw, pw2, threshold = FOC.wave_kernel_param(l_kernel)
+    ncell = 12 * nside * nside
+    th, ph = hp.pix2ang(nside, np.arange(ncell), nest=True)
+    x, y, z = hp.pix2vec(nside, np.arange(ncell), nest=True)
+    phi = ph / np.pi * 180
+    thi = th / np.pi * 180
+
+    indice, wav, indice2, wwav = [], [], [], []
+    for iii in range(ncell):
+        hidx = hp.query_disc(
+            nside, [x[iii], y[iii], z[iii]], 2 * np.pi / nside, nest=True
+        )
+        R = hp.Rotator(rot=[phi[iii], -thi[iii]], eulertype="ZYZ")
+        x2, y2, z2 = hp.ang2vec(*R(th[hidx], ph[hidx])).T
+
+        ww = np.exp(-pw2 * nside**2 * (x2**2 + y2**2 + (z2 - 1.0) ** 2))
+        idx = np.where(ww**2 > threshold)[0]
+        indice2 += [[k, iii] for k in hidx[idx]]
+        wwav.append(ww[idx] / np.sum(ww[idx]))
+
+        for l_rotation in range(op.NORIENT):
+            angle = (
+                l_rotation / 4.0 * np.pi
+                - phi[iii] / 180.0 * np.pi * (z[hidx] > 0)
+                - (180.0 - phi[iii]) / 180.0 * np.pi * (z[hidx] < 0)
+            )
+            axes = y2 * np.cos(angle) - x2 * np.sin(angle)
+            wresr = ww * np.cos(pw * axes * nside * np.pi)
+            wresi = ww * np.sin(pw * axes * nside * np.pi)
+            idx = np.where(wresr * wresr + wresi * wresi > threshold)[0]
+            indice += [[k, iii + l_rotation * ncell] for k in hidx[idx]]
+            val = (
+                wresr[idx]
+                - np.mean(wresr[idx])
+                + 1j * (wresi[idx] - np.mean(wresi[idx]))
+            )
+            r = abs(val).sum()
+            if r > 0:
+                val = val / r
+            wav.append(val)
+
+    return (
+        np.array(indice),
+        np.concatenate(wav),
+        np.array(indice2),
+        np.concatenate(wwav),
+    )
+
+
+def per_cell_index(op, nside, l_kernel, cell_ids):
+    # reference: the historical quadratic computation of init_index for cell_ids
+    pw, pw2, threshold = FOC.wave_kernel_param(l_kernel)
+    ncell = cell_ids.shape[0]
+    th, ph = hp.pix2ang(nside, cell_ids, nest=True)
+    x, y, z = hp.pix2vec(nside, cell_ids, nest=True)
+    phi = ph / np.pi * 180
+    thi = th / np.pi * 180
+
+    indice, wav, indice2, wwav = [], [], [], []
+    for iii in range(ncell):
+        hidx = np.where(
+            (x - x[iii]) ** 2 + (y - y[iii]) ** 2 + (z - z[iii]) ** 2
+            < (2 * np.pi / nside) ** 2
+        )[0]
+        R = hp.Rotator(rot=[phi[iii], -thi[iii]], eulertype="ZYZ")
+        x2, y2, z2 = hp.ang2vec(*R(th[hidx], ph[hidx])).T
+
+        ww = np.exp(-pw2 * nside**2 * (x2**2 + y2**2 + (z2 - 1.0) ** 2))
+        idx = np.where(ww**2 > threshold)[0]
+        indice2 += [[k, iii] for k in hidx[idx]]
+        wwav.append(ww[idx] / np.sum(ww[idx]))
+
+        for l_rotation in range(op.NORIENT):
+            angle = (
+                l_rotation / 4.0 * np.pi
+                - phi[iii] / 180.0 * np.pi * (z[hidx] > 0)
+                - (180.0 - phi[iii]) / 180.0 * np.pi * (z[hidx] < 0)
+            )
+            axes = y2 * np.cos(angle) - x2 * np.sin(angle)
+            wresr = ww * np.cos(pw * axes * nside * np.pi)
+            wresi = ww * np.sin(pw * axes * nside * np.pi)
+            idx = np.where(wresr * wresr + wresi * wresi > threshold)[0]
+            indice += [[k, iii + l_rotation * ncell] for k in hidx[idx]]
+            val = (
+                wresr[idx]
+                - np.mean(wresr[idx])
+                + 1j * (wresi[idx] - np.mean(wresi[idx]))
+            )
+            r = abs(val).sum()
+            if r > 0:
+                val = val / r
+            wav.append(val)
+
+    return (
+        np.array(indice),
+        np.concatenate(wav),
+        np.array(indice2),
+        np.concatenate(wwav),
+    )
+
+
+@pytest.mark.parametrize("kernelsz", [3, 5, 7])
+@pytest.mark.parametrize("nside", [2, 4, 8])
+def test_calc_wave_index(funct, kernelsz, nside):
+    op = funct(lazy=False, BACKEND="numpy", KERNELSZ=kernelsz)
+
+    indice, wav, indice2, wwav = op.calc_wave_index(nside, kernelsz, block_size=100)
+    r_indice, r_wav, r_indice2, r_wwav = per_pixel_index(op, nside, kernelsz)
+
+    np.testing.assert_array_equal(indice, r_indice)
+    np.testing.assert_array_equal(indice2, r_indice2)
+    np.testing.assert_allclose(wav, r_wav, rtol=0, atol=1e-14)
+    np.testing.assert_allclose(wwav, r_wwav, rtol=0, atol=1e-14)
+
+
+@pytest.mark.parametrize("kernelsz", [3, 5])
+def test_calc_wave_index_cell_ids(funct, kernelsz):
+    op = funct(BACKEND="numpy", KERNELSZ=kernelsz)
+    nside = 16
+    cell_ids = np.concatenate([np.arange(40, 300), np.arange(1000, 1100)])
+
+    res = op.calc_wave_index(nside, kernelsz, block_size=100, cell_ids=cell_ids)
+    ref = per_cell_index(op, nside, kernelsz, cell_ids)
+
+    np.testing.assert_array_equal(res[0], ref[0])
+    np.testing.assert_array_equal(res[2], ref[2])
+    np.testing.assert_allclose(res[1], ref[1], rtol=0, atol=1e-14)
+    np.testing.assert_allclose(res[3], ref[3], rtol=0, atol=1e-14)
+
+
+def test_cell_ids_operators(funct):
+    op = funct()
+    nside = 16
+    tiles = [np.arange(0, 256), np.arange(512, 1024)]
+    im = np.random.default_rng(0).normal(size=12 * nside**2)
+
+    for cell_ids in tiles + tiles:
+        res = op.convol(
+            op.backend.bk_cast(im[cell_ids]), cell_ids=cell_ids, nside=nside
+        )
+        assert res.shape == (4, cell_ids.shape[0])
+        assert op.ww_RealImag[nside].shape == (
+            cell_ids.shape[0],
+            8 * cell_ids.shape[0],
+        )
+
+    # the cell sets are in their own store of the cache
+    assert op.get_operator_cache().keys() == []
+    cache = op.get_operator_cache(cells=True)
+    for cell_ids in tiles:
+        cells = FOC.cell_ids_hash(cell_ids)
+        for name in FOC.WAVE_CACHE_NAMES:
+            assert FOC.cache_key(nside, name, cells) in cache
+
+    # bounded, the least recently used cell sets are removed
+    size = sum(os.path.getsize(cache.filename(k)) for k in cache.keys())
+    op.operator_caches = {}
+    op.cell_cache_size = size - 1
+    cell_ids = np.arange(2000, 2100)
+    op.convol(op.backend.bk_cast(im[cell_ids]), cell_ids=cell_ids, nside=nside)
+    cache = op.get_operator_cache(cells=True)
+    assert sum(os.path.getsize(cache.filename(k)) for k in cache.keys()) < size
+    cells = FOC.cell_ids_hash(cell_ids)
+    for name in FOC.WAVE_CACHE_NAMES:
+        assert FOC.cache_key(nside, name, cells) in cache
+
+
+def test_wave_operators(funct):
+    op = funct()
+    nside = 8
+    ncell = 12 * nside**2
+    indice, wav, indice2, wwav = op.calc_wave_index(nside, 3)
+    wr, wi, ws, _ = op.init_index(nside)
+
+    ref = np.zeros([ncell, 4 * ncell], dtype="complex")
+    ref[indice[:, 0], indice[:, 1]] = wav
+    np.testing.assert_array_equal(wr.to_dense().numpy(), ref.real)
+    np.testing.assert_array_equal(wi.to_dense().numpy(), ref.imag)
+    ref = np.zeros([ncell, ncell])
+    ref[indice2[:, 0], indice2[:, 1]] = wwav
+    np.testing.assert_array_equal(ws.to_dense().numpy(), ref)
+
+
+def test_init_wave(funct):
+    # InitWave without cell_ids
+    def InitWave(op, nside):
+        calls.append(nside)
+        return ref.init_index(nside, kernel=3)
+
+    calls = []
+    ref = funct()
+    op = funct(InitWave=InitWave)
+    im = np.random.default_rng(0).normal(size=12 * 8**2)
+    res = op.convol(op.backend.bk_cast(im))
+    assert calls == [8]
+    np.testing.assert_allclose(
+        op.backend.to_numpy(res),
+        ref.backend.to_numpy(ref.convol(ref.backend.bk_cast(im))),
+    )
+
+
+def test_precompute(funct, tmp_path):
+    op = funct(lazy=False, BACKEND="numpy", KERNELSZ=5)
+
+    op.precompute([16, 32], workers=2, nchunk=3)
+
+    cache = op.get_operator_cache()
+    assert [p.name for p in tmp_path.iterdir()] == [os.path.basename(cache.path)]
+    for nside in [16, 32]:
+        ref = FOC.wave_cache_arrays(nside, 4, *op.calc_wave_index(nside, 5))
+        for key, val in ref.items():
+            np.testing.assert_array_equal(cache.get(key), val)
+        assert op.Idx_Neighbours[nside] is not None
+        assert op.ww_RealImag[nside].shape == (12 * nside**2, 8 * 12 * nside**2)
+
+
+def test_lazy(funct, tmp_path):
+    op = funct()
+    assert list(tmp_path.iterdir()) == []
+
+    im = np.random.default_rng(0).normal(size=12 * 16**2)
+    res = op.convol(op.backend.bk_cast(im))
+    smo = op.smooth(im)
+
+    cache = op.get_operator_cache()
+    assert [p.name for p in tmp_path.iterdir()] == [os.path.basename(cache.path)]
+    assert sorted(cache.keys()) == sorted(
+        FOC.cache_key(16, name) for name in FOC.WAVE_CACHE_NAMES
+    )
+
+    ref = funct(lazy=False)
+    np.testing.assert_allclose(
+        op.backend.to_numpy(res),
+        ref.backend.to_numpy(ref.convol(ref.backend.bk_cast(im))),
+    )
+    np.testing.assert_allclose(
+        op.backend.to_numpy(smo), ref.backend.to_numpy(ref.smooth(im))
+    )
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_masked_mean_prod(funct, backend):
+    op = funct(BACKEND=backend, mask_norm=True)
+    rng = np.random.default_rng(0)
+    npix = 12 * 4**2
+    x1 = rng.normal(size=[2, 3, 4, npix]) + 1j * rng.normal(size=[2, 3, 4, npix])
+    x2 = rng.normal(size=[2, 5, 4, npix]) + 1j * rng.normal(size=[2, 5, 4, npix])
+    mask = np.stack([np.ones(npix), rng.uniform(size=npix)])
+    x1, x2, mask = [op.backend.bk_cast(x) for x in [x1, x2, mask]]
+
+    prod = op.backend.bk_expand_dims(x1, -4) * op.backend.bk_conjugate(
+        op.backend.bk_expand_dims(x2, -3)
+    )
+    ref = op.masked_mean(prod, mask, axis=4, calc_var=True)
+    res = op.masked_mean_prod(x1, x2, mask, calc_var=True)
+    for r, v in zip(res, ref):
+        assert r.shape == v.shape
+        np.testing.assert_allclose(
+            op.backend.to_numpy(r), op.backend.to_numpy(v), rtol=1e-10
+        )
+
+    # full sky fast path
+    ones = op.backend.bk_cast(np.ones([1, npix]))
+    res = op.masked_mean_prod(x1, x2, None, calc_var=True)
+    ref = op.masked_mean_prod(x1, x2, ones, calc_var=True)
+    ref2 = op.masked_mean(x1, ones, axis=3, calc_var=True)
+    res2 = op.masked_mean(x1, None, axis=3, calc_var=True)
+    for r, v in zip(res + res2, ref + ref2):
+        assert r.shape == v.shape
+        np.testing.assert_allclose(
+            op.backend.to_numpy(r), op.backend.to_numpy(v), rtol=1e-10
+        )
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_mask_pyramid(funct, backend, monkeypatch):
+    op = funct(BACKEND=backend, KERNELSZ=5)
+    nside = 8
+    rng = np.random.default_rng(0)
+    mask = (rng.uniform(size=[2, 12 * nside**2]) > 0.3).astype("float64")
+
+    assert op.mask_pyramid(np.ones([1, 12 * nside**2]), nside, 3) == [None] * 3
+    pyramid = op.mask_pyramid(mask, nside, 3)
+    # up_graded for KERNELSZ=5 then downgraded
+    assert [v.shape[1] for v in pyramid] == [12 * 16**2, 12 * 8**2, 12 * 4**2]
+    assert op.mask_pyramid(mask.copy(), nside, 2)[1] is pyramid[1]
+    for k in range(5):
+        op.mask_pyramid(mask + k, nside, 2)
+    assert len(op.mask_pyramids) == 4
+
+    # the same mask object again is neither copied to the host nor hashed
+    ones = op.backend.bk_cast(np.ones([1, 12 * nside**2]))
+    vmask = op.backend.bk_cast(mask)
+    assert op.mask_pyramid(ones, nside, 3) == [None] * 3
+    pyramid = op.mask_pyramid(vmask, nside, 3)
+    with monkeypatch.context() as m:
+        m.setattr(op.backend, "to_numpy", None)
+        assert op.mask_pyramid(vmask, nside, 2)[1] is pyramid[1]
+    assert op.mask_pyramid(ones, nside, 3) == [None] * 3
+    with monkeypatch.context() as m:
+        m.setattr(op.backend, "to_numpy", None)
+        assert op.mask_pyramid(ones, nside, 3) == [None] * 3
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_masked_mean_var(funct, backend):
+    op = funct(BACKEND=backend, all_type="float32")
+    nside = 16
+    rng = np.random.default_rng(0)
+    # large offset, E[x*x]-E[x]**2 cancels out in float32
+    im = 1e4 + rng.normal(size=[1, 12 * nside**2])
+    mask = (rng.uniform(size=[2, 12 * nside**2]) > 0.3).astype("float64")
+
+    for l_mask in [None, mask]:
+        res, std = op.masked_mean(
+            op.backend.bk_cast(im.astype("float32")),
+            None if l_mask is None else op.backend.bk_cast(l_mask),
+            axis=1,
+            calc_var=True,
+        )
+        if l_mask is None:
+            l_mask = np.ones([1, 12 * nside**2])
+        mean = np.sum(l_mask * im, -1) / np.sum(l_mask, -1)
+        var = np.sum(l_mask * (im - mean[:, None]) ** 2, -1) / np.sum(l_mask, -1)
+        np.testing.assert_allclose(op.backend.to_numpy(res).ravel(), mean, rtol=1e-6)
+        np.testing.assert_allclose(
+            op.backend.to_numpy(std).ravel(),
+            np.sqrt(var / np.sum(l_mask, -1)),
+            rtol=1e-3,
+        )
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_prepare_mask(funct, backend):
+    op = funct(BACKEND=backend)
+    nside = 8
+    rng = np.random.default_rng(0)
+    im = rng.normal(size=[2, 12 * nside**2])
+    mask = (rng.uniform(size=[2, 12 * nside**2]) > 0.3).astype("float64")
+    pyramid = op.prepare_mask(mask)
+
+    for image2 in [None, im[::-1].copy()]:
+        ref = op.eval(im, image2=image2, mask=mask, norm="self")
+        res = op.eval(im, image2=image2, mask=pyramid, norm="self")
+        for name in ["S0", "S1", "S2", "S3", "S4", "S3P"]:
+            if getattr(ref, name) is None:
+                assert getattr(res, name) is None
+                continue
+            np.testing.assert_allclose(
+                op.backend.to_numpy(getattr(res, name)),
+                op.backend.to_numpy(getattr(ref, name)),
+                rtol=1e-12,
+            )
+
+    with pytest.raises(ValueError):
+        op.eval(im, mask=op.prepare_mask(mask, Jmax=2), Jmax=3)
+
+    if backend == "torch":
+        op = funct(BACKEND=backend, use_2D=True)
+        im = rng.normal(size=[2, 32, 32])
+        mask = (rng.uniform(size=[1, 32, 32]) > 0.3).astype("float64")
+        ref = op.eval(im, mask=mask)
+        res = op.eval(im, mask=op.prepare_mask(mask))
+        for name in ["S0", "S1", "S2", "S3", "S4"]:
+            np.testing.assert_allclose(
+                op.backend.to_numpy(getattr(res, name)),
+                op.backend.to_numpy(getattr(ref, name)),
+                rtol=1e-12,
+            )
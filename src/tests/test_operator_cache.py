@@ -0,0 +1,116 @@
+import os
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+
+import foscat.OperatorCache as OC
+from foscat.OperatorCache import OperatorCache
+
+
+def test_operator_cache(tmp_path):
+    cache = OperatorCache(str(tmp_path / "op.cache"), "V1")
+    assert "a" not in cache
+
+    a = np.arange(10, dtype="int32")
+    b = np.linspace(0, 1, 7).reshape(7, 1)
+    cache.update({"a": a, "b": b, "c": np.zeros([0, 2])})
+    cache.update({"b": 2 * b})
+
+    other = OperatorCache(cache.path, "V1")
+    assert sorted(other.keys()) == ["a", "b", "c"]
+    assert isinstance(other.get("a"), np.memmap)
+    np.testing.assert_array_equal(other.get("a"), a)
+    np.testing.assert_array_equal(other.get("b"), 2 * b)
+    assert other.get("c").shape == (0, 2)
+    assert OperatorCache(cache.path, "V2").keys() == []
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_operator_cache_lock(tmp_path, shared):
+    path = str(tmp_path / "op.cache")
+    computed = []
+    shared_cache = OperatorCache(path, "V1")
+
+    def work():
+        # one cache per process, or one shared by the threads
+        cache = shared_cache if shared else OperatorCache(path, "V1")
+        with cache.lock():
+            if "a" not in cache:
+                computed.append(1)
+                time.sleep(0.2)
+                cache.update({"a": np.arange(1000)})
+        return cache.get("a")
+
+    with ThreadPoolExecutor(4) as pool:
+        res = list(pool.map(lambda i: work(), range(4)))
+
+    assert len(computed) == 1
+    for val in res:
+        np.testing.assert_array_equal(val, np.arange(1000))
+    assert [
+        p.name for p in (tmp_path / "op.cache").iterdir() if p.suffix == ".tmp"
+    ] == []
+
+
+def test_operator_cache_corrupted(tmp_path):
+    cache = OperatorCache(str(tmp_path / "op.cache"), "V1")
+    cache.update({"a": np.arange(1000), "b": np.ones(10)})
+    size = os.path.getsize(cache.filename("b"))
+
+    # checksum mismatch of one array
+    with open(cache.filename("b"), "r+b") as f:
+        f.seek(size - 8)
+        f.write(b"\x01")
+    assert OperatorCache(cache.path, "V1").keys() == ["a"]
+
+    # truncated file
+    with open(cache.filename("a"), "r+b") as f:
+        f.truncate(size - 64)
+    other = OperatorCache(cache.path, "V1")
+    assert other.keys() == []
+    other.update({"b": np.ones(10)})
+    assert OperatorCache(cache.path, "V1").keys() == ["b"]
+
+
+def test_operator_cache_removed(tmp_path, monkeypatch):
+    cache = OperatorCache(str(tmp_path / "op.cache"), "V1")
+    cache.update({"a": np.arange(1000)})
+
+    # removed by another process between the stat and the open of the file
+    def remove_open(name, *args):
+        if os.path.exists(name):
+            os.remove(name)
+        return open(name, *args)
+
+    other = OperatorCache(cache.path, "V1")
+    monkeypatch.setattr(OC, "open", remove_open, raising=False)
+    assert "a" not in other
+    monkeypatch.undo()
+    other.update({"a": np.arange(1000)})
+    np.testing.assert_array_equal(other.get("a"), np.arange(1000))
+
+
+def test_operator_cache_update(tmp_path):
+    cache = OperatorCache(str(tmp_path / "op.cache"), "V1", max_size=2500)
+    cache.update({"a": np.arange(100)})
+    mtime = os.stat(cache.filename("a")).st_mtime_ns
+
+    # the other arrays are not written again
+    cache.update({"b": np.arange(100)})
+    assert os.stat(cache.filename("a")).st_mtime_ns == mtime
+
+    # the least recently used array goes above max_size
+    os.utime(cache.filename("a"), ns=(mtime - 10**9, mtime - 10**9))
+    a = cache.get("a")
+    cache.update({"c": np.arange(100)})
+    assert OperatorCache(cache.path, "V1").keys() == ["a", "c"]
+
+    # copy on write maps, given to torch without warning
+    assert a.flags.writeable
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        torch.as_tensor(a)
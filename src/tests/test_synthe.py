@@ -9,9 +9,13 @@ import foscat.Synthesis as synthe
 nside = 16
 
 import os
+import tempfile
 
+# downloaded out of the working directory
+target_map = os.path.join(tempfile.mkdtemp(), "target_map_lss.npy")
 os.system(
-    "wget -O target_map_lss.npy https://github.com/astro-informatics/s2scat/raw/main/notebooks/data/target_map_lss.npy"
+    "wget -O %s https://github.com/astro-informatics/s2scat/raw/main/notebooks/data/target_map_lss.npy"
+    % (target_map)
 )
 
 from scipy.interpolate import RegularGridInterpolator
@@ -19,7 +23,7 @@ from scipy.interpolate import RegularGridInterpolator
 # convert the input data in a nside=128 healpix map
 l_nside = 128
 
-im = np.load("target_map_lss.npy")
+im = np.load(target_map)
 xsize, ysize = im.shape
 
 # Define the new row and column to be added to prepare the interpolation
@@ -0,0 +1,425 @@
+import os
+import sys
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import foscat.Synthesis as synthe
+
+
+@pytest.mark.parametrize("optimizer", ["lbfgs", "adam"])
+def test_synthesis_optimizer(funct, optimizer):
+    op = funct()
+    nside = 4
+    rng = np.random.default_rng(0)
+    ref = op.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+
+    def The_loss(u, scat_operator, args):
+        learn = scat_operator.eval(u, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    sy = synthe.Synthesis([synthe.Loss(The_loss, op, ref)])
+    omap = sy.run(
+        3 * rng.normal(size=12 * nside**2),
+        NUM_EPOCHS=20,
+        EVAL_FREQUENCY=100,
+        LEARNING_RATE=0.1,
+        optimizer=optimizer,
+    )
+    history = sy.get_history()
+    assert list(omap.shape) == [12 * nside**2]
+    assert history[-1] < 0.5 * history[0]
+
+    with pytest.raises(ValueError):
+        sy.run(np.zeros(12 * nside**2), optimizer="sgd")
+    # do_lbfgs does not select the optimizer
+    sy.run(np.zeros(12 * nside**2), NUM_EPOCHS=1, do_lbfgs=False)
+    assert sy.optimizer == "scipy"
+
+
+def test_synthesis_stochastic(funct):
+    op = funct()
+    nside = 4
+    rng = np.random.default_rng(0)
+    ref = op.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+    noise = op.backend.bk_cast(0.1 * rng.normal(size=[8, 12 * nside**2]))
+
+    def batch(batch_data, istep, init=False):
+        return batch_data[2 * istep : 2 * istep + 2]
+
+    def The_loss(u, l_batch, scat_operator, args):
+        learn = scat_operator.eval(u[None] + l_batch, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    loss = synthe.Loss(The_loss, op, ref, batch=batch, batch_data=noise)
+    for svrg in [None, 3]:
+        sy = synthe.Synthesis([loss])
+        sy.run(
+            3 * rng.normal(size=12 * nside**2),
+            NUM_EPOCHS=20,
+            EVAL_FREQUENCY=100,
+            LEARNING_RATE=0.1,
+            batchsz=2,
+            totalsz=8,
+            optimizer="adam",
+            nsample=2,
+            svrg=svrg,
+        )
+        history = sy.get_history()
+        assert history[-1] < 0.5 * history[0]
+        # one noise batch per iteration
+        assert sy.imin == 21 * 2
+
+    # the snapshot gradient of SVRG is the full one
+    x = op.backend.bk_cast(rng.normal(size=12 * nside**2))
+    l_full, g_full = sy.device_grad(x)
+    l_snap, g_snap = sy.sample_grad(x, 0, nsample=2, svrg=3)
+    np.testing.assert_allclose(op.to_numpy(g_snap), op.to_numpy(g_full))
+
+    # each bias step restarts adam
+    sy = synthe.Synthesis([loss])
+    sy.run(
+        3 * rng.normal(size=12 * nside**2),
+        NUM_EPOCHS=5,
+        NUM_STEP_BIAS=2,
+        EVAL_FREQUENCY=100,
+        batchsz=2,
+        totalsz=8,
+        optimizer="adam",
+    )
+    assert sy.pbeta1 == pytest.approx(sy.beta1**6)
+    assert sy.pbeta2 == pytest.approx(sy.beta2**6)
+
+    with pytest.raises(ValueError):
+        sy.run(np.zeros(12 * nside**2), nsample=2, optimizer="lbfgs")
+
+
+def test_synthesis_threads(funct):
+    op = funct()
+    nside = 4
+    rng = np.random.default_rng(0)
+    refs = [
+        op.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+        for k in range(3)
+    ]
+    x0 = rng.normal(size=12 * nside**2)
+
+    def The_loss(u, scat_operator, args):
+        learn = scat_operator.eval(u, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    res = []
+    for nthread in [1, 3]:
+        sy = synthe.Synthesis([synthe.Loss(The_loss, op, ref) for ref in refs])
+        omap = sy.run(
+            x0, NUM_EPOCHS=5, EVAL_FREQUENCY=100, optimizer="lbfgs", nthread=nthread
+        )
+        res.append((op.to_numpy(omap), sy.get_history()))
+        assert sy.executor is None
+    np.testing.assert_allclose(res[1][0], res[0][0])
+    np.testing.assert_allclose(res[1][1], res[0][1])
+
+
+def test_threads_cold_operator(funct, tmp_path):
+    # the operators of a lazy funct are built by the first thread needing them
+    nside = 8
+    rng = np.random.default_rng(0)
+    ims = rng.normal(size=[6, 12 * nside**2])
+    mask = (rng.uniform(size=[1, 12 * nside**2]) > 0.2).astype("float64")
+    ref = funct(TEMPLATE_PATH=tmp_path / "ref")
+    refs = [ref.eval(im, mask=mask, Jmax=3) for im in ims]
+
+    op = funct(TEMPLATE_PATH=tmp_path / "cold")
+    with ThreadPoolExecutor(3) as pool:
+        res = list(pool.map(lambda im: op.eval(im, mask=mask, Jmax=3), ims))
+    for r, l_ref in zip(res, refs):
+        for name in ["S0", "S1", "S2", "S3", "S4"]:
+            np.testing.assert_allclose(
+                op.to_numpy(getattr(r, name)), ref.to_numpy(getattr(l_ref, name))
+            )
+
+    # synthesis on 3 threads with an operator never used before
+    nside = 4
+    targets = [
+        ref.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+        for k in range(3)
+    ]
+
+    def The_loss(u, scat_operator, args):
+        learn = scat_operator.eval(u, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    x0 = rng.normal(size=12 * nside**2)
+    res = []
+    for nthread, path in [(1, "serial"), (3, "threads")]:
+        op = funct(TEMPLATE_PATH=tmp_path / path)
+        sy = synthe.Synthesis([synthe.Loss(The_loss, op, t) for t in targets])
+        omap = sy.run(
+            x0, NUM_EPOCHS=5, EVAL_FREQUENCY=100, optimizer="lbfgs", nthread=nthread
+        )
+        res.append(op.to_numpy(omap))
+    np.testing.assert_allclose(res[1], res[0])
+
+
+class FakeComm:
+    # two processes, the other one has the same gradient and losses
+    def __init__(self, ngrad):
+        self.ngrad = ngrad
+        self.sent = []
+        # checkpoint generations of the other process, the same if None
+        self.generations = None
+
+    def Barrier(self):
+        pass
+
+    def allgather(self, value):
+        return [value, value if self.generations is None else self.generations]
+
+    def Allreduce(self, send, recv):
+        recv[0][:] = 2 * send[0]
+
+    def Iallreduce(self, send, recv, op=None):
+        other = send.copy()
+        if send.shape[0] > self.ngrad:
+            # loss values of the other process in its slots of l_log
+            nlog = send.shape[0] - self.ngrad
+            other[self.ngrad :] = np.roll(send[self.ngrad :], nlog // 2)
+        recv[:] = send + other
+        self.sent.append(send)
+        return len(self.sent)
+
+
+def test_synthesis_mpi_reduce(funct, monkeypatch):
+    op = funct()
+    nside = 4
+    rng = np.random.default_rng(0)
+    ref = op.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+    noise = op.backend.bk_cast(0.1 * rng.normal(size=[8, 12 * nside**2]))
+
+    def batch(batch_data, istep, init=False):
+        return batch_data[2 * istep : 2 * istep + 2]
+
+    def The_loss(u, l_batch, scat_operator, args):
+        learn = scat_operator.eval(u[None] + l_batch, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    def The_loss2(u, scat_operator, args):
+        learn = scat_operator.eval(u, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    losses = [
+        synthe.Loss(The_loss, op, ref, batch=batch, batch_data=noise),
+        synthe.Loss(The_loss2, op, ref),
+    ]
+    x0 = rng.normal(size=12 * nside**2)
+    x = op.backend.bk_cast(x0)
+    param = dict(NUM_EPOCHS=1, EVAL_FREQUENCY=100, optimizer="lbfgs")
+    sy = synthe.Synthesis(losses)
+    sy.run(x0, batchsz=2, totalsz=8, **param)
+    l_ref, g_ref = sy.loss_grad(x)
+    g_ref = op.to_numpy(g_ref)
+    ltot_ref = sy.ltot.copy()
+
+    comm = FakeComm(12 * nside**2)
+    mpi = types.SimpleNamespace(
+        COMM_WORLD=comm,
+        SUM="SUM",
+        INT="INT",
+        Request=types.SimpleNamespace(Waitall=lambda reqs: None),
+    )
+    monkeypatch.setitem(sys.modules, "mpi4py", types.SimpleNamespace(MPI=mpi))
+
+    for mpi_float32, mpi_nreduce, rtol in [
+        (False, 1, 0),
+        (False, 2, 1e-12),
+        (True, 1, 1e-6),
+    ]:
+        sy = synthe.Synthesis(losses)
+        sy.mpi_size = 2
+        sy.run(
+            x0,
+            batchsz=2,
+            totalsz=8,
+            mpi_float32=mpi_float32,
+            mpi_nreduce=mpi_nreduce,
+            **param,
+        )
+        comm.sent = []
+        l_tot, grad = sy.loss_grad(x)
+
+        # mpi_nreduce packed buffers, the last one with the losses
+        dtype = "float32" if mpi_float32 else "float64"
+        assert [v.dtype for v in comm.sent] == [np.dtype(dtype)] * mpi_nreduce
+        assert comm.sent[-1].shape[0] == 12 * nside**2 + 4
+        np.testing.assert_allclose(grad, 2 * g_ref, rtol=rtol, atol=rtol * 1e-3)
+        # the losses of both processes, in their slots
+        np.testing.assert_allclose(sy.ltot, np.tile(ltot_ref, 2), rtol=1e-6)
+        np.testing.assert_allclose(l_tot, l_ref, rtol=1e-6)
+
+    # complex gradients are sent as their real and imaginary parts
+    comm.ngrad = 2 * 12 * nside**2
+    g1 = rng.normal(size=12 * nside**2) + 1j * rng.normal(size=12 * nside**2)
+    g2 = rng.normal(size=12 * nside**2) + 1j * rng.normal(size=12 * nside**2)
+    reqs = [
+        sy.start_reduce(op.backend.bk_cast(g1)),
+        sy.start_reduce(op.backend.bk_cast(g2), sy.l_log),
+    ]
+    assert comm.sent[-1].shape[0] == 2 * 12 * nside**2 + 4
+    grad, ltot = sy.finish_reduce(reqs)
+    np.testing.assert_allclose(grad, 2 * (g1 + g2), rtol=1e-6)
+    np.testing.assert_allclose(ltot, np.tile(sy.l_log[0:2], 2))
+
+
+class ImmediateExecutor:
+    # runs the tasks at submission, the test returns them in reverse order
+    def submit(self, fn, *args):
+        f = Future()
+        f.set_result(fn(*args))
+        return f
+
+
+def test_synthesis_mpi_reduce_order(funct, monkeypatch):
+    op = funct()
+    nside = 4
+    rng = np.random.default_rng(0)
+    ref = op.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+    noise = op.backend.bk_cast(0.1 * rng.normal(size=[8, 12 * nside**2]))
+
+    def batch(batch_data, istep, init=False):
+        return batch_data[2 * istep : 2 * istep + 2]
+
+    def The_loss(u, l_batch, scat_operator, args):
+        learn = scat_operator.eval(u[None] + l_batch, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    comm = FakeComm(12 * nside**2)
+    mpi = types.SimpleNamespace(
+        COMM_WORLD=comm,
+        SUM="SUM",
+        INT="INT",
+        Request=types.SimpleNamespace(Waitall=lambda reqs: None),
+    )
+    monkeypatch.setitem(sys.modules, "mpi4py", types.SimpleNamespace(MPI=mpi))
+
+    x0 = rng.normal(size=12 * nside**2)
+    x = op.backend.bk_cast(x0)
+    sent = []
+    for executor in [None, ImmediateExecutor()]:
+        sy = synthe.Synthesis(
+            [synthe.Loss(The_loss, op, ref, batch=batch, batch_data=noise)]
+        )
+        sy.mpi_size = 2
+        # 4 batch steps in 3 groups of different sizes
+        sy.run(
+            x0,
+            batchsz=2,
+            totalsz=8,
+            NUM_EPOCHS=1,
+            EVAL_FREQUENCY=100,
+            optimizer="lbfgs",
+            mpi_nreduce=3,
+        )
+        monkeypatch.setattr(
+            synthe, "as_completed", lambda fs: list(fs)[::-1], raising=False
+        )
+        sy.executor = executor
+        comm.sent = []
+        sy.loss_grad(x)
+        sent.append(comm.sent)
+
+    # the same buffers in the order of the groups, the last one with l_log
+    assert [v.shape[0] for v in sent[1]] == [12 * nside**2] * 2 + [12 * nside**2 + 2]
+    for v, l_ref in zip(sent[1], sent[0]):
+        np.testing.assert_allclose(v, l_ref, rtol=1e-12)
+
+
+@pytest.mark.parametrize("optimizer", ["lbfgs", "adam"])
+def test_synthesis_resume(funct, tmp_path, optimizer):
+    op = funct()
+    nside = 4
+    rng = np.random.default_rng(0)
+    ref = op.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+    x0 = 3 * rng.normal(size=12 * nside**2)
+
+    def The_loss(u, scat_operator, args):
+        learn = scat_operator.eval(u, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    def run(nepoch, **kwargs):
+        sy = synthe.Synthesis([synthe.Loss(The_loss, op, ref)])
+        omap = sy.run(
+            x0,
+            NUM_EPOCHS=nepoch,
+            EVAL_FREQUENCY=100,
+            LEARNING_RATE=0.1,
+            optimizer=optimizer,
+            **kwargs,
+        )
+        return op.to_numpy(omap), sy.get_history()
+
+    ck = str(tmp_path / "synthesis.npz")
+    omap, history = run(10)
+    # a run stopped after 6 iterations, checkpointed every 3
+    run(6, checkpoint=ck, checkpoint_freq=3)
+    assert os.path.exists(ck)
+    res, res_history = run(10, checkpoint=ck, checkpoint_freq=3, resume=True)
+    np.testing.assert_allclose(res, omap)
+    np.testing.assert_allclose(res_history, history)
+
+
+def test_synthesis_resume_mpi(funct, tmp_path, monkeypatch):
+    op = funct()
+    nside = 4
+    rng = np.random.default_rng(0)
+    ref = op.eval(rng.normal(size=12 * nside**2), coefficients=["S1", "S2"])
+    x0 = 3 * rng.normal(size=12 * nside**2)
+
+    comm = FakeComm(12 * nside**2)
+    mpi = types.SimpleNamespace(
+        COMM_WORLD=comm,
+        SUM="SUM",
+        INT="INT",
+        Request=types.SimpleNamespace(Waitall=lambda reqs: None),
+    )
+    monkeypatch.setitem(sys.modules, "mpi4py", types.SimpleNamespace(MPI=mpi))
+
+    def The_loss(u, scat_operator, args):
+        learn = scat_operator.eval(u, coefficients=["S1", "S2"])
+        return scat_operator.reduce_distance(learn, args[0])
+
+    def run(nepoch, **kwargs):
+        sy = synthe.Synthesis([synthe.Loss(The_loss, op, ref)])
+        sy.mpi_size = 2
+        omap = sy.run(
+            x0, NUM_EPOCHS=nepoch, EVAL_FREQUENCY=100, optimizer="lbfgs", **kwargs
+        )
+        return op.to_numpy(omap)
+
+    ck = str(tmp_path / "synthesis.npz")
+    omap = run(10)
+
+    # generations of rank 0 named by iteration, the previous one is kept
+    run(10, checkpoint=ck, checkpoint_freq=3)
+    assert sorted(p.name for p in tmp_path.glob("synthesis.npz*")) == [
+        "synthesis.npz.0.10",
+        "synthesis.npz.0.7",
+    ]
+
+    # the other process only wrote the generation 7, the last one is not read
+    with open(ck + ".0.10", "wb") as f:
+        f.write(b"pre-empted")
+    comm.generations = [4, 7]
+    np.testing.assert_allclose(
+        run(10, checkpoint=ck, checkpoint_freq=3, resume=True), omap
+    )
+
+    # no common generation, all the processes start again
+    for p in tmp_path.glob("synthesis.npz*"):
+        with open(p, "wb") as f:
+            f.write(b"pre-empted")
+    comm.generations = [1]
+    np.testing.assert_allclose(
+        run(10, checkpoint=ck, checkpoint_freq=3, resume=True), omap
+    )